@@ -0,0 +1,97 @@
+from __future__ import division, print_function
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+from visual_dynamics.utils.benchmark import run_benchmarks, get_environment_info
+from visual_dynamics.utils.container import ImageDataContainer
+
+
+def str2bool(v):
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise argparse.ArgumentTypeError('boolean value expected')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the throughput of the data pipeline on synthetic '
+                                                 'containers and write the results to a JSON file')
+    parser.add_argument('--output_fname', '-o', type=str, default=None,
+                        help='JSON file that the results are written to')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='directory in which the synthetic containers are generated (and reused by later runs); '
+                             'defaults to a temporary directory that is removed afterwards')
+    parser.add_argument('--num_containers', type=int, default=4)
+    parser.add_argument('--num_trajs', '-n', type=int, default=10)
+    parser.add_argument('--num_steps', '-t', type=int, default=10)
+    parser.add_argument('--image_shape', type=int, nargs=3, default=[256, 256, 3],
+                        help='shape of the synthetic images (the default is the camera size of the environments)')
+    parser.add_argument('--image_storages', type=str, nargs='+', choices=ImageDataContainer.IMAGE_STORAGES,
+                        default=list(ImageDataContainer.IMAGE_STORAGES))
+    parser.add_argument('--transformers_fnames', type=str, nargs='+', default=None,
+                        help='transformers config files (e.g. config/transformer/transformer_32.yaml), or none to '
+                             'not preprocess the data; defaults to all the files in config/transformer that have '
+                             'image and action transformers')
+    parser.add_argument('--nb_workers', type=int, nargs='+', default=[0, 4],
+                        help='numbers of workers, where 0 computes the minibatches in this process')
+    parser.add_argument('--parallels', type=str, nargs='+', choices=['process', 'thread'], default=['process'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32])
+    parser.add_argument('--shuffles', type=str2bool, nargs='+', default=[True])
+    parser.add_argument('--num_batches', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.transformers_fnames is None:
+        transformer_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                       'config', 'transformer')
+        transformers_fnames = sorted(glob.glob(os.path.join(transformer_dir, 'transformer*.yaml')))
+    else:
+        transformers_fnames = [None if fname == 'none' else fname for fname in args.transformers_fnames]
+
+    def print_result(result):
+        if result['nb_worker'] > 0:
+            workers = '%d %s worker(s)' % (result['nb_worker'], result['parallel'])
+        else:
+            workers = 'no workers'
+        print("%s, %s, %s, batch size %d, shuffle %r: %.1f samples/s, p50 %.1f ms, p99 %.1f ms, "
+              "%.1f MB read, CPU utilization %.2f" %
+              (result['image_storage'], result['transformers_fname'], workers, result['batch_size'],
+               result['shuffle'], result['samples_per_sec'], result['latency_p50'] * 1000, result['latency_p99'] * 1000,
+               result['bytes_read'] / 2 ** 20, result['cpu_utilization']))
+
+    data_dir = args.data_dir or tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(data_dir,
+                                 image_storages=args.image_storages,
+                                 transformers_fnames=transformers_fnames,
+                                 nb_workers=args.nb_workers,
+                                 batch_sizes=args.batch_sizes,
+                                 shuffles=args.shuffles,
+                                 parallels=args.parallels,
+                                 num_containers=args.num_containers,
+                                 num_trajs=args.num_trajs,
+                                 num_steps=args.num_steps,
+                                 image_shape=tuple(args.image_shape),
+                                 num_batches=args.num_batches,
+                                 callback=print_result)
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    if args.output_fname:
+        settings = dict(vars(args))
+        settings['transformers_fnames'] = transformers_fnames
+        with open(args.output_fname, 'w') as output_file:
+            json.dump(dict(environment=get_environment_info(), settings=settings, results=results),
+                      output_file, indent=2, sort_keys=True)
+        print("Saved results to %s" % args.output_fname)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+from __future__ import division, print_function
+
+import argparse
+import time
+
+from visual_dynamics.utils.config import from_yaml
+
+
+def main():
+    parser = argparse.ArgumentParser(description='eagerly build the feature containers of the frozen encoder that '
+                                                 'are used by the solver when it trains from features')
+    parser.add_argument('predictor_fname', type=str, help='config file of the predictor (e.g. a model snapshot)')
+    parser.add_argument('solver_fname', type=str, help='config file of the solver (e.g. a solver snapshot)')
+    parser.add_argument('--feature_cache_dir', '-f', type=str, help='overrides the feature_cache_dir of the solver')
+    args = parser.parse_args()
+
+    with open(args.predictor_fname) as predictor_file:
+        predictor = from_yaml(predictor_file)
+    with open(args.solver_fname) as solver_file:
+        solver = from_yaml(solver_file)
+    if args.feature_cache_dir:
+        solver.feature_cache_dir = args.feature_cache_dir
+    if not solver.feature_cache_dir:
+        raise ValueError('the solver has no feature_cache_dir and none was given')
+
+    start_time = time.time()
+    feature_layers = solver.get_feature_layers(predictor)
+    print("Feature layers: %r" % [feature_layer.name for feature_layer in feature_layers])
+    feature_data_fnames, _ = solver.get_data(predictor, solver.train_data_fnames + solver.val_data_fnames,
+                                             feature_layers)
+    for feature_data_fname in feature_data_fnames:
+        print(feature_data_fname)
+    print("Built the features in %.2f s" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
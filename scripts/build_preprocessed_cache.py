@@ -0,0 +1,49 @@
+from __future__ import division, print_function
+
+import argparse
+import time
+
+import yaml
+
+from visual_dynamics.utils.cache import PreprocessedDataCache
+from visual_dynamics.utils.config import Python2to3Loader, from_config
+from visual_dynamics.utils.container import ImageDataContainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='eagerly build the preprocessed data caches used by DataGenerator')
+    parser.add_argument('transformers_fname', type=str)
+    parser.add_argument('data_fname', type=str)
+    parser.add_argument('--cache_dir', '-c', type=str, required=True)
+    parser.add_argument('--data_names', nargs='+', type=str, default=['image'])
+    parser.add_argument('--dtype', type=str, default='float32')
+    args = parser.parse_args()
+
+    with open(args.transformers_fname) as transformers_file:
+        transformers_config = yaml.load(transformers_file, Loader=Python2to3Loader)
+
+    with open(args.data_fname) as data_file:
+        data_config = yaml.load(data_file, Loader=Python2to3Loader)
+    data_fnames = data_config.get('train_data_fnames', []) + data_config.get('val_data_fnames', [])
+
+    for data_fname in data_fnames:
+        with ImageDataContainer(data_fname) as container:
+            env_spec = from_config(container.get_info('env_spec_config'))
+            for data_name in args.data_names:
+                # same replacements as the ones done when training
+                if data_name == 'action':
+                    replace_config = {'space': env_spec.action_space}
+                elif data_name in env_spec.observation_space.spaces:
+                    replace_config = {'space': env_spec.observation_space.spaces[data_name]}
+                else:
+                    replace_config = {}
+                transformer = from_config(transformers_config[data_name], replace_config=replace_config)
+                start_time = time.time()
+                print("Building cache of %s for %s..." % (data_name, data_fname))
+                cache = PreprocessedDataCache(args.cache_dir, container, data_name, transformer, dtype=args.dtype)
+                cache.build(container)
+                print("... finished in %.2f s" % (time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
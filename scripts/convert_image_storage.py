@@ -0,0 +1,30 @@
+from __future__ import division, print_function
+
+import argparse
+import shutil
+
+from visual_dynamics.utils.container import ImageDataContainer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='convert the image storage of data containers')
+    parser.add_argument('data_dirs', nargs='+', type=str)
+    parser.add_argument('--image_storage', '-s', type=str, choices=ImageDataContainer.IMAGE_STORAGES, default='hdf5')
+    parser.add_argument('--output_suffix', type=str, default=None,
+                        help='if specified, each data directory is copied to a directory with this suffix and the '
+                             'copy is converted instead')
+    args = parser.parse_args()
+
+    for data_dir in args.data_dirs:
+        if args.output_suffix:
+            output_dir = data_dir.rstrip('/') + args.output_suffix
+            print("Copying %s to %s" % (data_dir, output_dir))
+            shutil.copytree(data_dir, output_dir)
+            data_dir = output_dir
+        with ImageDataContainer(data_dir, 'r+') as container:
+            print("Converting %s from image storage %s to %s" % (data_dir, container.image_storage, args.image_storage))
+            container.convert_image_storage(args.image_storage)
+
+
+if __name__ == '__main__':
+    main()
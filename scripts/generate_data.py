@@ -19,6 +19,13 @@ def main():
     parser.add_argument('--output_dir', '-o', type=str, default=None)
     parser.add_argument('--num_trajs', '-n', type=int, default=10, metavar='N', help='total number of data points is N*T')
     parser.add_argument('--num_steps', '-t', type=int, default=10, metavar='T', help='number of time steps per trajectory')
+    parser.add_argument('--image_storage', type=str, choices=ImageDataContainer.IMAGE_STORAGES, default='file')
+    parser.add_argument('--depth_storage', type=str, choices=ImageDataContainer.DEPTH_STORAGES, default='float16')
+    parser.add_argument('--num_write_threads', type=int, default=0,
+                        help='number of threads that encode and write the images (0 to write them synchronously)')
+    parser.add_argument('--variable_length', action='store_true',
+                        help='store the trajectories in appendable datasets so that the episodes can terminate early '
+                             'and the container only has the trajectories that were collected')
     parser.add_argument('--visualize', '-v', type=int, default=None)
     parser.add_argument('--record_file', '-r', type=str, default=None)
     args = parser.parse_args()
@@ -37,9 +44,14 @@ def main():
         pol = from_config(policy_config, replace_config=replace_config)
 
     if args.output_dir:
-        container = ImageDataContainer(args.output_dir, 'x')
-        container.reserve(list(env.observation_space.spaces.keys()) + ['state'], (args.num_trajs, args.num_steps + 1))
-        container.reserve(['action', 'state_diff'], (args.num_trajs, args.num_steps))
+        container = ImageDataContainer(args.output_dir, 'x', image_storage=args.image_storage,
+                                       depth_storage=args.depth_storage, num_write_threads=args.num_write_threads)
+        if args.variable_length:
+            container.reserve(list(env.observation_space.spaces.keys()) + ['state', 'action', 'state_diff'],
+                              (None, None))
+        else:
+            container.reserve(list(env.observation_space.spaces.keys()) + ['state'], (args.num_trajs, args.num_steps + 1))
+            container.reserve(['action', 'state_diff'], (args.num_trajs, args.num_steps))
         container.add_info(environment_config=env.get_config())
         container.add_info(env_spec_config=envs.EnvSpec(env.action_space, env.observation_space).get_config())
         container.add_info(policy_config=pol.get_config())
@@ -60,6 +72,7 @@ def main():
             writer.setup(fig, args.record_file, fig.dpi)
 
     start_time = time.time()
+    num_frames = 0
     done = False
     for traj_iter in range(args.num_trajs):
         print('traj_iter', traj_iter)
@@ -71,17 +84,21 @@ def main():
             for step_iter in range(args.num_steps):
                 if container:
                     container.add_datum(traj_iter, step_iter, state=state, **obs)
+                num_frames += 1
 
                 action = pol.act(obs)
                 obs, _, episode_done, _ = env.step(action)  # action is updated in-place if needed
-                if episode_done:
-                    raise NotImplementedError('Early termination of episodes is not allowed during data generation/collection.')
+                if episode_done and not args.variable_length:
+                    raise NotImplementedError('Early termination of episodes is only allowed during data '
+                                              'generation/collection when --variable_length is used.')
 
                 if container:
                     prev_state, state = state, env.get_state()
                     container.add_datum(traj_iter, step_iter, action=action, state_diff=state - prev_state)
-                    if step_iter == (args.num_steps - 1):
+                    if step_iter == (args.num_steps - 1) or episode_done:
                         container.add_datum(traj_iter, step_iter + 1, state=state, **obs)
+                if step_iter == (args.num_steps - 1) or episode_done:
+                    num_frames += 1
 
                 if args.visualize:
                     env.render()
@@ -91,7 +108,7 @@ def main():
                             writer.grab_frame()
                     except:
                         done = True
-                if done:
+                if done or episode_done:
                     break
             if done:
                 break
@@ -103,7 +120,7 @@ def main():
     if container:
         container.close()
     end_time = time.time()
-    print("average FPS: {}".format(args.num_trajs * (args.num_steps + 1) / (end_time - start_time)))
+    print("average FPS: {}".format(num_frames / (end_time - start_time)))
 
 
 if __name__ == "__main__":
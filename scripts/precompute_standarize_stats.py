@@ -0,0 +1,75 @@
+from __future__ import division, print_function
+
+import argparse
+import multiprocessing
+import time
+import traceback
+
+from visual_dynamics.predictors.solver import get_standarize_layers, get_standarize_stats_results
+from visual_dynamics.utils.config import from_yaml
+
+
+def load_predictor_and_solver(predictor_fname, solver_fname):
+    with open(predictor_fname) as predictor_file:
+        predictor = from_yaml(predictor_file)
+    with open(solver_fname) as solver_file:
+        solver = from_yaml(solver_file)
+    return predictor, solver
+
+
+def standarize_stats_worker(predictor_fname, solver_fname, aggregating_batch_size, shard_id, num_shards,
+                            result_queue):
+    try:
+        predictor, solver = load_predictor_and_solver(predictor_fname, solver_fname)
+        online_stats = solver.compute_standarize_stats(predictor, get_standarize_layers(predictor),
+                                                       aggregating_batch_size=aggregating_batch_size,
+                                                       shard_id=shard_id, num_shards=num_shards)
+        result_queue.put((shard_id, online_stats, None))
+    except Exception:
+        result_queue.put((shard_id, None, traceback.format_exc()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='precompute the statistics of the standarize layers that are '
+                                                 'cached and reused by the solver')
+    parser.add_argument('predictor_fname', type=str, help='config file of the predictor (e.g. a model snapshot)')
+    parser.add_argument('solver_fname', type=str, help='config file of the solver (e.g. a solver snapshot)')
+    parser.add_argument('--nb_worker', '-w', type=int, default=4,
+                        help='number of processes that compute the statistics of interleaved shards of the data')
+    parser.add_argument('--aggregating_batch_size', type=int, default=100)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    # each worker builds its own net (and initializes its own device) in a fresh process, and the workers are not
+    # daemonic since the data generators of compute_standarize_stats start processes of their own
+    context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') else multiprocessing
+    result_queue = context.Queue()
+    workers = dict()
+    for shard_id in range(args.nb_worker):
+        worker = context.Process(target=standarize_stats_worker,
+                                 args=(args.predictor_fname, args.solver_fname, args.aggregating_batch_size,
+                                       shard_id, args.nb_worker, result_queue))
+        worker.start()
+        workers[shard_id] = worker
+    try:
+        all_online_stats = get_standarize_stats_results(workers, result_queue)
+    finally:
+        for worker in workers.values():
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+
+    online_stats = all_online_stats[0]
+    for shard_id in range(1, args.nb_worker):
+        for online_stat, other_online_stat in zip(online_stats, all_online_stats[shard_id]):
+            online_stat.merge(other_online_stat)
+
+    predictor, solver = load_predictor_and_solver(args.predictor_fname, args.solver_fname)
+    standarize_layers = get_standarize_layers(predictor)
+    stats_fname = solver.get_standarize_stats_fname(predictor, standarize_layers)
+    solver.save_standarize_stats(stats_fname, standarize_layers, online_stats)
+    print("Saved standarize statistics to %s in %.2f s" % (stats_fname, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,29 @@
+from __future__ import division, print_function
+
 import argparse
+import time
 
+import numpy as np
 import yaml
 
+from visual_dynamics.policies.servoing_policy import ServoingPolicy, TheanoServoingPolicy
 from visual_dynamics.utils.config import Python2to3Loader, from_config
-from visual_dynamics.utils.time_util import tic, toc
+
+
+def time_steps(act, obs, num_steps):
+    act(obs)  # compiles or loads the functions
+    latencies = []
+    for _ in range(num_steps):
+        start_time = time.time()
+        action = act(obs)
+        latencies.append(time.time() - start_time)
+    return action, np.array(latencies)
 
 
 def main():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='time the per-step latency of the servoing policy of an algorithm')
     parser.add_argument('algorithm_fname', type=str)
+    parser.add_argument('--num_steps', '-t', type=int, default=1000)
     args = parser.parse_args()
 
     with open(args.algorithm_fname) as algorithm_file:
@@ -19,13 +34,20 @@ def main():
     servoing_pol = alg.servoing_pol
 
     obs = env.reset()
-    servoing_pol.pi2([obs])
 
-    T = 1000
-    tic()
-    for _ in range(T):
-        pi = servoing_pol.pi2([obs])
-    print(toc() / T)
+    acts = [('act (unfused)', lambda obs: ServoingPolicy.act(servoing_pol, obs))]
+    if isinstance(servoing_pol, TheanoServoingPolicy):
+        acts.extend([('act', servoing_pol.act),
+                     ('pi2', lambda obs: servoing_pol.action_space.clip(
+                         servoing_pol.action_transformer.deprocess(servoing_pol.pi2([obs]))))])
+    unfused_action = None
+    for name, act in acts:
+        action, latencies = time_steps(act, obs, args.num_steps)
+        if unfused_action is None:
+            unfused_action = action
+        print("%s: mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max action difference %.2e" %
+              (name, latencies.mean() * 1000, np.percentile(latencies, 50) * 1000,
+               np.percentile(latencies, 99) * 1000, np.abs(action - unfused_action).max()))
 
 
 if __name__ == '__main__':
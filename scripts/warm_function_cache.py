@@ -0,0 +1,66 @@
+from __future__ import division, print_function
+
+import argparse
+import time
+
+from visual_dynamics.policies.servoing_policy import TheanoServoingPolicy
+from visual_dynamics.utils import iter_util
+from visual_dynamics.utils.config import from_yaml
+from visual_dynamics.utils.function_cache_theano import get_function_cache_dir, set_function_cache_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compile the Theano functions of a predictor and of its servoing '
+                                                 'policy and store them in the function cache, so that later '
+                                                 'processes load them instead of compiling them')
+    parser.add_argument('predictor_fname', type=str, help='config file of the predictor (e.g. a model snapshot)')
+    parser.add_argument('--function_cache_dir', type=str, default=None,
+                        help='directory of the cached functions (defaults to the directory given by the '
+                             'VISUAL_DYNAMICS_FUNCTION_CACHE_DIR environment variable, which the processes that '
+                             'load the functions need to set as well)')
+    parser.add_argument('--functions', type=str, nargs='+',
+                        choices=['feature', 'feature_jacobian', 'phi', 'pi', 'A_b_c_split'],
+                        default=['feature', 'feature_jacobian', 'phi', 'pi', 'A_b_c_split'])
+    parser.add_argument('--jacobian_mode', type=str, default=None,
+                        help='mode of the jacobian of the next feature with respect to the control (used if the '
+                             'predictor has no feature jacobian layer)')
+    args = parser.parse_args()
+
+    if args.function_cache_dir is not None:
+        set_function_cache_dir(args.function_cache_dir)
+    if not get_function_cache_dir():
+        raise ValueError('the function cache is disabled; specify --function_cache_dir or set the '
+                         'VISUAL_DYNAMICS_FUNCTION_CACHE_DIR environment variable')
+
+    start_time = time.time()
+    with open(args.predictor_fname) as predictor_file:
+        predictor = from_yaml(predictor_file)
+
+    # the functions are compiled with the same arguments that the predictor and the policies use
+    if 'feature' in args.functions:
+        names = tuple(iter_util.flatten_tree(predictor.feature_name))
+        predictor.pred_fns[names] = predictor._compile_pred_fn(names)
+    if 'feature_jacobian' in args.functions:
+        if predictor.feature_jacobian_name:
+            names = tuple(iter_util.flatten_tree([predictor.feature_jacobian_name, predictor.next_feature_name]))
+            predictor.pred_fns[names] = predictor._compile_pred_fn(names)
+        else:
+            jac_fn_args = (tuple(iter_util.flatten_tree(predictor.next_feature_name)), predictor.control_name,
+                           True, args.jacobian_mode)
+            predictor.jac_fns[jac_fn_args] = predictor._compile_jacobian_fn(*jac_fn_args)
+
+    policy_functions = [function for function in args.functions if function in ('phi', 'pi', 'A_b_c_split')]
+    if policy_functions:
+        if predictor.feature_jacobian_name:
+            servoing_pol = TheanoServoingPolicy(predictor)
+            for function in policy_functions:
+                fn_name = '%s_fn' % function
+                setattr(servoing_pol, fn_name, getattr(servoing_pol, '_compile_%s' % fn_name)())
+        else:
+            print("Skipping the functions %r of the servoing policy since the predictor has no feature jacobian "
+                  "layer" % policy_functions)
+    print("Stored the functions in %s in %.2f s" % (get_function_cache_dir(), time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
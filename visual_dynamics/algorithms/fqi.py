@@ -1,7 +1,5 @@
 from __future__ import division, print_function
 
-import time
-
 import lasagne
 import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
@@ -12,6 +10,7 @@ from matplotlib.ticker import MultipleLocator, FormatStrFormatter
 
 from visual_dynamics.algorithms import ServoingOptimizationAlgorithm
 from visual_dynamics.gui.loss_plotter import LossPlotter
+from visual_dynamics.utils.function_cache_theano import compile_function
 from visual_dynamics.utils.generator import iterate_minibatches_generic
 from visual_dynamics.utils.rl_util import do_rollouts, split_observations
 from visual_dynamics.utils.time_util import tic, toc
@@ -129,10 +128,10 @@ class ServoingFittedQIterationAlgorithm(ServoingOptimizationAlgorithm):
                         np.tensordot(A_split, self.servoing_pol.w / self.servoing_pol.repeats, axes=(0, 0)) + np.diag(self.servoing_pol.lambda_),
                         np.tensordot(b_split, self.servoing_pol.w / self.servoing_pol.repeats, axes=(0, 0))
                     )
-                    A_p = np.array([self.servoing_pol.action_transformer.deprocess(a_p) for a_p in A_p])
+                    A_p = self.servoing_pol.action_transformer.deprocess_batch(A_p)
                     for a_p in A_p:
                         self.servoing_pol.action_space.clip(a_p, out=a_p)
-                    A_p = np.array([self.servoing_pol.action_transformer.preprocess(a_p) for a_p in A_p])
+                    A_p = self.servoing_pol.action_transformer.preprocess_batch(A_p)
                     phi_p_errors = np.einsum('injk,nk,nj->ni', A_split, A_p, A_p) - 2 * np.einsum('inj,nj->ni', b_split, A_p) + c_split.T
                     phi_p_actions = A_p ** 2
                     phi_p = np.concatenate([phi_p_errors / self.servoing_pol.repeats, phi_p_actions], axis=1)
@@ -503,6 +502,8 @@ class ServoingSgdFittedQIterationAlgorithm(ServoingFittedQIterationAlgorithm):
 
         self.theta = self.sqrt_theta_var.get_value() ** 2
         self.bias = self.bias_var.get_value()
+        # the trainable parameters of the predictor have been updated
+        self.servoing_pol.clear_target_features()
         return train_loss
 
     def _compile_sgd_train_fn(self):
@@ -550,12 +551,9 @@ class ServoingSgdFittedQIterationAlgorithm(ServoingFittedQIterationAlgorithm):
             input_vars += [Q_sample_var]
         input_vars += [U_lin_var, alpha_var, learning_rate_var]
 
-        start_time = time.time()
-        print("Compiling SGD training function...")
-        sgd_train_fn = theano.function(input_vars, loss_var,
-                                       updates=updates,
-                                       on_unused_input='warn', allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        sgd_train_fn = compile_function('SGD training', input_vars, loss_var,
+                                        updates=updates,
+                                        on_unused_input='warn', allow_input_downcast=True)
         return sgd_train_fn
 
     def _get_config(self):
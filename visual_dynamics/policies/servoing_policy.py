@@ -1,23 +1,36 @@
 from __future__ import division, print_function
 
-import time
+import hashlib
+from collections import OrderedDict
 
 import lasagne.layers as L
 import numpy as np
 import theano
+import theano.ifelse
 import theano.tensor as T
 import yaml
 
 from visual_dynamics.policies import Policy
 from visual_dynamics.spaces import AxisAngleSpace
+from visual_dynamics.spaces import BoxSpace
+from visual_dynamics.spaces import ConcatenationSpace
 from visual_dynamics.spaces import TranslationAxisAngleSpace
 from visual_dynamics.utils import iter_util
 from visual_dynamics.utils.config import Python2to3Loader
 from visual_dynamics.utils.config import from_config, from_yaml
+from visual_dynamics.utils.function_cache_theano import compile_function
+from visual_dynamics.utils.transformer import Transformer, OpsTransformer, CompositionTransformer
 
 
 class ServoingPolicy(Policy):
-    def __init__(self, predictor, alpha=1.0, lambda_=0.0, w=1.0, use_constrained_opt=False, unweighted_features=False, algorithm_or_fname=None):
+    def __init__(self, predictor, alpha=1.0, lambda_=0.0, w=1.0, use_constrained_opt=False, unweighted_features=False, algorithm_or_fname=None,
+                 target_feature_cache_size=100):
+        """
+        Args:
+            target_feature_cache_size: Maximum number of target images whose features are memoized (keyed by the
+                contents of the target images), or 0 to not memoize them. The memoized features are cleared by
+                reset().
+        """
         if isinstance(predictor, str):
             with open(predictor) as predictor_file:
                 predictor = from_yaml(predictor_file)
@@ -48,6 +61,8 @@ class ServoingPolicy(Policy):
         self.unweighted_features = unweighted_features
         self.image_name = 'image'
         self.target_image_name = 'target_image'
+        self.target_feature_cache_size = target_feature_cache_size
+        self._target_features = OrderedDict()
 
         if algorithm_or_fname is not None:
             from visual_dynamics.algorithms import ServoingFittedQIterationAlgorithm
@@ -112,6 +127,50 @@ class ServoingPolicy(Policy):
         assert all(self._theta == np.append(self._w, self._lambda_))
         self._lambda_[...] = lambda_
 
+    def _get_image_key(self, image, preprocessed):
+        image = np.ascontiguousarray(image)
+        sha1 = hashlib.sha1(('%r,%s,%r' % (image.shape, image.dtype, preprocessed)).encode('utf-8'))
+        sha1.update(image.view(np.uint8).data)
+        return sha1.hexdigest()
+
+    def get_target_features(self, target_images, preprocessed=False):
+        """
+        Returns the flattened and concatenated features of the batch of
+        target images. The features are only computed for the target images
+        that are not memoized, and only once for identical target images.
+        """
+        if not self.target_feature_cache_size:
+            target_features = self.predictor.feature([np.asarray(target_images)], preprocessed=preprocessed)
+            return np.concatenate([f.reshape((f.shape[0], -1)) for f in target_features], axis=1)
+        keys = [self._get_image_key(target_image, preprocessed) for target_image in target_images]
+        y_targets = dict()
+        for key in keys:
+            y_target = self._target_features.pop(key, None)
+            if y_target is not None:
+                self._target_features[key] = y_target  # most recently used
+                y_targets[key] = y_target
+        missing_inds = OrderedDict()
+        for i, key in enumerate(keys):
+            if key not in y_targets:
+                missing_inds.setdefault(key, i)
+        if missing_inds:
+            missing_target_images = np.array([target_images[i] for i in missing_inds.values()])
+            target_features = self.predictor.feature([missing_target_images], preprocessed=preprocessed)
+            missing_y_targets = np.concatenate([f.reshape((f.shape[0], -1)) for f in target_features], axis=1)
+            for key, y_target in zip(missing_inds.keys(), missing_y_targets):
+                y_targets[key] = y_target
+                self._target_features[key] = y_target
+            while len(self._target_features) > self.target_feature_cache_size:
+                self._target_features.popitem(last=False)
+        return np.array([y_targets[key] for key in keys])
+
+    def clear_target_features(self):
+        """
+        Clears the memoized target features, which should be done whenever
+        the parameters of the predictor change.
+        """
+        self._target_features.clear()
+
     def phi(self, states, actions, preprocessed=False, with_constant=True):
         """
         Corresponds to the linearized objective
@@ -132,11 +191,10 @@ class ServoingPolicy(Policy):
             batch_image, = self.predictor.preprocess([obs[0] for (obs, target_obs) in states], batch_size=len(states))
             batch_target_image, = self.predictor.preprocess([target_obs[0] for (obs, target_obs) in states],
                                                             batch_size=len(states))
-            batch_u = np.array([self.action_transformer.preprocess(action) for action in actions])
-        batch_target_feature = self.predictor.feature(batch_target_image, preprocessed=True)
-        batch_y_target = np.concatenate([f.reshape((f.shape[0], -1)) for f in batch_target_feature], axis=1)
+            batch_u = self.action_transformer.preprocess_batch(np.asarray(actions))
+        batch_y_target = self.get_target_features(batch_target_image, preprocessed=True)
         if self.alpha != 1.0:
-            batch_feature = self.predictor.feature(batch_image, preprocessed=True)
+            batch_feature = self.predictor.feature([batch_image], preprocessed=True)
             batch_y = np.concatenate([f.reshape((f.shape[0], -1)) for f in batch_feature], axis=1)
             batch_y_target = self.alpha * batch_y_target + (1 - self.alpha) * batch_y
         action_lin = np.zeros(self.action_space.shape)
@@ -180,10 +238,9 @@ class ServoingPolicy(Policy):
         else:
             batch_image, = self.predictor.preprocess([obs[0] for (obs, target_obs) in states], batch_size=len(states))
             batch_target_image, = self.predictor.preprocess([target_obs[0] for (obs, target_obs) in states], batch_size=len(states))
-        batch_target_feature = self.predictor.feature(batch_target_image, preprocessed=True)
-        batch_y_target = np.concatenate([f.reshape((f.shape[0], -1)) for f in batch_target_feature], axis=1)
+        batch_y_target = self.get_target_features(batch_target_image, preprocessed=True)
         if self.alpha != 1.0:
-            batch_feature = self.predictor.feature(batch_image, preprocessed=True)
+            batch_feature = self.predictor.feature([batch_image], preprocessed=True)
             batch_y = np.concatenate([f.reshape((f.shape[0], -1)) for f in batch_feature], axis=1)
             batch_y_target = self.alpha * batch_y_target + (1 - self.alpha) * batch_y
         action_lin = np.zeros(self.action_space.shape)
@@ -202,7 +259,7 @@ class ServoingPolicy(Policy):
         batch_b = np.tensordot(batch_b_split, self.w / self.repeats, axes=(0, 0))
         batch_u = np.linalg.solve(batch_A, batch_b)
 
-        actions = np.array([self.action_transformer.deprocess(u) for u in batch_u])
+        actions = self.action_transformer.deprocess_batch(batch_u)
         for action in actions:
             self.action_space.clip(action, out=action)
         return actions
@@ -293,10 +350,18 @@ class ServoingPolicy(Policy):
         image = obs[self.image_name]
         target_image = obs[self.target_image_name]
 
-        features = self.predictor.feature([np.array([image, target_image])])
-        y, y_target = np.concatenate([f.reshape((f.shape[0], -1)) for f in features], axis=1)
-        if self.alpha != 1.0:
+        if self.alpha != 1.0 and not self.target_feature_cache_size:
+            # the features of the image and the target image are computed in a single batched pass
+            features = self.predictor.feature([np.array([image, target_image])])
+            y, y_target = np.concatenate([f.reshape((f.shape[0], -1)) for f in features], axis=1)
             y_target = self.alpha * y_target + (1 - self.alpha) * y
+        else:
+            y_target, = self.get_target_features(np.array([target_image]))
+            if self.alpha != 1.0:
+                # the feature of the image is only needed to blend it with the target feature
+                feature = self.predictor.feature([np.array([image])])
+                y, = np.concatenate([f.reshape((f.shape[0], -1)) for f in feature], axis=1)
+                y_target = self.alpha * y_target + (1 - self.alpha) * y
 
         if action_lin is None:
             action_lin = np.zeros(self.predictor.input_shapes[1])  # original units
@@ -370,6 +435,7 @@ class ServoingPolicy(Policy):
         return action
 
     def reset(self):
+        self.clear_target_features()
         return None
 
     def _get_config(self):
@@ -379,10 +445,74 @@ class ServoingPolicy(Policy):
                        'lambda_': self.lambda_.tolist(),
                        'w': self.w.tolist() if self.w is not None else self.w,
                        'use_constrained_opt': self.use_constrained_opt,
-                       'unweighted_features': self.unweighted_features})
+                       'unweighted_features': self.unweighted_features,
+                       'target_feature_cache_size': self.target_feature_cache_size})
         return config
 
 
+def get_deprocess_var_fn(transformer, shape):
+    """
+    Returns a function that applies transformer.deprocess to a symbolic
+    datum of the given (deprocessed) shape, or None if the transformer has
+    no symbolic counterpart.
+    """
+    if type(transformer).deprocess == Transformer.deprocess:  # identity
+        return lambda var: var
+    elif type(transformer).deprocess == OpsTransformer.deprocess:
+        if transformer.transpose or transformer._data_dtype == np.uint8:
+            return None
+        exponent = transformer.exponent
+        scale, offset = transformer._get_scale_offset(shape)
+
+        def deprocess_var(var):
+            if exponent != 1.0:
+                var = var ** (1.0 / exponent)
+            return (var - offset) * (1.0 / scale)
+        return deprocess_var
+    elif type(transformer).deprocess == CompositionTransformer.deprocess:
+        deprocess_var_fns = []
+        for sub_transformer in reversed(transformer.transformers):
+            deprocess_var_fn = get_deprocess_var_fn(sub_transformer, shape)
+            if deprocess_var_fn is None:
+                return None
+            deprocess_var_fns.append(deprocess_var_fn)
+            shape = sub_transformer.deprocess_shape(shape)
+
+        def deprocess_var(var):
+            for deprocess_var_fn in deprocess_var_fns:
+                var = deprocess_var_fn(var)
+            return var
+        return deprocess_var
+    else:
+        return None
+
+
+def get_clip_var_fn(space):
+    """
+    Returns a function that applies space.clip to a symbolic vector, or None
+    if the space has no symbolic counterpart.
+    """
+    if isinstance(space, AxisAngleSpace):
+        if space.axis is not None:
+            return lambda var: T.clip(var, space.low, space.high)
+
+        def clip_var(var):
+            # same as transformations.split_axis_angle for the default reference axis
+            angle_var = T.sqrt(T.sum(var ** 2))
+            axis_var = T.switch(T.gt(angle_var, 0), var / angle_var, T.constant(np.array([0, 0, 1], dtype=theano.config.floatX)))
+            return T.clip(angle_var, space.low, space.high) * axis_var
+        return clip_var
+    elif isinstance(space, BoxSpace):
+        return lambda var: T.clip(var, space.low, space.high)
+    elif isinstance(space, ConcatenationSpace):
+        clip_var_fns = [get_clip_var_fn(sub_space) for sub_space in space.spaces]
+        if any(clip_var_fn is None for clip_var_fn in clip_var_fns):
+            return None
+        return lambda var: T.concatenate([clip_var_fn(var[s]) for clip_var_fn, s in zip(clip_var_fns, space.slices)])
+    else:
+        return None
+
+
 class TheanoServoingPolicy(ServoingPolicy):
     def __init__(self, *args, **kwargs):
         super(TheanoServoingPolicy, self).__init__(*args, **kwargs)
@@ -394,11 +524,18 @@ class TheanoServoingPolicy(ServoingPolicy):
         self.A_b_c_split_fn = None
         self.phi_fn = None
         self.pi_fn = None
+        # same functions as above except that they take the target features instead of the target images
+        self.A_b_c_split_y_target_fn = None
+        self.phi_y_target_fn = None
+        self.pi_y_target_fn = None
+        self.act_fn = None
+        self.act_y_target_fn = None
         X_var, U_var = self.predictor.input_vars
         X_target_var = T.tensor4('x_target')
         U_lin_var = T.matrix('u_lin')
         alpha_var = theano.tensor.scalar(name='alpha')
         self.input_vars = [X_var, U_var, X_target_var, U_lin_var, alpha_var]
+        self.y_target_var = T.matrix('y_target')
         w_var = T.vector('w')
         lambda_var = T.vector('lambda')
         self.param_vars = [w_var, lambda_var]
@@ -507,7 +644,12 @@ class TheanoServoingPolicy(ServoingPolicy):
         pi_var = T.dot(T.nlinalg.matrix_inverse(A_var), b_var)  # preprocessed units
         return pi_var
 
-    def _get_A_b_c_split_vars(self):
+    def _get_A_b_c_split_vars(self, target_feature_input=False):
+        """
+        If target_feature_input is True, the target features are given by
+        y_target_var (the flattened and concatenated features, as returned
+        by get_target_features) instead of being computed from X_target_var.
+        """
         if not self.predictor.feature_jacobian_name:
             raise NotImplementedError
 
@@ -517,8 +659,14 @@ class TheanoServoingPolicy(ServoingPolicy):
         vars_ = L.get_output([self.predictor.pred_layers[name] for name in iter_util.flatten_tree(names)], deterministic=True)
         feature_vars, jac_vars, next_feature_vars = iter_util.unflatten_tree(names, vars_)
 
+        feature_shapes = L.get_output_shape([self.predictor.pred_layers[name] for name in iter_util.flatten_tree(self.predictor.feature_name)])
+
         y_vars = [T.flatten(feature_var, outdim=2) for feature_var in feature_vars]
-        y_target_vars = [theano.clone(y_var, replace={X_var: X_target_var}) for y_var in y_vars]
+        if target_feature_input:
+            y_inds = np.r_[0, np.cumsum([np.prod(feature_shape[1:]) for feature_shape in feature_shapes])]
+            y_target_vars = [self.y_target_var[:, start_ind:end_ind] for (start_ind, end_ind) in zip(y_inds[:-1], y_inds[1:])]
+        else:
+            y_target_vars = [theano.clone(y_var, replace={X_var: X_target_var}) for y_var in y_vars]
         y_target_vars = [theano.ifelse.ifelse(T.eq(alpha_var, 1.0),
                                               y_target_var,
                                               alpha_var * y_target_var + (1 - alpha_var) * y_var)
@@ -531,8 +679,6 @@ class TheanoServoingPolicy(ServoingPolicy):
         z_vars = [y_target_var - y_next_pred_var + T.batched_tensordot(jac_var, U_lin_var, axes=(2, 1))
                   for (y_target_var, y_next_pred_var, jac_var) in zip(y_target_vars, y_next_pred_vars, jac_vars)]
 
-        feature_shapes = L.get_output_shape([self.predictor.pred_layers[name] for name in iter_util.flatten_tree(self.predictor.feature_name)])
-
         A_split_vars = []
         b_split_vars = []
         c_split_vars = []
@@ -628,9 +774,9 @@ class TheanoServoingPolicy(ServoingPolicy):
     def _get_A_b_split_vars(self):
         pass
 
-    def _get_phi_var(self):
+    def _get_phi_var(self, target_feature_input=False):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
-        A_split_var, b_split_var, c_split_var = self._get_A_b_c_split_vars()
+        A_split_var, b_split_var, c_split_var = self._get_A_b_c_split_vars(target_feature_input=target_feature_input)
 
         phi_errors_var = (T.batched_tensordot(T.batched_tensordot(A_split_var.dimshuffle((1, 0, 2, 3)), U_var, axes=(3, 1)), U_var, axes=(2, 1))
                           - 2 * T.batched_tensordot(b_split_var.dimshuffle((1, 0, 2)), U_var, axes=(2, 1))
@@ -639,13 +785,11 @@ class TheanoServoingPolicy(ServoingPolicy):
         phi_var = T.concatenate([phi_errors_var / self.repeats, phi_actions_var], axis=1)
         return phi_var
 
-    def _compile_phi_fn(self):
+    def _compile_phi_fn(self, target_feature_input=False):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
-        phi_var = self._get_phi_var()
-        start_time = time.time()
-        print("Compiling phi function...")
-        phi_fn = theano.function([X_var, U_var, X_target_var, U_lin_var, alpha_var], phi_var, on_unused_input='warn', allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        phi_var = self._get_phi_var(target_feature_input=target_feature_input)
+        target_var = self.y_target_var if target_feature_input else X_target_var
+        phi_fn = compile_function('phi', [X_var, U_var, target_var, U_lin_var, alpha_var], phi_var, on_unused_input='warn', allow_input_downcast=True)
         return phi_fn
 
     def _get_phi2_var(self):
@@ -662,41 +806,94 @@ class TheanoServoingPolicy(ServoingPolicy):
     def _compile_phi2_fn(self):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
         phi_var = self._get_phi2_var()
-        start_time = time.time()
-        print("Compiling phi2 function...")
-        phi2_fn = theano.function([X_var, U_var, X_target_var, U_lin_var, alpha_var], phi_var, on_unused_input='warn', allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        phi2_fn = compile_function('phi2', [X_var, U_var, X_target_var, U_lin_var, alpha_var], phi_var, on_unused_input='warn', allow_input_downcast=True)
         return phi2_fn
 
-    def _get_pi_var(self):
+    def _get_pi_var(self, target_feature_input=False):
         w_var, lambda_var = self.param_vars
-        A_split_var, b_split_var, _ = self._get_A_b_c_split_vars()
+        A_split_var, b_split_var, _ = self._get_A_b_c_split_vars(target_feature_input=target_feature_input)
 
         A_var = T.tensordot(A_split_var, w_var / self.repeats, axes=(0, 0)) + T.diag(lambda_var)
         B_var = T.tensordot(b_split_var, w_var / self.repeats, axes=(0, 0))
-        pi_var = T.batched_tensordot(T.nlinalg.matrix_inverse(A_var), B_var, axes=(2, 1))  # preprocessed units
+        # matrix_inverse only takes a single matrix, so it is scanned over the batch
+        pi_var, _ = theano.scan(fn=lambda A_var, B_var: T.dot(T.nlinalg.matrix_inverse(A_var), B_var),
+                                sequences=[A_var, B_var])  # preprocessed units
         return pi_var
 
-    def _compile_pi_fn(self):
+    def _compile_pi_fn(self, target_feature_input=False):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
         w_var, lambda_var = self.param_vars
-        pi_var = self._get_pi_var()
-        start_time = time.time()
-        print("Compiling pi function...")
-        pi_fn = theano.function([X_var, X_target_var, U_lin_var, alpha_var, w_var, lambda_var], pi_var, on_unused_input='warn', allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        pi_var = self._get_pi_var(target_feature_input=target_feature_input)
+        target_var = self.y_target_var if target_feature_input else X_target_var
+        pi_fn = compile_function('pi', [X_var, target_var, U_lin_var, alpha_var, w_var, lambda_var], pi_var, on_unused_input='warn', allow_input_downcast=True)
         return pi_fn
 
+    def _get_act_vars(self, target_feature_input=False):
+        """
+        Returns the variables of the action of the first (and only)
+        observation of the batch in preprocessed units and in original units
+        clipped to the action space. The latter is None if the action
+        transformer or the action space has no symbolic counterpart.
+        """
+        u_var = self._get_pi_var(target_feature_input=target_feature_input)[0]  # preprocessed units
+        deprocess_var_fn = get_deprocess_var_fn(self.action_transformer, self.action_space.shape)
+        clip_var_fn = get_clip_var_fn(self.action_space)
+        if deprocess_var_fn is None or clip_var_fn is None:
+            return u_var, None
+        return u_var, clip_var_fn(deprocess_var_fn(u_var))
+
+    def _compile_act_fn(self, target_feature_input=False):
+        X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
+        w_var, lambda_var = self.param_vars
+        act_vars = [act_var for act_var in self._get_act_vars(target_feature_input=target_feature_input)
+                    if act_var is not None]
+        target_var = self.y_target_var if target_feature_input else X_target_var
+        act_fn = compile_function('act', [X_var, target_var, U_lin_var, alpha_var, w_var, lambda_var], act_vars, on_unused_input='warn', allow_input_downcast=True)
+        return act_fn
+
+    def act(self, obs, action_lin=None):
+        """
+        Same as ServoingPolicy.act except that the action is computed by a
+        single compiled function, where the image goes through the encoder
+        once for both the feature and the jacobian. The constrained
+        optimization, linearizations about a nonzero action, full weight
+        matrices and singular linear systems use ServoingPolicy.act instead.
+        """
+        if self.use_constrained_opt or action_lin is not None or not self.predictor.feature_jacobian_name or \
+                self.w.shape != (len(self.repeats),):
+            return super(TheanoServoingPolicy, self).act(obs, action_lin=action_lin)
+        batch_image, batch_target = self._get_batch_image_and_target([obs])
+        u_lin = self.action_transformer.preprocess(np.zeros(self.action_space.shape))
+        if self.target_feature_cache_size:
+            if self.act_y_target_fn is None:
+                self.act_y_target_fn = self._compile_act_fn(target_feature_input=True)
+            act_fn = self.act_y_target_fn
+        else:
+            if self.act_fn is None:
+                self.act_fn = self._compile_act_fn()
+            act_fn = self.act_fn
+        try:
+            outputs = act_fn(batch_image, batch_target, u_lin[None, :], self.alpha, self.w, self.lambda_)
+        except np.linalg.LinAlgError:
+            outputs = None
+        # the clipped action is finite even if the solution of a (nearly) singular system is not
+        if outputs is None or not np.all(np.isfinite(outputs[0])):
+            return super(TheanoServoingPolicy, self).act(obs, action_lin=action_lin)
+        if len(outputs) == 2:
+            u, action = outputs
+        else:
+            u, = outputs
+            action = self.action_transformer.deprocess(u)
+            self.action_space.clip(action, out=action)
+        return action
+
     def _compile_jac_fn(self):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
         jac_vars = self._get_jac_vars()
-        start_time = time.time()
-        print("Compiling jac function...")
-        jac_fn = theano.function([X_var, U_lin_var],  # U_lin_var should be unused
-                                  jac_vars,
-                                  on_unused_input='warn',
-                                  allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        jac_fn = compile_function('jac', [X_var, U_lin_var],  # U_lin_var should be unused
+                                   jac_vars,
+                                   on_unused_input='warn',
+                                   allow_input_downcast=True)
         return jac_fn
 
     def jac(self, observations, preprocessed=False):
@@ -719,13 +916,10 @@ class TheanoServoingPolicy(ServoingPolicy):
     def _compile_jac_z_fn(self):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
         jac_vars, z_vars = self._get_jac_z_vars()
-        start_time = time.time()
-        print("Compiling jac_z function...")
-        jac_z_fn = theano.function([X_var, X_target_var, U_lin_var, alpha_var],
-                                   jac_vars + z_vars,
-                                   on_unused_input='warn',
-                                   allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        jac_z_fn = compile_function('jac_z', [X_var, X_target_var, U_lin_var, alpha_var],
+                                    jac_vars + z_vars,
+                                    on_unused_input='warn',
+                                    allow_input_downcast=True)
         return jac_z_fn
 
     def jac_z(self, observations, preprocessed=False):
@@ -752,25 +946,19 @@ class TheanoServoingPolicy(ServoingPolicy):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
         w_var, lambda_var = self.param_vars
         pi_var = self._get_pi2_var()
-        start_time = time.time()
-        print("Compiling pi2 function...")
-        pi2_fn = theano.function([X_var, X_target_var, U_lin_var, alpha_var, w_var, lambda_var],
-                                 pi_var,
-                                 on_unused_input='warn',
-                                 allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        pi2_fn = compile_function('pi2', [X_var, X_target_var, U_lin_var, alpha_var, w_var, lambda_var],
+                                  pi_var,
+                                  on_unused_input='warn',
+                                  allow_input_downcast=True)
         return pi2_fn
 
     def _compile_A_b_c_split2_fn(self):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
         A_split_var, b_split_var, c_split_var = self._get_A_b_c_split2_vars()
-        start_time = time.time()
-        print("Compiling A_b_c2 function...")
-        A_b_c_split2_fn = theano.function([X_var, X_target_var, U_lin_var, alpha_var],
-                                         [A_split_var, b_split_var, c_split_var],
-                                         on_unused_input='warn',
-                                         allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        A_b_c_split2_fn = compile_function('A_b_c2', [X_var, X_target_var, U_lin_var, alpha_var],
+                                           [A_split_var, b_split_var, c_split_var],
+                                           on_unused_input='warn',
+                                           allow_input_downcast=True)
         return A_b_c_split2_fn
 
     def A_b_c_split2(self, observations, preprocessed=False):
@@ -834,7 +1022,7 @@ class TheanoServoingPolicy(ServoingPolicy):
             else:
                 batch_image, = self.predictor.preprocess([[obs['image'] for obs in observations]], batch_size)
                 batch_target_image, = self.predictor.preprocess([[obs['target_image'] for obs in observations]], batch_size)
-                batch_u = np.array([self.action_transformer.preprocess(action) for action in actions])
+                batch_u = self.action_transformer.preprocess_batch(np.asarray(actions))
             action_lin = np.zeros(self.action_space.shape)
             u_lin = self.action_transformer.preprocess(action_lin)
             batch_u_lin = np.array([u_lin] * batch_size)
@@ -873,18 +1061,36 @@ class TheanoServoingPolicy(ServoingPolicy):
         pi = self.pi2_fn(batch_image, batch_target_image, batch_u_lin, self.alpha, self.w, self.lambda_)
         return pi
 
-    def _compile_A_b_c_split_fn(self):
+    def _compile_A_b_c_split_fn(self, target_feature_input=False):
         X_var, U_var, X_target_var, U_lin_var, alpha_var = self.input_vars
-        A_split_var, b_split_var, c_split_var = self._get_A_b_c_split_vars()
-        start_time = time.time()
-        print("Compiling A_b_c function...")
-        A_b_c_split_fn = theano.function([X_var, X_target_var, U_lin_var, alpha_var],
-                                         [A_split_var, b_split_var, c_split_var],
-                                         on_unused_input='warn',
-                                         allow_input_downcast=True)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        A_split_var, b_split_var, c_split_var = self._get_A_b_c_split_vars(target_feature_input=target_feature_input)
+        target_var = self.y_target_var if target_feature_input else X_target_var
+        A_b_c_split_fn = compile_function('A_b_c', [X_var, target_var, U_lin_var, alpha_var],
+                                          [A_split_var, b_split_var, c_split_var],
+                                          on_unused_input='warn',
+                                          allow_input_downcast=True)
         return A_b_c_split_fn
 
+    def _get_batch_image_and_target(self, observations, preprocessed=False):
+        """
+        Returns the batch of preprocessed images and either the batch of
+        target features (if they are memoized) or the batch of preprocessed
+        target images, which are the inputs of the respective functions.
+        """
+        batch_size = len(observations)
+        if preprocessed:
+            batch_image = np.array([obs['image'] for obs in observations])
+        else:
+            batch_image, = self.predictor.preprocess([[obs['image'] for obs in observations]], batch_size)
+        target_images = [obs['target_image'] for obs in observations]
+        if self.target_feature_cache_size:
+            batch_target = self.get_target_features(target_images, preprocessed=preprocessed)
+        elif preprocessed:
+            batch_target = np.array(target_images)
+        else:
+            batch_target, = self.predictor.preprocess([target_images], batch_size)
+        return batch_image, batch_target
+
     def A_b_c_split(self, observations, preprocessed=False):
         """
         Corresponds to the linearized objective
@@ -898,19 +1104,20 @@ class TheanoServoingPolicy(ServoingPolicy):
             raise NotImplementedError
         batch_size = len(observations)
         if batch_size <= self.max_batch_size:
-            if preprocessed:
-                batch_image = np.array([obs['image'] for obs in observations])
-                batch_target_image = np.array([obs['target_image'] for obs in observations])
-            else:
-                batch_image, = self.predictor.preprocess([[obs['image'] for obs in observations]], batch_size)
-                batch_target_image, = self.predictor.preprocess([[obs['target_image'] for obs in observations]], batch_size)
+            batch_image, batch_target = self._get_batch_image_and_target(observations, preprocessed=preprocessed)
             action_lin = np.zeros(self.action_space.shape)
             u_lin = self.action_transformer.preprocess(action_lin)
             batch_u_lin = np.array([u_lin] * batch_size)
 
-            if self.A_b_c_split_fn is None:
-                self.A_b_c_split_fn = self._compile_A_b_c_split_fn()
-            A_split, b_split, c_split = self.A_b_c_split_fn(batch_image, batch_target_image, batch_u_lin, self.alpha)
+            if self.target_feature_cache_size:
+                if self.A_b_c_split_y_target_fn is None:
+                    self.A_b_c_split_y_target_fn = self._compile_A_b_c_split_fn(target_feature_input=True)
+                A_b_c_split_fn = self.A_b_c_split_y_target_fn
+            else:
+                if self.A_b_c_split_fn is None:
+                    self.A_b_c_split_fn = self._compile_A_b_c_split_fn()
+                A_b_c_split_fn = self.A_b_c_split_fn
+            A_split, b_split, c_split = A_b_c_split_fn(batch_image, batch_target, batch_u_lin, self.alpha)
             return A_split, b_split, c_split
         else:
             A_split, b_split, c_split = None, None, None
@@ -940,21 +1147,24 @@ class TheanoServoingPolicy(ServoingPolicy):
         if use_fn:
             batch_size = len(observations)
             if batch_size <= self.max_batch_size:
+                batch_image, batch_target = self._get_batch_image_and_target(observations, preprocessed=preprocessed)
                 if preprocessed:
-                    batch_image = np.array([obs['image'] for obs in observations])
-                    batch_target_image = np.array([obs['target_image'] for obs in observations])
                     batch_u = np.array(actions)
                 else:
-                    batch_image, = self.predictor.preprocess([[obs['image'] for obs in observations]], batch_size)
-                    batch_target_image, = self.predictor.preprocess([[obs['target_image'] for obs in observations]], batch_size)
-                    batch_u = np.array([self.action_transformer.preprocess(action) for action in actions])
+                    batch_u = self.action_transformer.preprocess_batch(np.asarray(actions))
                 action_lin = np.zeros(self.action_space.shape)
                 u_lin = self.action_transformer.preprocess(action_lin)
                 batch_u_lin = np.array([u_lin] * batch_size)
 
-                if self.phi_fn is None:
-                    self.phi_fn = self._compile_phi_fn()
-                phi = self.phi_fn(batch_image, batch_u, batch_target_image, batch_u_lin, self.alpha)
+                if self.target_feature_cache_size:
+                    if self.phi_y_target_fn is None:
+                        self.phi_y_target_fn = self._compile_phi_fn(target_feature_input=True)
+                    phi_fn = self.phi_y_target_fn
+                else:
+                    if self.phi_fn is None:
+                        self.phi_fn = self._compile_phi_fn()
+                    phi_fn = self.phi_fn
+                phi = phi_fn(batch_image, batch_u, batch_target, batch_u_lin, self.alpha)
                 return phi
             else:
                 phi = None
@@ -971,7 +1181,7 @@ class TheanoServoingPolicy(ServoingPolicy):
             if preprocessed:
                 batch_u = np.array(actions)
             else:
-                batch_u = np.array([self.action_transformer.preprocess(action) for action in actions])
+                batch_u = self.action_transformer.preprocess_batch(np.asarray(actions))
             phi_errors = np.einsum('injk,nk,nj->ni', A_split, batch_u, batch_u) - 2 * np.einsum('inj,nj->ni', b_split, batch_u) + c_split.T
             phi_actions = batch_u ** 2
             phi = np.concatenate([phi_errors / self.repeats, phi_actions], axis=1)
@@ -991,25 +1201,26 @@ class TheanoServoingPolicy(ServoingPolicy):
         if use_fn:
             batch_size = len(observations)
             if batch_size <= self.max_batch_size:
-                if preprocessed:
-                    batch_image = np.array([obs['image'] for obs in observations])
-                    batch_target_image = np.array([obs['target_image'] for obs in observations])
-                else:
-                    batch_image, = self.predictor.preprocess([[obs['image'] for obs in observations]], batch_size)
-                    batch_target_image, = self.predictor.preprocess([[obs['target_image'] for obs in observations]], batch_size)
+                batch_image, batch_target = self._get_batch_image_and_target(observations, preprocessed=preprocessed)
                 action_lin = np.zeros(self.action_space.shape)
                 u_lin = self.action_transformer.preprocess(action_lin)
                 batch_u_lin = np.array([u_lin] * batch_size)
 
-                if self.pi_fn is None:
-                    self.pi_fn = self._compile_pi_fn()
-                batch_u = self.pi_fn(batch_image, batch_target_image, batch_u_lin, self.alpha, self.w, self.lambda_)
+                if self.target_feature_cache_size:
+                    if self.pi_y_target_fn is None:
+                        self.pi_y_target_fn = self._compile_pi_fn(target_feature_input=True)
+                    pi_fn = self.pi_y_target_fn
+                else:
+                    if self.pi_fn is None:
+                        self.pi_fn = self._compile_pi_fn()
+                    pi_fn = self.pi_fn
+                batch_u = pi_fn(batch_image, batch_target, batch_u_lin, self.alpha, self.w, self.lambda_)
 
-                actions = np.array([self.action_transformer.deprocess(u) for u in batch_u])
+                actions = self.action_transformer.deprocess_batch(batch_u)
                 for action in actions:
                     self.action_space.clip(action, out=action)
                 if preprocessed:
-                    return np.array([self.action_transformer.preprocess(action) for action in actions])
+                    return self.action_transformer.preprocess_batch(np.asarray(actions))
                 else:
                     return actions
             else:
@@ -1028,10 +1239,10 @@ class TheanoServoingPolicy(ServoingPolicy):
                 np.tensordot(A_split, self.w / self.repeats, axes=(0, 0)) + np.diag(self.lambda_),
                 np.tensordot(b_split, self.w / self.repeats, axes=(0, 0))
             )
-            actions = np.array([self.action_transformer.deprocess(u) for u in batch_u])
+            actions = self.action_transformer.deprocess_batch(batch_u)
             for action in actions:
                 self.action_space.clip(action, out=action)
             if preprocessed:
-                return np.array([self.action_transformer.preprocess(action) for action in actions])
+                return self.action_transformer.preprocess_batch(np.asarray(actions))
             else:
                 return actions
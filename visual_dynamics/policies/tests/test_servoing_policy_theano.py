@@ -0,0 +1,172 @@
+from __future__ import division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from nose2 import tools
+
+try:
+    import lasagne
+    import lasagne.layers as L
+    import theano
+    import theano.tensor as T
+    from visual_dynamics.policies.servoing_policy import ServoingPolicy, TheanoServoingPolicy
+    from visual_dynamics.predictors.layers_theano import BatchwiseSumLayer
+    from visual_dynamics.predictors.predictor_theano import TheanoNetFeaturePredictor
+except ImportError:
+    theano = None
+from visual_dynamics.spaces import BoxSpace, TranslationAxisAngleSpace
+from visual_dynamics.utils.transformer import Transformer, NormalizerTransformer
+
+x_shape = (3, 4, 4)
+y_channels = 2
+
+
+def build_feature_net(input_shapes):
+    x_shape, u_shape = input_shapes
+    u_dim, = u_shape
+    X_var = T.tensor4('x')
+    U_var = T.matrix('u')
+    l_x = L.InputLayer(shape=(None,) + x_shape, input_var=X_var, name='x')
+    l_u = L.InputLayer(shape=(None,) + u_shape, input_var=U_var, name='u')
+    y_shape = (y_channels,) + x_shape[1:]
+    l_y = L.ReshapeLayer(L.DenseLayer(l_x, np.prod(y_shape), nonlinearity=T.tanh), ([0],) + y_shape, name='y')
+    # the next feature is affine in u, so its jacobian is given by the linear terms, which are small so that the
+    # actions are clipped more often
+    l_y_diff_pred_lins = [L.ReshapeLayer(L.DenseLayer(l_y, np.prod(y_shape), W=lasagne.init.GlorotUniform(gain=0.1),
+                                                      b=None, nonlinearity=None,
+                                                      name='y_diff_pred_lin%d_dense' % i),
+                                         ([0],) + y_shape, name='y_diff_pred_lin%d' % i) for i in range(u_dim)]
+    l_y_diff_pred_const = L.ReshapeLayer(L.DenseLayer(l_y, np.prod(y_shape), nonlinearity=None),
+                                         ([0],) + y_shape, name='y_diff_pred_const')
+    l_y_diff_pred = BatchwiseSumLayer(l_y_diff_pred_lins + [l_y_diff_pred_const, l_u], name='y_diff_pred')
+    l_y_next_pred = L.ElemwiseSumLayer([l_y, l_y_diff_pred], name='y_next_pred')
+    l_y_next_pred_jac = L.ConcatLayer([L.DimshuffleLayer(L.FlattenLayer(l_y_diff_pred_lin, outdim=2), (0, 1, 'x'))
+                                       for l_y_diff_pred_lin in l_y_diff_pred_lins], axis=2, name='y_next_pred_jac')
+    return dict(x=l_x, u=l_u, y=l_y, y_next_pred=l_y_next_pred, y_next_pred_jac=l_y_next_pred_jac)
+
+
+class TemporaryModelDir(object):
+    """
+    Changes the working directory to a temporary directory, which is where the
+    predictors store their models.
+    """
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.model_dir = tempfile.mkdtemp()
+        os.chdir(self.model_dir)
+        return self.model_dir
+
+    def __exit__(self, *args):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.model_dir)
+
+
+def create_action_space(action_space_name):
+    if action_space_name == 'box':
+        return BoxSpace(-0.1, 0.1, shape=(3,))
+    elif action_space_name == 'translation_axis_angle':
+        return TranslationAxisAngleSpace(np.array([-0.1, -0.1, -0.1, -np.pi / 8]),
+                                         np.array([0.1, 0.1, 0.1, np.pi / 8]))
+    else:
+        raise ValueError('Unknown action space %s' % action_space_name)
+
+
+def build_feature_predictor(action_space):
+    return TheanoNetFeaturePredictor(build_feature_net, ['x', 'u'], [x_shape, action_space.shape],
+                                     ['y'], ['y_next_pred'], 'u', feature_jacobian_name=['y_next_pred_jac'],
+                                     transformers=dict(x=Transformer(), u=NormalizerTransformer(action_space)),
+                                     name='FeatureNet', environment_config=dict(action_space=action_space))
+
+
+def get_observations(num_observations, seed=0):
+    random_state = np.random.RandomState(seed)
+    return [dict(image=random_state.uniform(-1, 1, size=x_shape),
+                 target_image=random_state.uniform(-1, 1, size=x_shape)) for _ in range(num_observations)]
+
+
+@tools.params(('box', False),
+              ('box', True),
+              ('translation_axis_angle', False),
+              ('translation_axis_angle', True),
+              )
+def test_act(action_space_name, singular):
+    if theano is None:
+        raise unittest.SkipTest('theano or lasagne is not installed')
+    with TemporaryModelDir():
+        action_space = create_action_space(action_space_name)
+        predictor = build_feature_predictor(action_space)
+        if singular:
+            # the first column of the jacobian is zero, so the linear system is singular without regularization
+            W = predictor.pred_layers['y_diff_pred_lin0'].input_layer.W
+            W.set_value(np.zeros_like(W.get_value()))
+        policy = TheanoServoingPolicy(predictor, lambda_=0.0 if singular else 0.01)
+        for obs in get_observations(4):
+            action = policy.act(obs)
+            expected_action = ServoingPolicy.act(policy, obs)
+            assert action.shape == action_space.shape
+            assert np.allclose(action, expected_action, atol=1e-5)
+            assert action_space.contains((1 - 1e-6) * action)
+
+
+def test_target_feature_cache():
+    if theano is None:
+        raise unittest.SkipTest('theano or lasagne is not installed')
+    with TemporaryModelDir():
+        predictor = build_feature_predictor(create_action_space('box'))
+        policy = TheanoServoingPolicy(predictor, target_feature_cache_size=2)
+        target_images = [obs['target_image'] for obs in get_observations(3)]
+        changed_target_image = target_images[0].copy()
+        changed_target_image[0, 0, 0] += 1.0
+        target_images.append(changed_target_image)
+        expected_y_targets = [np.concatenate([f.flatten() for f in predictor.feature([target_image[None]])])
+                              for target_image in target_images]
+
+        y_target, = policy.get_target_features([target_images[0]])
+        assert np.allclose(y_target, expected_y_targets[0])
+        assert len(policy._target_features) == 1
+        # an identical target image hits the cache
+        y_target, = policy.get_target_features([target_images[0].copy()])
+        assert np.allclose(y_target, expected_y_targets[0])
+        assert len(policy._target_features) == 1
+        # a changed target image misses the cache
+        y_target, = policy.get_target_features([changed_target_image])
+        assert np.allclose(y_target, expected_y_targets[-1])
+        assert not np.allclose(y_target, expected_y_targets[0])
+        assert len(policy._target_features) == 2
+        # the cache holds at most target_feature_cache_size target features
+        for inds in [[1], [2, 1, 2], [0, 3, 0, 1]]:
+            y_targets = policy.get_target_features([target_images[i] for i in inds])
+            assert np.allclose(y_targets, [expected_y_targets[i] for i in inds])
+            assert len(policy._target_features) <= 2
+
+        policy.reset()
+        assert len(policy._target_features) == 0
+
+
+@tools.params(1.0, 0.5)
+def test_target_feature_cache_results(alpha):
+    if theano is None:
+        raise unittest.SkipTest('theano or lasagne is not installed')
+    with TemporaryModelDir():
+        action_space = create_action_space('translation_axis_angle')
+        predictor = build_feature_predictor(action_space)
+        policy = TheanoServoingPolicy(predictor, alpha=alpha, lambda_=0.01)
+        uncached_policy = TheanoServoingPolicy(predictor, alpha=alpha, lambda_=0.01, target_feature_cache_size=0)
+        observations = get_observations(4)
+        observations[2]['target_image'] = observations[0]['target_image'].copy()
+        actions = np.array([action_space.sample() for _ in observations])
+        # the second time, all the target features are memoized
+        for _ in range(2):
+            assert np.allclose(policy.pi(observations), uncached_policy.pi(observations))
+            assert np.allclose(policy.phi(observations, actions), uncached_policy.phi(observations, actions))
+            for split, uncached_split in zip(policy.A_b_c_split(observations),
+                                             uncached_policy.A_b_c_split(observations)):
+                assert np.allclose(split, uncached_split)
+            for obs in observations:
+                assert np.allclose(policy.act(obs), uncached_policy.act(obs))
+        assert len(policy._target_features) == 3
+        assert len(uncached_policy._target_features) == 0
@@ -56,9 +56,8 @@ class Predictor(ConfigObject):
             preprocessed_inputs = [self.transformers[name].preprocess(input_)
                                    for (name, input_) in zip(self.input_names, inputs)]
         else:
-            batched_inputs = inputs
-            preprocessed_inputs = zip(*[self.preprocess(inputs) for inputs in zip(*batched_inputs)])
-            preprocessed_inputs = [np.array(preprocessed_input) for preprocessed_input in preprocessed_inputs]
+            preprocessed_inputs = [self.transformers[name].preprocess_batch(np.asarray(input_))
+                                   for (name, input_) in zip(self.input_names, inputs)]
         return preprocessed_inputs
 
     def batch_size(self, inputs, preprocessed=False):
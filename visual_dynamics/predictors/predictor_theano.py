@@ -8,21 +8,23 @@ import matplotlib.pyplot as plt
 import numpy as np
 import theano
 import theano.tensor as T
+import yaml
 
 from visual_dynamics.utils import iter_util
 try:
     from visual_dynamics.utils import visualization_theano
 except ImportError:
     visualization_theano = None
-from visual_dynamics.utils.config import ConfigObject, from_yaml
+from visual_dynamics.utils.config import ConfigObject, Python2to3Loader, from_yaml
 from visual_dynamics.utils.container import MultiDataContainer
+from visual_dynamics.utils.function_cache_theano import compile_function
 from visual_dynamics.utils.transformer import Transformer
 from . import predictor
 
 
 class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
     def __init__(self, build_net, input_names, input_shapes, transformers=None, name=None, pretrained_fname=None,
-                 solvers=None, environment_config=None, policy_config=None, **kwargs):
+                 solvers=None, environment_config=None, policy_config=None, autotune_jacobian_mode=False, **kwargs):
         """
         Args:
             build_net: Function that builds the net and returns a dict the network layers, which should contain at least
@@ -34,6 +36,9 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
             pretrained_fname: File name of h5 file with parameters to initialize the parameters of this net. The
                 file name could also be an iteration number, in which case the file with the corresponding number
                 in the default snapshot directory is used.
+            autotune_jacobian_mode: If True, the jacobians that are requested without a mode use the mode that is the
+                fastest one for their batch size (rounded up to a power of two). The modes are timed on the inputs
+                of the first request and the fastest one is cached in a file next to the model snapshot.
             kwargs: Optional arguments that are passed to build_net.
         """
         self.build_net = build_net
@@ -61,6 +66,9 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
             except ValueError:
                 pretrained_fname = pretrained_fname.replace('.yaml', '.h5')
             self.copy_from(pretrained_fname)
+        self.pretrained_fname = pretrained_fname
+        self.autotune_jacobian_mode = autotune_jacobian_mode
+        self._jacobian_modes = None
         # draw net and save to file
         net_graph_fname = os.path.join(self.get_model_dir(), 'net_graph.png')
         if visualization_theano is not None:
@@ -101,10 +109,7 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
         pred_vars = lasagne.layers.get_output(output_layers, deterministic=True)
         input_vars = [input_var for input_var in self.input_vars if input_var in
                       theano.gof.graph.inputs(pred_vars)]
-        start_time = time.time()
-        print("Compiling prediction function...")
-        pred_fn = theano.function(input_vars, pred_vars)
-        print("... finished in %.2f s" % (time.time() - start_time))
+        pred_fn = compile_function('prediction', input_vars, pred_vars)
         return pred_fn
 
     def predict(self, name_or_names, inputs, preprocessed=False):
@@ -121,11 +126,27 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
             preds = [np.squeeze(pred, 0) for pred in preds]
         return iter_util.unflatten_tree(name_or_names, preds)
 
+    def _get_default_jacobian_mode(self, names, wrt_name):
+        """
+        Returns the forward mode if the wrt variable has fewer dimensions than
+        the outputs and the reverse mode otherwise.
+        """
+        output_shapes = lasagne.layers.get_output_shape([self.pred_layers[name] for name in names])
+        output_dim = sum([np.prod(output_shape[1:]) for output_shape in output_shapes])
+        wrt_dim = np.prod(self.pred_layers[wrt_name].output_shape[1:])
+        if wrt_dim < output_dim:
+            return 'forward'
+        else:
+            return 'reverse'
+
     def _get_jacobian_var(self, names, wrt_name, mode=None):
         """
-        Returns the jacobian expressions and the respective outputs for a single
-        data point. Assumes that the inputs being passed have a single leading
-        dimension (i.e. batch_size=1).
+        Returns the jacobian expressions and the respective outputs for a
+        batch of data points. The jacobians have shape (batch_size,
+        output_dim, wrt_dim), where output_dim is the flattened dimension of
+        the respective output, and the jacobian of each data point is only
+        with respect to the wrt variable of that same data point (i.e. the
+        data points of a batch are assumed to be independent).
         """
         output_wrt_vars = lasagne.layers.get_output([self.pred_layers[name] for name in (names + (wrt_name,))], deterministic=True)
         output_vars, wrt_var = output_wrt_vars[:-1], output_wrt_vars[-1]
@@ -138,51 +159,59 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
                              "leading axis being a singleton or None")
         _, wrt_dim = wrt_shape
         if mode is None:
-            if wrt_dim < output_dim:
-                mode = 'forward'
-            else:
-                mode = 'reverse'
+            mode = self._get_default_jacobian_mode(names, wrt_name)
         if mode in ('fwd', 'forward'):
             # compute jacobian as multiple Rop jacobian-vector product gradients for each index of wrt variable
-            output_var = T.concatenate([output_var.flatten() for output_var in output_vars])
-            jac_var, _ = theano.scan(lambda eval_points, output_var, wrt_var: theano.gradient.Rop(output_var, wrt_var, eval_points),
-                                     sequences=np.eye(wrt_dim)[:, None, :],
+            output_var = T.concatenate([T.flatten(output_var, outdim=2) for output_var in output_vars], axis=1)
+            jac_var, _ = theano.scan(lambda eval_point, output_var, wrt_var:
+                                     theano.gradient.Rop(output_var, wrt_var, T.zeros_like(wrt_var) + eval_point),
+                                     sequences=np.eye(wrt_dim).astype(theano.config.floatX),
                                      non_sequences=[output_var, wrt_var])
-            jac_var = jac_var.T
+            jac_var = jac_var.dimshuffle((1, 2, 0))
         elif mode == 'batched':
             # same as forward mode but using batch computations as opposed to scan
             # see https://github.com/Theano/Theano/issues/4087
             output_var = T.concatenate([T.flatten(output_var, outdim=2) for output_var in output_vars], axis=1)
-            jac_var = theano.gradient.Rop(output_var, wrt_var, np.eye(wrt_dim))
-            input_vars = [input_var for input_var in self.input_vars if input_var in theano.gof.graph.inputs([jac_var])]
+            input_vars = [input_var for input_var in self.input_vars if
+                          input_var in theano.gof.graph.inputs([output_var, wrt_var])]
+            # each data point is repeated wrt_dim times and paired with each index of the wrt variable
             rep_dict = {input_var: T.repeat(input_var, wrt_dim, axis=0) for input_var in input_vars}
-            jac_var = theano.clone(jac_var, replace=rep_dict)
-            jac_var = jac_var.T
+            rep_output_var, rep_wrt_var = theano.clone([output_var, wrt_var], replace=rep_dict)
+            eval_points = T.tile(T.constant(np.eye(wrt_dim, dtype=theano.config.floatX)),
+                                 (rep_wrt_var.shape[0] // wrt_dim, 1))
+            jac_var = theano.gradient.Rop(rep_output_var, rep_wrt_var, eval_points)
+            jac_var = jac_var.reshape((-1, wrt_dim, output_dim)).dimshuffle((0, 2, 1))
         elif mode in ('rev', 'reverse'):
             # compute jacobian as multiple Lop vector-jacobian product gradients for each index of the output variable
-            output_var = T.concatenate([output_var.flatten() for output_var in output_vars])
-            jac_var = theano.gradient.jacobian(output_var, wrt_var)
-            jac_var = jac_var[:, 0, :]
+            # the outputs are summed over the batch since each output only depends on the wrt of its data point
+            output_var = T.concatenate([T.flatten(output_var, outdim=2) for output_var in output_vars], axis=1)
+            jac_var = theano.gradient.jacobian(output_var.sum(axis=0), wrt_var)
+            jac_var = jac_var.dimshuffle((1, 0, 2))
         elif mode == 'linear':
+            # the outputs are assumed to be affine in the wrt variable, so that the jacobian is the difference
+            # between the outputs for each unit vector and the outputs for the zero vector
+            wrt_points = T.constant(np.r_[np.zeros((1, wrt_dim)), np.eye(wrt_dim)].astype(theano.config.floatX))
+            rep_wrt_var = wrt_var.type()
             jac_vars = []
-            for output_var in output_vars:
+            for output_var, output_shape in zip(output_vars, output_shapes):
                 input_vars = [input_var for input_var in self.input_vars if
                               input_var in theano.gof.graph.inputs([output_var])]
-                # using tensordot to multiply ones with the input_var seems to be faster than using repeat
-                # rep_dict = {input_var: T.repeat(input_var, wrt_dim + 1, axis=0)
-                #             for input_var in input_vars if input_var != wrt_var}
-                rep_dict = {input_var: T.tensordot(T.ones((wrt_dim + 1, 1)), input_var, axes=1)
+                # each data point is repeated wrt_dim + 1 times and paired with each of the wrt points
+                rep_dict = {input_var: T.repeat(input_var, wrt_dim + 1, axis=0)
                             for input_var in input_vars if input_var != wrt_var}
-                rep_dict[wrt_var] = np.r_[np.zeros((1, wrt_dim)), np.eye(wrt_dim)].astype(theano.config.floatX)
+                rep_dict[wrt_var] = rep_wrt_var
                 rep_output_var = theano.clone(output_var, replace=rep_dict)
-                jac_var = rep_output_var[1:] - rep_output_var[0]
-                jac_var = jac_var.reshape((wrt_dim, -1, 1)).T
-                jac_vars.append(jac_var)
+                # replaced separately so that the batch size is the one of the original wrt variable
+                rep_output_var = theano.clone(rep_output_var,
+                                              replace={rep_wrt_var: T.tile(wrt_points, (wrt_var.shape[0], 1))})
+                rep_output_var = rep_output_var.reshape((-1, wrt_dim + 1, np.prod(output_shape[1:])))
+                jac_var = rep_output_var[:, 1:] - rep_output_var[:, 0].dimshuffle((0, 'x', 1))
+                jac_vars.append(jac_var.dimshuffle((0, 2, 1)))
         else:
             raise ValueError('mode can only be fwd, forward, rev, reverse, batched or linear, but %r was given' % mode)
         if mode != 'linear':
             split_inds = np.r_[0, np.cumsum([np.prod(output_shape[1:]) for output_shape in output_shapes])]
-            jac_vars = [jac_var[start_ind:end_ind].reshape((1, -1, wrt_dim)) for (start_ind, end_ind) in zip(split_inds[:-1], split_inds[1:])]
+            jac_vars = [jac_var[:, start_ind:end_ind] for (start_ind, end_ind) in zip(split_inds[:-1], split_inds[1:])]
         return jac_vars, output_vars
 
     def _compile_jacobian_fn(self, names, wrt_name, ret_outputs=False, mode=None):
@@ -192,34 +221,97 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
         else:
             all_vars = jac_vars
         input_vars = [input_var for input_var in self.input_vars if input_var in theano.gof.graph.inputs(all_vars)]
-        start_time = time.time()
-        print("Compiling jacobian function...")
-        jac_fn = theano.function(input_vars, all_vars, on_unused_input='warn')
-        print("... finished in %.2f s" % (time.time() - start_time))
+        jac_fn = compile_function('jacobian', input_vars, all_vars, on_unused_input='warn')
+        return jac_fn
+
+    def _get_jacobian_fn(self, names, wrt_name, ret_outputs=False, mode=None):
+        jac_fn_args = (names, wrt_name, ret_outputs, mode)
+        jac_fn = self.jac_fns.get(jac_fn_args) or \
+            self.jac_fns.setdefault(jac_fn_args, self._compile_jacobian_fn(*jac_fn_args))
         return jac_fn
 
+    def get_jacobian_modes_fname(self):
+        if self.pretrained_fname is not None:
+            return os.path.splitext(self.pretrained_fname)[0] + '_jacobian_modes.yaml'
+        else:
+            return os.path.join(self.get_model_dir(), 'jacobian_modes.yaml')
+
+    def _time_jacobian_modes(self, names, wrt_name, inputs, ret_outputs=False, num_runs=3):
+        """
+        Returns a dict with the time that each jacobian mode takes for the
+        given (batched and preprocessed) inputs. The modes that can't be
+        compiled for this net or whose jacobians don't match the ones of the
+        default mode (e.g. the linear mode for outputs that are not affine in
+        the wrt variable) are skipped.
+        """
+        default_mode = self._get_default_jacobian_mode(names, wrt_name)
+        ref_jacs = self._get_jacobian_fn(names, wrt_name, ret_outputs=ret_outputs, mode=default_mode)(*inputs)
+        mode_times = OrderedDict()
+        for mode in ['forward', 'batched', 'reverse', 'linear']:
+            try:
+                jac_fn = self._get_jacobian_fn(names, wrt_name, ret_outputs=ret_outputs, mode=mode)
+            except Exception as e:  # e.g. ops of the net that don't implement R_op
+                print("Skipping jacobian mode %s that failed to compile (%s: %s)" % (mode, type(e).__name__, e))
+                continue
+            jacs = jac_fn(*inputs)
+            if not all(np.allclose(jac, ref_jac, rtol=1e-3, atol=1e-3 * np.abs(ref_jac).max())
+                       for jac, ref_jac in zip(jacs, ref_jacs)):
+                print("Skipping jacobian mode %s since its jacobians are different from the ones of the default "
+                      "mode" % mode)
+                continue
+            run_times = []
+            for _ in range(num_runs):
+                start_time = time.time()
+                jac_fn(*inputs)
+                run_times.append(time.time() - start_time)
+            mode_times[mode] = min(run_times)
+        return mode_times
+
+    def _get_autotuned_jacobian_mode(self, names, wrt_name, inputs, ret_outputs=False):
+        batch_size = len(inputs[0])
+        batch_bucket = 2 ** int(np.ceil(np.log2(max(batch_size, 1))))
+        key = '%s/%s/%s/%d' % (self.name, ','.join(names), wrt_name, batch_bucket)
+        if ret_outputs:
+            key += '/outputs'
+        jacobian_modes_fname = self.get_jacobian_modes_fname()
+        if self._jacobian_modes is None:
+            if os.path.exists(jacobian_modes_fname):
+                with open(jacobian_modes_fname) as jacobian_modes_file:
+                    self._jacobian_modes = yaml.load(jacobian_modes_file, Loader=Python2to3Loader) or dict()
+            else:
+                self._jacobian_modes = dict()
+        if key not in self._jacobian_modes:
+            print("Autotuning jacobian mode for %s..." % key)
+            mode_times = self._time_jacobian_modes(names, wrt_name, inputs, ret_outputs=ret_outputs)
+            mode = min(mode_times, key=mode_times.get)
+            print("... using mode %s (%s)" % (mode, ', '.join('%s: %.2f ms' % (mode_, mode_time * 1000)
+                                                              for mode_, mode_time in mode_times.items())))
+            self._jacobian_modes[key] = dict(mode=mode, times=dict(mode_times), batch_size=batch_size)
+            # write the file with a temporary name and rename it once it is complete
+            tmp_jacobian_modes_fname = jacobian_modes_fname + '.%d.tmp' % os.getpid()
+            with open(tmp_jacobian_modes_fname, 'w') as jacobian_modes_file:
+                yaml.dump(self._jacobian_modes, jacobian_modes_file, default_flow_style=False)
+            os.rename(tmp_jacobian_modes_fname, jacobian_modes_fname)
+        return self._jacobian_modes[key]['mode']
+
     def jacobian(self, name_or_names, wrt_name, inputs, preprocessed=False, ret_outputs=False, mode=None):
         names = tuple(iter_util.flatten_tree(name_or_names))
         batch_size = self.batch_size(inputs, preprocessed=preprocessed)
         if not preprocessed:
             inputs = self.preprocess(inputs)
         inputs = [input_.astype(theano.config.floatX, copy=False) for input_ in inputs]
-        if batch_size in (0, 1):
-            if batch_size == 0:
-                inputs = [input_[None, :] for input_ in inputs]
-            jac_fn_args = (names, wrt_name, ret_outputs, mode)
-            jac_fn = self.jac_fns.get(jac_fn_args) or \
-                self.jac_fns.setdefault(jac_fn_args, self._compile_jacobian_fn(*jac_fn_args))
-            preds = jac_fn(*inputs)
-            if batch_size == 0:
-                preds = [np.squeeze(pred, 0) for pred in preds]
-        else:
-            batched_preds = [self.jacobian(names, wrt_name, single_inputs,
-                                           preprocessed=True, ret_outputs=ret_outputs,
-                                           mode=mode) for single_inputs in zip(*inputs)]
-            if ret_outputs:
-                batched_preds = [sum(preds, []) for preds in batched_preds]
-            preds = [np.array(pred) for pred in zip(*batched_preds)]
+        if batch_size == 0:
+            inputs = [input_[None, :] for input_ in inputs]
+        if mode is None:
+            if self.autotune_jacobian_mode:
+                mode = self._get_autotuned_jacobian_mode(names, wrt_name, inputs, ret_outputs=ret_outputs)
+            else:
+                mode = self._get_default_jacobian_mode(names, wrt_name)
+        # the same function is used for any batch size
+        jac_fn = self._get_jacobian_fn(names, wrt_name, ret_outputs=ret_outputs, mode=mode)
+        preds = jac_fn(*inputs)
+        if batch_size == 0:
+            preds = [np.squeeze(pred, 0) for pred in preds]
         if ret_outputs:
             return iter_util.unflatten_tree([name_or_names, name_or_names], preds)
         else:
@@ -302,7 +394,8 @@ class TheanoNetPredictor(predictor.NetPredictor, ConfigObject):
                        'name': self.name,
                        'solvers': self.solvers,
                        'environment_config': self.environment_config,
-                       'policy_config': self.policy_config})
+                       'policy_config': self.policy_config,
+                       'autotune_jacobian_mode': self.autotune_jacobian_mode})
         config.update(self._kwargs)
         return config
 
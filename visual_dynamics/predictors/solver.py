@@ -1,6 +1,16 @@
 from __future__ import division, print_function
 
+import hashlib
+import os
+import shutil
 import time
+import traceback
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import lasagne
 import lasagne.layers as L
@@ -13,19 +23,82 @@ import yaml
 
 from visual_dynamics.gui.grid_image_visualizer import GridImageVisualizer
 from visual_dynamics.gui.loss_plotter import LossPlotter
+from visual_dynamics.utils.cache import FrameCache, get_hash, get_data_dir_signature
 from visual_dynamics.utils.config import ConfigObject
-from visual_dynamics.utils.generator import DataGenerator, ParallelGenerator
+from visual_dynamics.utils.container import DataContainer, ImageDataContainer
+from visual_dynamics.utils.generator import DataGenerator, MultiprocessGenerator, get_multiprocessing_context
 from visual_dynamics.utils.math_utils import OnlineStatistics
+from visual_dynamics.utils.transformer import Transformer
 from . import layers_theano as LT
 
 
+def get_standarize_layers(net):
+    standarize_layers = set()
+    for pred_layer in net.pred_layers.values():
+        for layer in L.get_all_layers(pred_layer):
+            if isinstance(layer, LT.StandarizeLayer):
+                standarize_layers.add(layer)
+    return sorted(standarize_layers, key=lambda layer: layer.name)
+
+
+def get_params_hash(params):
+    """
+    Returns a hex digest of the names, shapes and values of the parameters.
+    """
+    sha1 = hashlib.sha1()
+    for param in params:
+        value = np.ascontiguousarray(param.get_value())
+        sha1.update(('%s:%s:%r' % (param.name, value.dtype, value.shape)).encode('utf-8'))
+        sha1.update(value.tobytes())
+    return sha1.hexdigest()
+
+
+def _standarize_stats_worker(solver, net, standarize_layers, aggregating_batch_size, shard_id, num_shards,
+                             result_queue):
+    try:
+        online_stats = solver.compute_standarize_stats(net, standarize_layers,
+                                                       aggregating_batch_size=aggregating_batch_size,
+                                                       shard_id=shard_id, num_shards=num_shards)
+        result_queue.put((shard_id, online_stats, None))
+    except Exception:
+        result_queue.put((shard_id, None, traceback.format_exc()))
+
+
+def get_standarize_stats_results(workers, result_queue, timeout=1.0):
+    """
+    Returns a dict that maps the shard ids to the statistics that the worker
+    processes in the dict workers (keyed by shard id) put in result_queue.
+    Raises a RuntimeError if a worker failed, or if it exited without putting
+    its statistics (e.g. if it was killed) instead of blocking forever.
+    """
+    results = dict()
+    while len(results) < len(workers):
+        # a worker that exited before the get has already flushed its statistics to the queue
+        exited_shard_ids = [shard_id for shard_id, worker in workers.items()
+                            if shard_id not in results and not worker.is_alive()]
+        try:
+            shard_id, online_stats, error = result_queue.get(timeout=timeout)
+        except queue.Empty:
+            if exited_shard_ids:
+                shard_id = exited_shard_ids[0]
+                raise RuntimeError('the worker process of shard %d exited unexpectedly with exit code %r' %
+                                   (shard_id, workers[shard_id].exitcode))
+            continue
+        if error is not None:
+            raise RuntimeError('computing the standarize statistics of shard %d failed:\n%s' % (shard_id, error))
+        results[shard_id] = online_stats
+    return results
+
+
 class TheanoNetSolver(ConfigObject):
     def __init__(self, train_data_fnames, val_data_fnames=None, data_names=None, data_name_offset_pairs=None,
                  input_names=None, output_names=None,
                  trainable_tags_list=None, batch_size=32, test_iter=10, solver_type='ADAM', test_interval=1000,
                  base_lr=0.001, gamma=1.0, stepsize=1000, display=20, max_iter=10000, momentum=0.9, momentum2=0.999,
                  weight_decay=0.0005, snapshot_interval=1000, snapshot_prefix='', average_loss=10, loss_interval=100,
-                 plot_interval=100, iter_=0, losses=None, train_losses=None, val_losses=None, loss_iters=None):
+                 plot_interval=100, iter_=0, losses=None, train_losses=None, val_losses=None, loss_iters=None,
+                 cache_dir=None, train_data_gen_state=None, standarize_stats_dir=None, standarize_nb_worker=1,
+                 frame_cache_bytes=0, num_decode_threads=0, feature_cache_dir=None):
         """
         Args:
             data_names: Iterable of names for the image and velocity inputs in the data files.
@@ -34,6 +107,23 @@ class TheanoNetSolver(ConfigObject):
                 used for the loss.
             trainable_tags_list: Iterable of tags, each being a dict of tags to filter out the parameters that should
                 be trained.
+            cache_dir: Directory in which the preprocessed data is cached, or None to not cache it.
+            train_data_gen_state: State of the training data generator (see DataGenerator.state_dict), which is
+                saved in the snapshots so that resumed training iterates the data in the same order.
+            standarize_stats_dir: Directory in which the statistics used to standarize the features are cached.
+                Defaults to the model directory of the net.
+            standarize_nb_worker: Number of processes among which the pass over the training data that computes
+                the standarize statistics is sharded. The workers are forked after the net is built, so this is
+                only supported on the CPU; on other devices, the statistics are computed in this process (use
+                scripts/precompute_standarize_stats.py to shard them there).
+            frame_cache_bytes: If positive, the decoded images are kept in in-memory LRU caches (see FrameCache),
+                so that they are not decoded again in later epochs. Each data loading process has its own cache, and
+                this total number of bytes is divided evenly among the training and validation processes.
+            num_decode_threads: Number of threads that decode the images of each minibatch (see
+                ImageDataContainer), or 0 to decode them in the data loading process itself.
+            feature_cache_dir: If specified, the outputs of the frozen encoder (the inputs of the standarize layers)
+                are computed once over the data and stored in feature containers in this directory, and the net is
+                trained from these features instead of from the images.
         """
         self.train_data_fnames = train_data_fnames or []
         self.val_data_fnames = val_data_fnames or []
@@ -66,6 +156,13 @@ class TheanoNetSolver(ConfigObject):
         self.train_losses = train_losses or []
         self.val_losses = val_losses or []
         self.loss_iters = loss_iters or []
+        self.cache_dir = cache_dir
+        self.train_data_gen_state = train_data_gen_state
+        self.standarize_stats_dir = standarize_stats_dir
+        self.standarize_nb_worker = standarize_nb_worker
+        self.frame_cache_bytes = frame_cache_bytes
+        self.num_decode_threads = num_decode_threads
+        self.feature_cache_dir = feature_cache_dir
 
         self._last_snapshot_iter = None
         self._visualize_loss_num = None
@@ -98,7 +195,29 @@ class TheanoNetSolver(ConfigObject):
         _, outputs = zip(*sorted(iouts))
         return list(zip(outputs[0::2], outputs[1::2]))
 
-    def get_output_vars(self, net, deterministic=False):
+    def get_input_vars(self, net, feature_layers=None):
+        """
+        Returns the input variables in the order of data_name_offset_pairs. If
+        feature_layers is given, the image inputs are replaced by variables
+        for the outputs of these layers, and a dict that maps each time offset
+        to the dict of these layers and their variables is also returned.
+        """
+        input_vars = [net.pred_layers[name].input_var for name in self.input_names]
+        if feature_layers is None:
+            return input_vars, None
+        feature_input_vars = []
+        time_feature_vars_dict = dict()
+        for (data_name, offset), input_var in zip(self.data_name_offset_pairs, input_vars):
+            if data_name == self.data_names[0]:
+                feature_vars = [T.TensorType(theano.config.floatX, (False,) * len(L.get_output_shape(feature_layer)))(
+                    '%s_%d' % (feature_layer.name, offset)) for feature_layer in feature_layers]
+                feature_input_vars.extend(feature_vars)
+                time_feature_vars_dict[offset] = OrderedDict(zip(feature_layers, feature_vars))
+            else:
+                feature_input_vars.append(input_var)
+        return feature_input_vars, time_feature_vars_dict
+
+    def get_output_vars(self, net, deterministic=False, time_feature_vars_dict=None):
         for output_name in self.output_names:
             if not (isinstance(output_name, tuple) or isinstance(output_name, list))\
                     or len(output_name) != 2:
@@ -117,7 +236,12 @@ class TheanoNetSolver(ConfigObject):
         for t, inames in time_inames_dict.items():
             inds, names = zip(*inames)
             layers = [net.pred_layers[name] for name in names]
-            if t == 0:
+            if time_feature_vars_dict is not None:
+                if t not in time_feature_vars_dict:
+                    raise NotImplementedError("output name with time %d when training from features" % t)
+                vars_ = lasagne.layers.get_output(layers, inputs=time_feature_vars_dict[t],
+                                                  deterministic=deterministic)
+            elif t == 0:
                 vars_ = lasagne.layers.get_output(layers, deterministic=deterministic)
             elif t == 1:
                 input_vars = [net.pred_layers[name].input_var for name in self.input_names]
@@ -128,25 +252,29 @@ class TheanoNetSolver(ConfigObject):
         _, output_vars = zip(*sorted(ivars))
         return list(zip(output_vars[0::2], output_vars[1::2]))
 
-    def get_loss_var(self, net, deterministic=False):
+    def get_loss_var(self, net, deterministic=False, time_feature_vars_dict=None):
         # import IPython as ipy; ipy.embed()
         # output_names = [('x0_next_pred', ('x0', 1)),
         #                 (('x1', 1), 'x1_next_pred')]
-        pred_vars, target_vars = zip(*self.get_output_vars(net, deterministic=deterministic))
+        pred_vars, target_vars = zip(*self.get_output_vars(net, deterministic=deterministic,
+                                                           time_feature_vars_dict=time_feature_vars_dict))
         loss = 0
         for pred_var, target_var in zip(pred_vars, target_vars):
             loss += ((target_var - pred_var) ** 2).mean(axis=0).sum() / 2.
+        if time_feature_vars_dict is not None:
+            image_input_vars = [net.pred_layers[input_name].input_var
+                                for (data_name, _), input_name in zip(self.data_name_offset_pairs, self.input_names)
+                                if data_name == self.data_names[0]]
+            if set(image_input_vars) & set(theano.gof.graph.inputs([loss])):
+                raise ValueError('unable to train from features since the loss depends on the images through '
+                                 'layers other than the feature layers')
         params_regularizable = [param for param in net.get_all_params(regularizable=True).values()
                                 if param in theano.gof.graph.inputs([loss])]  # exclude params not in computation graph
         param_l2_penalty = lasagne.regularization.apply_penalty(params_regularizable, lasagne.regularization.l2)
         loss += self.weight_decay * param_l2_penalty / 2.
         return loss
 
-    def compile_train_fn(self, net):
-        input_vars = [net.pred_layers[name].input_var for name in self.input_names]
-        # training loss
-        loss = self.get_loss_var(net, deterministic=False)
-        # training function
+    def get_trainable_params(self, net):
         # params = list(net.get_all_params(trainable=True).values())
         trainable_params_dict = dict()
         for trainable_tags in self.trainable_tags_list:
@@ -154,7 +282,14 @@ class TheanoNetSolver(ConfigObject):
             trainable_tags = dict(trainable_tags)
             trainable_tags.setdefault('trainable', True)
             trainable_params_dict.update(net.get_all_params(**trainable_tags))
-        params = list(trainable_params_dict.values())
+        return list(trainable_params_dict.values())
+
+    def compile_train_fn(self, net, feature_layers=None):
+        input_vars, time_feature_vars_dict = self.get_input_vars(net, feature_layers=feature_layers)
+        # training loss
+        loss = self.get_loss_var(net, deterministic=False, time_feature_vars_dict=time_feature_vars_dict)
+        # training function
+        params = self.get_trainable_params(net)
         nontrainable_params = list(set(net.get_all_params().values()) - set(params))
         print('parameters that are not trainable:\n%r' % nontrainable_params)
 
@@ -180,10 +315,10 @@ class TheanoNetSolver(ConfigObject):
         print("... finished in %.2f s" % (time.time() - start_time))
         return train_fn
 
-    def compile_val_fn(self, net):
-        input_vars = [net.pred_layers[name].input_var for name in self.input_names]
+    def compile_val_fn(self, net, feature_layers=None):
+        input_vars, time_feature_vars_dict = self.get_input_vars(net, feature_layers=feature_layers)
         # validation loss
-        val_loss = self.get_loss_var(net, deterministic=True)
+        val_loss = self.get_loss_var(net, deterministic=True, time_feature_vars_dict=time_feature_vars_dict)
         # validation function
         start_time = time.time()
         print("Compiling validation function...")
@@ -191,6 +326,17 @@ class TheanoNetSolver(ConfigObject):
         print("... finished in %.2f s" % (time.time() - start_time))
         return val_fn
 
+    def compile_outputs_fn(self, net, feature_layers=None):
+        """
+        Compiles a function that returns the flattened pairs of outputs of
+        output_names (e.g. for visualization) given the inputs of a minibatch.
+        """
+        input_vars, time_feature_vars_dict = self.get_input_vars(net, feature_layers=feature_layers)
+        output_vars = [var for var_pair in self.get_output_vars(net, deterministic=True,
+                                                                 time_feature_vars_dict=time_feature_vars_dict)
+                       for var in var_pair]
+        return theano.function(input_vars, output_vars, on_unused_input='ignore')
+
     def solve(self, net):
         losses = self.step(self.max_iter - self.iter_, net)
         # save snapshot after the optimization is done if it hasn't already been saved
@@ -207,116 +353,132 @@ class TheanoNetSolver(ConfigObject):
     def step(self, iters, net):
         self.standarize(net)
 
+        feature_layers = self.get_feature_layers(net) if self.feature_cache_dir else None
+        validate = self.test_interval and self.val_data_fnames
+        train_nb_worker, val_nb_worker = 4, 1 if validate else 0
+        # each worker gets a copy of the cache when it is forked, so the budget is divided among the workers
+        frame_cache_bytes = self.frame_cache_bytes // (train_nb_worker + val_nb_worker)
         # training data
-        train_data_gen = DataGenerator(self.train_data_fnames,
-                                       data_name_offset_pairs=self.data_name_offset_pairs,
+        train_data_fnames, data_name_offset_pairs = self.get_data(net, self.train_data_fnames, feature_layers)
+        train_data_gen = DataGenerator(train_data_fnames,
+                                       data_name_offset_pairs=data_name_offset_pairs,
                                        transformers=net.transformers,
                                        batch_size=self.batch_size,
                                        shuffle=True,
-                                       dtype=theano.config.floatX)
-        train_data_gen = ParallelGenerator(train_data_gen, nb_worker=4)
-        validate = self.test_interval and self.val_data_fnames
-        if validate:
-            # validation data
-            val_data_gen = DataGenerator(self.val_data_fnames,
-                                         data_name_offset_pairs =self.data_name_offset_pairs ,
-                                         transformers=net.transformers,
-                                         batch_size=self.batch_size,
-                                         shuffle=True,
-                                         dtype=theano.config.floatX)
-            val_data_gen = ParallelGenerator(val_data_gen,
-                                             max_q_size=self.test_iter,
-                                             nb_worker=1)
-
-        print("Size of training data is %d" % train_data_gen.size)
-        train_fn = self.compile_train_fn(net)
-        if validate:
-            print("Size of validation data is %d" % val_data_gen.size)
-            val_fn = self.compile_val_fn(net)
-
-        if self.plot_interval:
-            fig, loss_plotter, image_visualizer = self.loss_visualization_init(validate=validate)
-
-        print("Starting training...")
-        stop_iter = self.iter_ + iters
-        while self.iter_ < stop_iter:
-            if validate and self.iter_ % self.test_interval == 0:
-                val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
-                print("    validation loss = {:.6f}".format(val_loss))
-
-            current_step = self.iter_ // self.stepsize
-            learning_rate = self.base_lr * self.gamma ** current_step
-            train_batch_data = tuple(next(train_data_gen))
-            loss = float(train_fn(*(train_batch_data + (learning_rate,))))
-            self.losses.append(loss)
-
-            if self.display and self.iter_ % self.display == 0:
-                print("Iteration {} of {}, lr = {}".format(self.iter_, self.max_iter, learning_rate))
-                print("    training loss = {:.6f}".format(loss))
-
-            if self.loss_interval and (self.iter_ % self.loss_interval == 0 or
-                                       self.snapshot_interval and self.iter_ % self.snapshot_interval == 0):  # update loss plot for snapshot
-                average_loss = min(self.average_loss, len(self.losses))
-                train_loss = float(sum(self.losses[-average_loss:]) / average_loss)
-                self.train_losses.append(train_loss)
-                if validate:
+                                       dtype=theano.config.floatX,
+                                       cache_dir=self.cache_dir,
+                                       num_decode_threads=self.num_decode_threads,
+                                       frame_cache=FrameCache(frame_cache_bytes) if frame_cache_bytes else None)
+        if self.train_data_gen_state is not None:
+            train_data_gen.load_state_dict(self.train_data_gen_state)
+        train_data_gen = MultiprocessGenerator(train_data_gen, nb_worker=train_nb_worker)
+        val_data_gen = None
+        try:
+            if validate:
+                # validation data
+                val_data_fnames, data_name_offset_pairs = self.get_data(net, self.val_data_fnames, feature_layers)
+                val_data_gen = DataGenerator(val_data_fnames,
+                                             data_name_offset_pairs=data_name_offset_pairs,
+                                             transformers=net.transformers,
+                                             batch_size=self.batch_size,
+                                             shuffle=True,
+                                             dtype=theano.config.floatX,
+                                             cache_dir=self.cache_dir,
+                                             num_decode_threads=self.num_decode_threads,
+                                             frame_cache=FrameCache(frame_cache_bytes) if frame_cache_bytes else None)
+                val_data_gen = MultiprocessGenerator(val_data_gen,
+                                                     max_q_size=self.test_iter,
+                                                     nb_worker=val_nb_worker)
+
+            print("Size of training data is %d" % train_data_gen.size)
+            train_fn = self.compile_train_fn(net, feature_layers=feature_layers)
+            if validate:
+                print("Size of validation data is %d" % val_data_gen.size)
+                val_fn = self.compile_val_fn(net, feature_layers=feature_layers)
+
+            if self.plot_interval:
+                fig, loss_plotter, image_visualizer = self.loss_visualization_init(validate=validate)
+                if feature_layers is not None:
+                    outputs_fn = self.compile_outputs_fn(net, feature_layers)
+
+            print("Starting training...")
+            stop_iter = self.iter_ + iters
+            while self.iter_ < stop_iter:
+                if validate and self.iter_ % self.test_interval == 0:
                     val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
-                    self.val_losses.append(val_loss)
-                self.loss_iters.append(self.iter_)
-
-            # plot visualization using first datum in batch
-            if self.plot_interval and self.iter_ % self.plot_interval == 0:
-                batch_data = next(val_data_gen) if validate else train_batch_data
-                outputs = self.get_outputs(net, *[datum[0] for datum in batch_data], preprocessed=True)
-                self.loss_visualization_update(loss_plotter, image_visualizer, outputs, validate=validate)
-                loss_fig_fname = self.get_snapshot_fname('_loss.pdf')
-                fig.savefig(loss_fig_fname)
+                    print("    validation loss = {:.6f}".format(val_loss))
+
+                current_step = self.iter_ // self.stepsize
+                learning_rate = self.base_lr * self.gamma ** current_step
+                train_batch_data = tuple(next(train_data_gen))
+                self.train_data_gen_state = train_data_gen.state_dict()
+                loss = float(train_fn(*(train_batch_data + (learning_rate,))))
+                self.losses.append(loss)
+
+                if self.display and self.iter_ % self.display == 0:
+                    print("Iteration {} of {}, lr = {}".format(self.iter_, self.max_iter, learning_rate))
+                    print("    training loss = {:.6f}".format(loss))
+
+                if self.loss_interval and (self.iter_ % self.loss_interval == 0 or
+                                           self.snapshot_interval and self.iter_ % self.snapshot_interval == 0):  # update loss plot for snapshot
+                    average_loss = min(self.average_loss, len(self.losses))
+                    train_loss = float(sum(self.losses[-average_loss:]) / average_loss)
+                    self.train_losses.append(train_loss)
+                    if validate:
+                        val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
+                        self.val_losses.append(val_loss)
+                    self.loss_iters.append(self.iter_)
+
+                # plot visualization using first datum in batch
+                if self.plot_interval and self.iter_ % self.plot_interval == 0:
+                    batch_data = next(val_data_gen) if validate else train_batch_data
+                    if feature_layers is None:
+                        outputs = self.get_outputs(net, *[datum[0] for datum in batch_data], preprocessed=True)
+                    else:
+                        outputs = outputs_fn(*[datum[:1] for datum in batch_data])
+                        outputs = list(zip(*[iter(output[0] for output in outputs)] * 2))
+                    self.loss_visualization_update(loss_plotter, image_visualizer, outputs, validate=validate)
+                    loss_fig_fname = self.get_snapshot_fname('_loss.pdf')
+                    fig.savefig(loss_fig_fname)
 
-            self.iter_ += 1
+                self.iter_ += 1
 
-            if self.snapshot_interval and self.iter_ % self.snapshot_interval == 0:
-                self.snapshot(net)
+                if self.snapshot_interval and self.iter_ % self.snapshot_interval == 0:
+                    self.snapshot(net)
 
-        average_loss = min(self.average_loss, len(self.losses))
-        train_loss = float(sum(self.losses[-average_loss:]) / average_loss)
-        if validate:
-            val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
-        else:
-            val_loss = None
+            average_loss = min(self.average_loss, len(self.losses))
+            train_loss = float(sum(self.losses[-average_loss:]) / average_loss)
+            if validate:
+                val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
+            else:
+                val_loss = None
+        finally:
+            # stop the data loading processes even if the training is interrupted
+            if val_data_gen is not None:
+                val_data_gen.close()
+            train_data_gen.close()
         return train_loss, val_loss
 
     def standarize(self, net, aggregating_batch_size=100, check=False):
         start_time = time.time()
-        print("Standarizing outputs...")
-
-        # training data (one pass)
-        train_data_once_gen = DataGenerator(self.train_data_fnames,
-                                            data_name_offset_pairs=self.data_name_offset_pairs,
-                                            transformers=net.transformers,
-                                            once=True,
-                                            batch_size=aggregating_batch_size,
-                                            shuffle=False,
-                                            dtype=theano.config.floatX)
-        train_data_once_gen = ParallelGenerator(train_data_once_gen, nb_worker=1)
-
-        standarize_layers = set()
-        for pred_layer in net.pred_layers.values():
-            for layer in L.get_all_layers(pred_layer):
-                if isinstance(layer, LT.StandarizeLayer):
-                    standarize_layers.add(layer)
-        standarize_layers = list(standarize_layers)
+        standarize_layers = get_standarize_layers(net)
+        if not standarize_layers:
+            return
         standarize_layer_names = [standarize_layer.name for standarize_layer in standarize_layers]
-        online_stats = [OnlineStatistics(axis=standarize_layer.shared_axes) for standarize_layer in standarize_layers]
-
-        for batch_data in train_data_once_gen:
-            X = batch_data[0]
-            outputs = net.predict(standarize_layer_names, [X], preprocessed=True)  # assume the only input is X
-            for output, online_stat in zip(outputs, online_stats):
-                online_stat.add_data(output)
+        stats_fname = self.get_standarize_stats_fname(net, standarize_layers)
+        if os.path.exists(stats_fname):
+            print("Standarizing outputs with the statistics in %s..." % stats_fname)
+            offsets, scales = self.load_standarize_stats(stats_fname, standarize_layers)
+        else:
+            print("Standarizing outputs...")
+            online_stats = self.collect_standarize_stats(net, standarize_layers,
+                                                         aggregating_batch_size=aggregating_batch_size,
+                                                         nb_worker=self.standarize_nb_worker)
+            offsets, scales = self.save_standarize_stats(stats_fname, standarize_layers, online_stats)
 
-        for online_stat, standarize_layer in zip(online_stats, standarize_layers):
-            standarize_layer.offset.set_value(online_stat.mean.astype(theano.config.floatX))
-            standarize_layer.scale.set_value(online_stat.std.astype(theano.config.floatX))
+        for offset, scale, standarize_layer in zip(offsets, scales, standarize_layers):
+            standarize_layer.offset.set_value(offset.astype(theano.config.floatX))
+            standarize_layer.scale.set_value(scale.astype(theano.config.floatX))
 
         print("... finished in %.2f s" % (time.time() - start_time))
 
@@ -327,8 +489,10 @@ class TheanoNetSolver(ConfigObject):
                                                 once=True,
                                                 batch_size=aggregating_batch_size,
                                                 shuffle=False,
-                                                dtype=theano.config.floatX)
-            train_data_once_gen = ParallelGenerator(train_data_once_gen, nb_worker=1)
+                                                dtype=theano.config.floatX,
+                                                cache_dir=self.cache_dir,
+                                                num_decode_threads=self.num_decode_threads)
+            train_data_once_gen = MultiprocessGenerator(train_data_once_gen, nb_worker=1)
 
             check_online_stats = [OnlineStatistics(axis=standarize_layer.shared_axes) for standarize_layer in standarize_layers]
 
@@ -343,6 +507,235 @@ class TheanoNetSolver(ConfigObject):
                 assert np.allclose(online_stat.mean, 0, atol=1e-5)
                 assert np.allclose(online_stat.std, 1)
 
+    def compute_standarize_stats(self, net, standarize_layers, aggregating_batch_size=100, shard_id=0, num_shards=1):
+        """
+        Computes the statistics of the inputs of the standarize layers over
+        a single pass of the training data, or over the shard_id-th of
+        num_shards interleaved shards of it. When training from features, the
+        statistics are computed directly from the cached features.
+        """
+        if self.feature_cache_dir:
+            feature_layers = [standarize_layer.input_layer for standarize_layer in standarize_layers]
+        else:
+            feature_layers = None
+        train_data_fnames, data_name_offset_pairs = self.get_data(net, self.train_data_fnames, feature_layers)
+        train_data_once_gen = DataGenerator(train_data_fnames,
+                                            data_name_offset_pairs=data_name_offset_pairs,
+                                            transformers=net.transformers,
+                                            once=True,
+                                            batch_size=aggregating_batch_size,
+                                            shuffle=False,
+                                            dtype=theano.config.floatX,
+                                            cache_dir=self.cache_dir,
+                                            num_decode_threads=self.num_decode_threads).shard(shard_id, num_shards)
+        train_data_once_gen = MultiprocessGenerator(train_data_once_gen, nb_worker=1)
+
+        if feature_layers is None:
+            # the statistics of the inputs don't depend on the current offsets and scales of the standarize layers
+            output_vars = L.get_output([standarize_layer.input_layer for standarize_layer in standarize_layers],
+                                       deterministic=True)
+            input_vars = [input_var for input_var in net.input_vars
+                          if input_var in theano.gof.graph.inputs(output_vars)]
+            standarize_input_fn = theano.function(input_vars, output_vars)  # assume the only input is X
+        online_stats = [OnlineStatistics(axis=standarize_layer.shared_axes) for standarize_layer in standarize_layers]
+
+        for batch_data in train_data_once_gen:
+            if feature_layers is None:
+                X = batch_data[0]
+                inputs = standarize_input_fn(X)
+            else:
+                inputs = batch_data[:len(feature_layers)]
+            for input_, online_stat in zip(inputs, online_stats):
+                online_stat.add_data(input_)
+        train_data_once_gen.close()
+        return online_stats
+
+    def collect_standarize_stats(self, net, standarize_layers, aggregating_batch_size=100, nb_worker=1):
+        """
+        Computes the statistics of the inputs of the standarize layers, where
+        the training data is sharded among nb_worker processes (this one
+        included) and the statistics of the shards are merged.
+
+        The workers are forked so that they inherit the net, and they run its
+        compiled functions. This is only supported on the CPU (e.g. a forked
+        CUDA context is unusable), so on other devices the statistics are
+        computed in this process.
+        """
+        if nb_worker > 1 and not theano.config.device.startswith('cpu'):
+            print("Computing the standarize statistics in a single process since the workers can't be forked on "
+                  "device %s" % theano.config.device)
+            nb_worker = 1
+        if nb_worker <= 1:
+            return self.compute_standarize_stats(net, standarize_layers, aggregating_batch_size=aggregating_batch_size)
+        if self.feature_cache_dir:
+            # build the features before forking so that the workers don't build them concurrently
+            self.get_data(net, self.train_data_fnames,
+                          [standarize_layer.input_layer for standarize_layer in standarize_layers])
+        # the workers are forked so that they inherit the net and its current parameters
+        context = get_multiprocessing_context()
+        result_queue = context.Queue()
+        workers = dict()
+        for shard_id in range(1, nb_worker):
+            worker = context.Process(target=_standarize_stats_worker,
+                                     args=(self, net, standarize_layers, aggregating_batch_size, shard_id, nb_worker,
+                                           result_queue))
+            worker.start()
+            workers[shard_id] = worker
+        try:
+            online_stats = self.compute_standarize_stats(net, standarize_layers,
+                                                         aggregating_batch_size=aggregating_batch_size,
+                                                         shard_id=0, num_shards=nb_worker)
+            shard_online_stats = get_standarize_stats_results(workers, result_queue)
+            for shard_id in sorted(shard_online_stats.keys()):
+                for online_stat, shard_online_stat in zip(online_stats, shard_online_stats[shard_id]):
+                    online_stat.merge(shard_online_stat)
+        finally:
+            for worker in workers.values():
+                worker.join(timeout=1.0)
+                if worker.is_alive():
+                    worker.terminate()
+        return online_stats
+
+    def get_standarize_stats_fname(self, net, standarize_layers):
+        """
+        Returns the file name of the cached standarize statistics, which is
+        identified by the parameters that the inputs of the standarize layers
+        depend on, the transformers and the training data.
+        """
+        params = L.get_all_params([standarize_layer.input_layer for standarize_layer in standarize_layers])
+        key = get_hash(get_params_hash(params),
+                       [standarize_layer.name for standarize_layer in standarize_layers],
+                       net.transformers,
+                       ';'.join([get_data_dir_signature(data_fname) for data_fname in self.train_data_fnames]),
+                       self.data_name_offset_pairs,
+                       str(theano.config.floatX))
+        stats_dir = self.standarize_stats_dir or net.get_model_dir()
+        return os.path.join(stats_dir, 'standarize_stats_%s.npz' % key)
+
+    def save_standarize_stats(self, stats_fname, standarize_layers, online_stats):
+        offsets = [online_stat.mean for online_stat in online_stats]
+        scales = [online_stat.std for online_stat in online_stats]
+        stats_dir = os.path.dirname(stats_fname)
+        if stats_dir and not os.path.exists(stats_dir):
+            os.makedirs(stats_dir)
+        stats_dict = dict()
+        for standarize_layer, offset, scale in zip(standarize_layers, offsets, scales):
+            stats_dict[standarize_layer.name + '_offset'] = offset
+            stats_dict[standarize_layer.name + '_scale'] = scale
+        # write the file with a temporary name and rename it once it is complete
+        tmp_stats_fname = stats_fname + '.%d.tmp' % os.getpid()
+        with open(tmp_stats_fname, 'wb') as stats_file:
+            np.savez(stats_file, **stats_dict)
+        os.rename(tmp_stats_fname, stats_fname)
+        return offsets, scales
+
+    def load_standarize_stats(self, stats_fname, standarize_layers):
+        with np.load(stats_fname) as stats_file:
+            offsets = [stats_file[standarize_layer.name + '_offset'] for standarize_layer in standarize_layers]
+            scales = [stats_file[standarize_layer.name + '_scale'] for standarize_layer in standarize_layers]
+        return offsets, scales
+
+    def get_feature_layers(self, net):
+        """
+        Returns the layers whose outputs are cached when training from
+        features, which are the inputs of the standarize layers. The encoder
+        that computes them should not have trainable parameters.
+        """
+        feature_layers = [standarize_layer.input_layer for standarize_layer in get_standarize_layers(net)]
+        if not feature_layers:
+            raise ValueError('unable to train from features since the net has no standarize layers')
+        trainable_params = set(self.get_trainable_params(net))
+        for feature_layer in feature_layers:
+            if trainable_params & set(L.get_all_params(feature_layer)):
+                raise ValueError('unable to train from the features of layer %s since its encoder has trainable '
+                                 'parameters' % feature_layer.name)
+        return feature_layers
+
+    def get_data(self, net, data_fnames, feature_layers=None):
+        """
+        Returns the data file names and the data name offset pairs to read
+        them with. If feature_layers is given, these are the feature
+        containers of the data files (which are built if they don't exist),
+        in which the images are replaced by the outputs of these layers.
+        """
+        if feature_layers is None:
+            return data_fnames, self.data_name_offset_pairs
+        feature_data_fnames = []
+        for data_fname in data_fnames:
+            feature_data_fname = self.get_feature_data_fname(net, feature_layers, data_fname)
+            if not os.path.exists(feature_data_fname):
+                self.build_feature_data(net, feature_layers, data_fname, feature_data_fname)
+            feature_data_fnames.append(feature_data_fname)
+        data_name_offset_pairs = []
+        for data_name, offset in self.data_name_offset_pairs:
+            if data_name == self.data_names[0]:
+                data_name_offset_pairs.extend((feature_layer.name, offset) for feature_layer in feature_layers)
+            else:
+                data_name_offset_pairs.append((data_name, offset))
+        return feature_data_fnames, data_name_offset_pairs
+
+    def get_feature_data_fname(self, net, feature_layers, data_fname):
+        """
+        The feature container is identified by the signature of the data, the
+        image transformer and the names and parameters of the feature layers,
+        so that the features are computed again whenever any of these change.
+        """
+        image_transformer = net.transformers.get(self.data_names[0], Transformer())
+        key = get_hash(get_data_dir_signature(data_fname), image_transformer, str(theano.config.floatX),
+                       ','.join(feature_layer.name for feature_layer in feature_layers),
+                       get_params_hash(L.get_all_params(feature_layers)))
+        return os.path.join(self.feature_cache_dir, '%s_%s' % (os.path.basename(os.path.normpath(data_fname)), key))
+
+    def build_feature_data(self, net, feature_layers, data_fname, feature_data_fname, batch_size=100):
+        """
+        Computes the outputs of the feature layers for all the images of the
+        data file and stores them as float16 arrays in a container, along with
+        the other data names (e.g. the actions).
+        """
+        start_time = time.time()
+        print("Building features of %s..." % data_fname)
+        image_name, other_names = self.data_names[0], list(self.data_names[1:])
+        feature_names = [feature_layer.name for feature_layer in feature_layers]
+        output_vars = L.get_output(feature_layers, deterministic=True)
+        input_vars = [input_var for input_var in net.input_vars if input_var in theano.gof.graph.inputs(output_vars)]
+        feature_fn = theano.function(input_vars, output_vars)  # assume the only input is X
+        image_transformer = net.transformers.get(image_name, Transformer())
+        # build the container with a temporary name and rename it once it is complete
+        tmp_feature_data_fname = '%s.%d.tmp' % (feature_data_fname, os.getpid())
+        with ImageDataContainer(data_fname) as container, \
+                DataContainer(tmp_feature_data_fname, 'x') as feature_container:
+            all_traj_lengths = [container.get_traj_lengths(data_name) for data_name in self.data_names]
+            num_trajs = min(len(traj_lengths) for traj_lengths in all_traj_lengths)
+            traj_lengths = np.min([traj_lengths[:num_trajs] for traj_lengths in all_traj_lengths], axis=0)
+            if len(set(traj_lengths)) == 1:
+                feature_container.reserve(feature_names + other_names, (num_trajs, int(traj_lengths[0])))
+            else:
+                feature_container.reserve(feature_names + other_names, (num_trajs, None))
+            for traj_iter, traj_length in enumerate(traj_lengths):
+                for start in range(0, traj_length, batch_size):
+                    step_inds = np.arange(start, min(start + batch_size, traj_length))
+                    data = container.get_data(np.full_like(step_inds, traj_iter), step_inds, self.data_names)
+                    # same preprocessing as the one of DataGenerator
+                    images = np.empty(image_transformer.preprocess_batch_shape(data[0].shape),
+                                      dtype=theano.config.floatX)
+                    images = image_transformer.preprocess_batch(data[0], out=images)
+                    features = feature_fn(images)
+                    features = [np.asarray(feature, dtype=np.float16) for feature in features]
+                    if not all(np.isfinite(feature).all() for feature in features):
+                        raise ValueError('the features of %s overflow float16' % data_fname)
+                    for i, step_iter in enumerate(step_inds):
+                        feature_container.add_datum(traj_iter, int(step_iter),
+                                                    **dict(zip(feature_names + other_names,
+                                                               [datum[i] for datum in features + data[1:]])))
+            feature_container.add_info(data_fname=os.path.abspath(data_fname), feature_names=feature_names)
+        try:
+            os.rename(tmp_feature_data_fname, feature_data_fname)
+        except OSError:
+            if not os.path.exists(feature_data_fname):
+                raise
+            shutil.rmtree(tmp_feature_data_fname)  # the same features were built concurrently
+        print("... finished in %.2f s" % (time.time() - start_time))
+
     def loss_visualization_init(self, validate=True):
         fig = plt.figure(figsize=(18, 18), frameon=False, tight_layout=True)
         fig.canvas.set_window_title(self.snapshot_prefix)
@@ -419,7 +812,14 @@ class TheanoNetSolver(ConfigObject):
                        'losses': self.losses,
                        'train_losses': self.train_losses,
                        'val_losses': self.val_losses,
-                       'loss_iters': self.loss_iters})
+                       'loss_iters': self.loss_iters,
+                       'cache_dir': self.cache_dir,
+                       'train_data_gen_state': self.train_data_gen_state,
+                       'standarize_stats_dir': self.standarize_stats_dir,
+                       'standarize_nb_worker': self.standarize_nb_worker,
+                       'frame_cache_bytes': self.frame_cache_bytes,
+                       'num_decode_threads': self.num_decode_threads,
+                       'feature_cache_dir': self.feature_cache_dir})
         return config
 
     def __repr__(self):
@@ -436,7 +836,8 @@ class BilinearSolver(TheanoNetSolver):
                  input_names=None, output_names=None,
                  loss_batch_size=32, aggregating_batch_size=1000, num_channel_groups=1,
                  test_iter=10, max_iter=1, weight_decay=0.0005,
-                 snapshot_prefix='', average_loss=10, iter_=0):
+                 snapshot_prefix='', average_loss=10, iter_=0, cache_dir=None, standarize_stats_dir=None,
+                 standarize_nb_worker=1, num_decode_threads=0, feature_cache_dir=None):
         self.train_data_fnames = train_data_fnames or []
         self.val_data_fnames = val_data_fnames or []
         self.data_names = data_names or ['image', 'action']
@@ -454,9 +855,20 @@ class BilinearSolver(TheanoNetSolver):
         self.average_loss = average_loss
 
         self.iter_ = iter_
+        self.cache_dir = cache_dir
+        self.standarize_stats_dir = standarize_stats_dir
+        self.standarize_nb_worker = standarize_nb_worker
+        self.feature_cache_dir = feature_cache_dir
+        self.num_decode_threads = num_decode_threads
 
         self._last_snapshot_iter = None
 
+    def get_trainable_params(self, net):
+        # only the parameters of the bilinear layers are solved for
+        return [param for layer in net.get_all_layers()
+                if isinstance(layer, (LT.BilinearLayer, LT.BilinearChannelwiseLayer))
+                for param in layer.get_params()]
+
     def solve(self, net):
         losses = self.step(self.max_iter - self.iter_, net)
         # save snapshot after the optimization is done if it hasn't already been saved
@@ -473,213 +885,248 @@ class BilinearSolver(TheanoNetSolver):
     def step(self, iters, net):
         self.standarize(net)
 
+        feature_layers = self.get_feature_layers(net) if self.feature_cache_dir else None
         # training data
-        train_data_gen = DataGenerator(self.train_data_fnames,
-                                       data_name_offset_pairs=self.data_name_offset_pairs,
+        train_data_fnames, data_name_offset_pairs = self.get_data(net, self.train_data_fnames, feature_layers)
+        train_data_gen = DataGenerator(train_data_fnames,
+                                       data_name_offset_pairs=data_name_offset_pairs,
                                        transformers=net.transformers,
                                        batch_size=self.loss_batch_size,
                                        shuffle=True,
-                                       dtype=theano.config.floatX)
-        train_data_gen = ParallelGenerator(train_data_gen,
-                                           max_q_size=self.average_loss,
-                                           nb_worker=4)
-        validate = bool(self.val_data_fnames)
-        if validate:
-            # validation data
-            val_data_gen = DataGenerator(self.val_data_fnames,
-                                         data_name_offset_pairs=self.data_name_offset_pairs,
-                                         transformers=net.transformers,
-                                         batch_size=self.loss_batch_size,
-                                         shuffle=True,
-                                         dtype=theano.config.floatX)
-            val_data_gen = ParallelGenerator(val_data_gen,
-                                             max_q_size=self.test_iter,
-                                             nb_worker=1)
-
-        print("Size of training data is %d" % train_data_gen.size)
-        if validate:
-            print("Size of validation data is %d" % val_data_gen.size)
-        val_fn = self.compile_val_fn(net)  # need val_fn to 'validate' on training data
-
-        print("Starting training...")
-        stop_iter = self.iter_ + iters
-        while self.iter_ < stop_iter:
-            # print losses
-            train_loss = float(sum([val_fn(*next(train_data_gen)) for _ in range(self.average_loss)]) / self.average_loss)
-            print("Iteration {} of {}".format(self.iter_, self.max_iter))
-            print("    training loss = {:.6f}".format(train_loss))
+                                       dtype=theano.config.floatX,
+                                       cache_dir=self.cache_dir,
+                                       num_decode_threads=self.num_decode_threads)
+        train_data_gen = MultiprocessGenerator(train_data_gen,
+                                               max_q_size=self.average_loss,
+                                               nb_worker=4)
+        val_data_gen = None
+        try:
+            validate = bool(self.val_data_fnames)
             if validate:
-                val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
-                print("    validation loss = {:.6f}".format(val_loss))
+                # validation data
+                val_data_fnames, data_name_offset_pairs = self.get_data(net, self.val_data_fnames, feature_layers)
+                val_data_gen = DataGenerator(val_data_fnames,
+                                             data_name_offset_pairs=data_name_offset_pairs,
+                                             transformers=net.transformers,
+                                             batch_size=self.loss_batch_size,
+                                             shuffle=True,
+                                             dtype=theano.config.floatX,
+                                             cache_dir=self.cache_dir,
+                                             num_decode_threads=self.num_decode_threads)
+                val_data_gen = MultiprocessGenerator(val_data_gen,
+                                                     max_q_size=self.test_iter,
+                                                     nb_worker=1)
+
+            print("Size of training data is %d" % train_data_gen.size)
+            if validate:
+                print("Size of validation data is %d" % val_data_gen.size)
+            val_fn = self.compile_val_fn(net, feature_layers=feature_layers)  # need val_fn to 'validate' on training data
+
+            print("Starting training...")
+            stop_iter = self.iter_ + iters
+            while self.iter_ < stop_iter:
+                # print losses
+                train_loss = float(sum([val_fn(*next(train_data_gen)) for _ in range(self.average_loss)]) / self.average_loss)
+                print("Iteration {} of {}".format(self.iter_, self.max_iter))
+                print("    training loss = {:.6f}".format(train_loss))
+                if validate:
+                    val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
+                    print("    validation loss = {:.6f}".format(val_loss))
 
-            # ensure outputs_names follow the expected format
-            curr_names = []
-            bilinear_layers = []
-            for output_pair in self.output_names:
-                try:
+                # ensure outputs_names follow the expected format
+                curr_names = []
+                bilinear_layers = []
+                for output_pair in self.output_names:
                     try:
-                        next_pred_name, (curr_name, offset) = output_pair
-                    except ValueError:
-                        (curr_name, offset), next_pred_name = output_pair
-                        output_pair[:] = output_pair[::-1]
-                    if offset != 1:
-                        raise Exception
-                    next_pred_layer = net.pred_layers[next_pred_name]
-                    curr_layer, bilinear_layer = next_pred_layer.input_layers
-                    if curr_layer != net.pred_layers[curr_name] or not isinstance(bilinear_layer,
-                                                                                  (LT.BilinearLayer,
-                                                                                   LT.BilinearChannelwiseLayer)):
-                        raise Exception
-                    curr_names.append(curr_name)
-                    bilinear_layers.append(bilinear_layer)
-                except Exception:
-                    raise NotImplementedError('bilinear solver for output pair %r' % output_pair)
-
-            for channel_group in range(self.num_channel_groups):
-                print("channel group %d" % channel_group)
-                # training data (one pass)
-                train_data_once_gen = DataGenerator(self.train_data_fnames,
-                                                    data_name_offset_pairs=self.data_name_offset_pairs,
-                                                    transformers=net.transformers,
-                                                    once=True,
-                                                    batch_size=self.aggregating_batch_size,
-                                                    shuffle=False,
-                                                    dtype=theano.config.floatX)
-                train_data_once_gen = ParallelGenerator(train_data_once_gen, nb_worker=4)
-
-                start_time = time.time()
-                print("Aggregating matrices...")
-                Ns = {i: 0 for i in range(len(bilinear_layers))}
-                As = {}
-                Bs = {}
-                post_fit_all = {}
-                diff_outputs = {}
-                batch_iter = 0
-                for X, U, X_next in train_data_once_gen:
-                    print("batch %d" % batch_iter)
-                    curr_outputs = net.predict(curr_names, [X], preprocessed=True)
-                    next_outputs = net.predict(curr_names, [X_next], preprocessed=True)
-                    for i, (bilinear_layer, curr_output, next_output) in \
-                            enumerate(zip(bilinear_layers, curr_outputs, next_outputs)):
-                        c_dim = curr_output.shape[1]
-                        assert c_dim % self.num_channel_groups == 0
-                        if self.num_channel_groups != 1 and net.bilinear_type != 'channelwise':
-                            raise ValueError("num_channel_groups != 1 is only valid for channelwise bilinear layers")
-                        if net.bilinear_type == 'share':
-                            batch_size = np.prod(curr_output.shape[:2])
-                            vel = np.repeat(U[:, None, :], c_dim, axis=1).reshape((batch_size, -1))
-                        else:
-                            batch_size = curr_output.shape[0]
-                            vel = U
-                        Ns[i] += batch_size
+                        try:
+                            next_pred_name, (curr_name, offset) = output_pair
+                        except ValueError:
+                            (curr_name, offset), next_pred_name = output_pair
+                            output_pair[:] = output_pair[::-1]
+                        if offset != 1:
+                            raise Exception
+                        next_pred_layer = net.pred_layers[next_pred_name]
+                        curr_layer, bilinear_layer = next_pred_layer.input_layers
+                        if curr_layer != net.pred_layers[curr_name] or not isinstance(bilinear_layer,
+                                                                                      (LT.BilinearLayer,
+                                                                                       LT.BilinearChannelwiseLayer)):
+                            raise Exception
+                        curr_names.append(curr_name)
+                        bilinear_layers.append(bilinear_layer)
+                    except Exception:
+                        raise NotImplementedError('bilinear solver for output pair %r' % output_pair)
+                if feature_layers is None:
+                    num_image_inputs = 1
+
+                    def predict_curr_outputs(X):
+                        return net.predict(curr_names, list(X), preprocessed=True)
+                else:
+                    num_image_inputs = len(feature_layers)
+                    _, time_feature_vars_dict = self.get_input_vars(net, feature_layers=feature_layers)
+                    feature_vars_dict = time_feature_vars_dict[0]
+                    predict_curr_outputs_fn = theano.function(
+                        list(feature_vars_dict.values()),
+                        L.get_output([net.pred_layers[curr_name] for curr_name in curr_names],
+                                     inputs=feature_vars_dict, deterministic=True))
+
+                    def predict_curr_outputs(X):
+                        return predict_curr_outputs_fn(*X)
+
+                for channel_group in range(self.num_channel_groups):
+                    print("channel group %d" % channel_group)
+                    # training data (one pass)
+                    train_data_once_gen = DataGenerator(train_data_fnames,
+                                                        data_name_offset_pairs=data_name_offset_pairs,
+                                                        transformers=net.transformers,
+                                                        once=True,
+                                                        batch_size=self.aggregating_batch_size,
+                                                        shuffle=False,
+                                                        dtype=theano.config.floatX,
+                                                        cache_dir=self.cache_dir,
+                                                        num_decode_threads=self.num_decode_threads)
+                    train_data_once_gen = MultiprocessGenerator(train_data_once_gen, nb_worker=4)
+
+                    start_time = time.time()
+                    print("Aggregating matrices...")
+                    Ns = {i: 0 for i in range(len(bilinear_layers))}
+                    As = {}
+                    Bs = {}
+                    post_fit_all = {}
+                    diff_outputs = {}
+                    batch_iter = 0
+                    for batch_data in train_data_once_gen:
+                        print("batch %d" % batch_iter)
+                        # the images (or their features when training from features) of the current and next steps
+                        X, U, X_next = (batch_data[:num_image_inputs], batch_data[num_image_inputs],
+                                        batch_data[num_image_inputs + 1:])
+                        curr_outputs = predict_curr_outputs(X)
+                        next_outputs = predict_curr_outputs(X_next)
+                        for i, (bilinear_layer, curr_output, next_output) in \
+                                enumerate(zip(bilinear_layers, curr_outputs, next_outputs)):
+                            c_dim = curr_output.shape[1]
+                            assert c_dim % self.num_channel_groups == 0
+                            if self.num_channel_groups != 1 and net.bilinear_type != 'channelwise':
+                                raise ValueError("num_channel_groups != 1 is only valid for channelwise bilinear layers")
+                            if net.bilinear_type == 'share':
+                                batch_size = np.prod(curr_output.shape[:2])
+                                vel = np.repeat(U[:, None, :], c_dim, axis=1).reshape((batch_size, -1))
+                            else:
+                                batch_size = curr_output.shape[0]
+                                vel = U
+                            Ns[i] += batch_size
+                            if net.bilinear_type == 'share' or net.bilinear_type == 'full':
+                                if i not in As:
+                                    As[i] = 0
+                                    Bs[i] = 0
+                                    diff_outputs[i] = 0
+                                curr_output = curr_output.reshape((batch_size, -1))
+                                next_output = next_output.reshape((batch_size, -1))
+                                diff_output = next_output - curr_output
+                                diff_outputs[i] += diff_output.sum(axis=0)
+                                A, B, post_fit = bilinear.BilinearFunction.compute_solver_terms(curr_output, vel,
+                                                                                                diff_output)
+                                As[i] += A
+                                Bs[i] += B
+                            elif net.bilinear_type == 'channelwise':
+                                cg_dim = c_dim // self.num_channel_groups
+                                cg_slice = slice(channel_group * cg_dim, (channel_group + 1) * cg_dim)
+                                if i not in As:
+                                    y_dim = bilinear_layer.y_dim
+                                    u_dim = bilinear_layer.u_dim
+                                    As[i] = np.zeros((cg_dim, (y_dim+1)*(u_dim+1), (y_dim+1)*(u_dim+1)), dtype=theano.config.floatX)
+                                    Bs[i] = np.zeros((cg_dim, (y_dim+1)*(u_dim+1), y_dim), dtype=theano.config.floatX)
+                                    diff_outputs[i] = np.zeros((cg_dim, y_dim), dtype=theano.config.floatX)
+                                curr_output = curr_output[:, cg_slice].reshape((batch_size, cg_dim, -1))
+                                next_output = next_output[:, cg_slice].reshape((batch_size, cg_dim, -1))
+                                diff_output = next_output - curr_output
+                                diff_outputs[i] += diff_output.sum(axis=0)
+                                for channel in range(cg_slice.start, cg_slice.stop):
+                                    A, B, post_fit = bilinear.BilinearFunction.compute_solver_terms(curr_output[:, channel % cg_dim, :], vel,
+                                                                                                    diff_output[:, channel % cg_dim, :])
+                                    As[i][channel % cg_dim] += A.astype(theano.config.floatX)
+                                    Bs[i][channel % cg_dim] += B.astype(theano.config.floatX)
+                                    del A, B
+                            else:
+                                raise NotImplementedError("aggregating matrices for bilinear_type %s" % net.bilinear_type)
+                            if i not in post_fit_all:
+                                post_fit_all[i] = post_fit
+                        batch_iter += 1
+                        # if batch_iter == 2:  # TODO: remove me
+                        #     break
+                    print("... finished in %2.f s" % (time.time() - start_time))
+
+                    # mean_diff_output = {}
+                    # scale_offset_transformer = net.transformers[0].transformers[-1]
+                    # for i in range(len(diff_outputs)):
+                    #     mean_diff_output[i] = ((diff_outputs[i] / Ns[i] - scale_offset_transformer.offset) \
+                    #                            * (1.0 / scale_offset_transformer.scale)).astype(scale_offset_transformer._data_dtype)
+                    # mean_diff_output_flat = np.concatenate([mean.flatten() for mean in mean_diff_output.values()])
+                    # for i in range(256):
+                    #     num = (mean_diff_output_flat == i).sum()
+                    #     if num > 0:
+                    #         print('%d: %d' % (i, num))
+
+                    start_time = time.time()
+                    print("Solving linear systems...")
+                    for i, bilinear_layer in enumerate(bilinear_layers):
+                        start_time_single = time.time()
+                        post_fit = post_fit_all[i]
+                        Q_param, R_param, S_param, b_param = bilinear_layer.get_params()
                         if net.bilinear_type == 'share' or net.bilinear_type == 'full':
-                            if i not in As:
-                                As[i] = 0
-                                Bs[i] = 0
-                                diff_outputs[i] = 0
-                            curr_output = curr_output.reshape((batch_size, -1))
-                            next_output = next_output.reshape((batch_size, -1))
-                            diff_output = next_output - curr_output
-                            diff_outputs[i] += diff_output.sum(axis=0)
-                            A, B, post_fit = bilinear.BilinearFunction.compute_solver_terms(curr_output, vel,
-                                                                                            diff_output)
-                            As[i] += A
-                            Bs[i] += B
+                            A = As[i] / (2. * Ns[i])
+                            A += self.weight_decay * np.diag([1.] * (len(A) - 1) + [0.])  # don't regularize bias, which is the last one
+                            B = Bs[i] / (2. * Ns[i])
+                            Q, R, S, b = post_fit(np.linalg.solve(A, B))
+                            Q = np.asarray(Q, dtype=theano.config.floatX)
+                            R = np.asarray(R, dtype=theano.config.floatX)
+                            S = np.asarray(S, dtype=theano.config.floatX)
+                            b = np.asarray(b, dtype=theano.config.floatX)
+                            Q_param.set_value(Q)
+                            R_param.set_value(R)
+                            S_param.set_value(S)
+                            b_param.set_value(b)
                         elif net.bilinear_type == 'channelwise':
+                            c_dim = L.get_output_shape(bilinear_layer)[1]
                             cg_dim = c_dim // self.num_channel_groups
                             cg_slice = slice(channel_group * cg_dim, (channel_group + 1) * cg_dim)
-                            if i not in As:
-                                y_dim = bilinear_layer.y_dim
-                                u_dim = bilinear_layer.u_dim
-                                As[i] = np.zeros((cg_dim, (y_dim+1)*(u_dim+1), (y_dim+1)*(u_dim+1)), dtype=theano.config.floatX)
-                                Bs[i] = np.zeros((cg_dim, (y_dim+1)*(u_dim+1), y_dim), dtype=theano.config.floatX)
-                                diff_outputs[i] = np.zeros((cg_dim, y_dim), dtype=theano.config.floatX)
-                            curr_output = curr_output[:, cg_slice].reshape((batch_size, cg_dim, -1))
-                            next_output = next_output[:, cg_slice].reshape((batch_size, cg_dim, -1))
-                            diff_output = next_output - curr_output
-                            diff_outputs[i] += diff_output.sum(axis=0)
-                            for channel in range(cg_slice.start, cg_slice.stop):
-                                A, B, post_fit = bilinear.BilinearFunction.compute_solver_terms(curr_output[:, channel % cg_dim, :], vel,
-                                                                                                diff_output[:, channel % cg_dim, :])
-                                As[i][channel % cg_dim] += A.astype(theano.config.floatX)
-                                Bs[i][channel % cg_dim] += B.astype(theano.config.floatX)
-                                del A, B
+                            # use borrow=True only if the param is shared variable in cpu (i.e. TensorSharedVariable)
+                            Q = Q_param.get_value(borrow=isinstance(Q_param, T.sharedvar.TensorSharedVariable))
+                            R = R_param.get_value(borrow=isinstance(R_param, T.sharedvar.TensorSharedVariable))
+                            S = S_param.get_value(borrow=isinstance(S_param, T.sharedvar.TensorSharedVariable))
+                            b = b_param.get_value(borrow=isinstance(b_param, T.sharedvar.TensorSharedVariable))
+                            for channel, A, B in (zip(range(cg_slice.start, cg_slice.stop), As[i], Bs[i])):
+                                A = A / (2. * Ns[i])
+                                A += self.weight_decay * np.diag([1.] * (len(A) - 1) + [0.])  # don't regularize bias, which is the last one
+                                B = B / (2. * Ns[i])
+                                Q[channel], R[channel], S[channel], b[channel] = post_fit(np.linalg.solve(A, B))
+                            Q_param.set_value(Q, borrow=isinstance(Q_param, T.sharedvar.TensorSharedVariable))
+                            R_param.set_value(R, borrow=isinstance(R_param, T.sharedvar.TensorSharedVariable))
+                            S_param.set_value(S, borrow=isinstance(S_param, T.sharedvar.TensorSharedVariable))
+                            b_param.set_value(b, borrow=isinstance(b_param, T.sharedvar.TensorSharedVariable))
                         else:
-                            raise NotImplementedError("aggregating matrices for bilinear_type %s" % net.bilinear_type)
-                        if i not in post_fit_all:
-                            post_fit_all[i] = post_fit
-                    batch_iter += 1
-                    # if batch_iter == 2:  # TODO: remove me
-                    #     break
-                print("... finished in %2.f s" % (time.time() - start_time))
-
-                # mean_diff_output = {}
-                # scale_offset_transformer = net.transformers[0].transformers[-1]
-                # for i in range(len(diff_outputs)):
-                #     mean_diff_output[i] = ((diff_outputs[i] / Ns[i] - scale_offset_transformer.offset) \
-                #                            * (1.0 / scale_offset_transformer.scale)).astype(scale_offset_transformer._data_dtype)
-                # mean_diff_output_flat = np.concatenate([mean.flatten() for mean in mean_diff_output.values()])
-                # for i in range(256):
-                #     num = (mean_diff_output_flat == i).sum()
-                #     if num > 0:
-                #         print('%d: %d' % (i, num))
-
-                start_time = time.time()
-                print("Solving linear systems...")
-                for i, bilinear_layer in enumerate(bilinear_layers):
-                    start_time_single = time.time()
-                    post_fit = post_fit_all[i]
-                    Q_param, R_param, S_param, b_param = bilinear_layer.get_params()
-                    if net.bilinear_type == 'share' or net.bilinear_type == 'full':
-                        A = As[i] / (2. * Ns[i])
-                        A += self.weight_decay * np.diag([1.] * (len(A) - 1) + [0.])  # don't regularize bias, which is the last one
-                        B = Bs[i] / (2. * Ns[i])
-                        Q, R, S, b = post_fit(np.linalg.solve(A, B))
-                        Q = np.asarray(Q, dtype=theano.config.floatX)
-                        R = np.asarray(R, dtype=theano.config.floatX)
-                        S = np.asarray(S, dtype=theano.config.floatX)
-                        b = np.asarray(b, dtype=theano.config.floatX)
-                        Q_param.set_value(Q)
-                        R_param.set_value(R)
-                        S_param.set_value(S)
-                        b_param.set_value(b)
-                    elif net.bilinear_type == 'channelwise':
-                        c_dim = L.get_output_shape(bilinear_layer)[1]
-                        cg_dim = c_dim // self.num_channel_groups
-                        cg_slice = slice(channel_group * cg_dim, (channel_group + 1) * cg_dim)
-                        # use borrow=True only if the param is shared variable in cpu (i.e. TensorSharedVariable)
-                        Q = Q_param.get_value(borrow=isinstance(Q_param, T.sharedvar.TensorSharedVariable))
-                        R = R_param.get_value(borrow=isinstance(R_param, T.sharedvar.TensorSharedVariable))
-                        S = S_param.get_value(borrow=isinstance(S_param, T.sharedvar.TensorSharedVariable))
-                        b = b_param.get_value(borrow=isinstance(b_param, T.sharedvar.TensorSharedVariable))
-                        for channel, A, B in (zip(range(cg_slice.start, cg_slice.stop), As[i], Bs[i])):
-                            A = A / (2. * Ns[i])
-                            A += self.weight_decay * np.diag([1.] * (len(A) - 1) + [0.])  # don't regularize bias, which is the last one
-                            B = B / (2. * Ns[i])
-                            Q[channel], R[channel], S[channel], b[channel] = post_fit(np.linalg.solve(A, B))
-                        Q_param.set_value(Q, borrow=isinstance(Q_param, T.sharedvar.TensorSharedVariable))
-                        R_param.set_value(R, borrow=isinstance(R_param, T.sharedvar.TensorSharedVariable))
-                        S_param.set_value(S, borrow=isinstance(S_param, T.sharedvar.TensorSharedVariable))
-                        b_param.set_value(b, borrow=isinstance(b_param, T.sharedvar.TensorSharedVariable))
-                    else:
-                        raise NotImplementedError("exact solve for bilinear_type %s" % net.bilinear_type)
-                    del Q, R, S, b
-                    print("%2.f s" % (time.time() - start_time_single))
-                del Ns, As, Bs, post_fit_all, diff_outputs
-                print("... finished in %2.f s" % (time.time() - start_time))
+                            raise NotImplementedError("exact solve for bilinear_type %s" % net.bilinear_type)
+                        del Q, R, S, b
+                        print("%2.f s" % (time.time() - start_time_single))
+                    del Ns, As, Bs, post_fit_all, diff_outputs
+                    print("... finished in %2.f s" % (time.time() - start_time))
 
-            self.iter_ += 1
+                self.iter_ += 1
 
-        # X_next_pred = net.predict('x_next_pred', [X, U], preprocessed=True)
-        # fig, axarr = utils.draw_images_callback(list(zip(*[[*X[:10]], [*X_next_pred[:10]], [*X_next[:10]]])),
-        #                                         image_transformer=net.transformers['x'].transformers[-1],
-        #                                         num=11)
+            # X_next_pred = net.predict('x_next_pred', [X, U], preprocessed=True)
+            # fig, axarr = utils.draw_images_callback(list(zip(*[[*X[:10]], [*X_next_pred[:10]], [*X_next[:10]]])),
+            #                                         image_transformer=net.transformers['x'].transformers[-1],
+            #                                         num=11)
 
-        train_loss = float(sum([val_fn(*next(train_data_gen)) for _ in range(self.average_loss)]) / self.average_loss)
-        if validate:
-            val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
-        else:
-            val_loss = None
+            train_loss = float(sum([val_fn(*next(train_data_gen)) for _ in range(self.average_loss)]) / self.average_loss)
+            if validate:
+                val_loss = float(sum([val_fn(*next(val_data_gen)) for _ in range(self.test_iter)]) / self.test_iter)
+            else:
+                val_loss = None
+        finally:
+            # stop the data loading processes even if the training is interrupted
+            if val_data_gen is not None:
+                val_data_gen.close()
+            train_data_gen.close()
         return train_loss, val_loss
 
     def _get_config(self):
@@ -698,5 +1145,10 @@ class BilinearSolver(TheanoNetSolver):
                        'weight_decay': self.weight_decay,
                        'snapshot_prefix': self.snapshot_prefix,
                        'average_loss': self.average_loss,
-                       'iter_': self.iter_})
+                       'iter_': self.iter_,
+                       'cache_dir': self.cache_dir,
+                       'standarize_stats_dir': self.standarize_stats_dir,
+                       'standarize_nb_worker': self.standarize_nb_worker,
+                       'num_decode_threads': self.num_decode_threads,
+                       'feature_cache_dir': self.feature_cache_dir})
         return config
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import yaml
+from nose2 import tools
+
+try:
+    import lasagne.layers as L
+    import theano
+    import theano.tensor as T
+    from visual_dynamics.predictors.predictor_theano import TheanoNetPredictor
+except ImportError:
+    theano = None
+from visual_dynamics.utils.config import Python2to3Loader
+from visual_dynamics.utils.transformer import Transformer
+
+x_dim, u_dim, y_dim, z_dim = 3, 2, 4, 5
+
+
+def build_bilinear_net(input_shapes):
+    x_shape, u_shape = input_shapes
+    X_var = T.matrix('x')
+    U_var = T.matrix('u')
+    l_x = L.InputLayer(shape=(None,) + x_shape, input_var=X_var, name='x')
+    l_u = L.InputLayer(shape=(None,) + u_shape, input_var=U_var, name='u')
+    l_x_dense = L.DenseLayer(l_x, y_dim, nonlinearity=None, name='x_dense')
+    l_u_dense = L.DenseLayer(l_u, y_dim, nonlinearity=None, name='u_dense')
+    # the outputs are bilinear in x and u, so they are affine in u
+    l_y = L.ElemwiseMergeLayer([l_x_dense, l_u_dense], T.mul, name='y')
+    l_z = L.DenseLayer(l_y, z_dim, nonlinearity=None, name='z')
+    return dict(x=l_x, u=l_u, y=l_y, z=l_z)
+
+
+class TemporaryModelDir(object):
+    """
+    Changes the working directory to a temporary directory, which is where the
+    predictors store their models.
+    """
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.model_dir = tempfile.mkdtemp()
+        os.chdir(self.model_dir)
+        return self.model_dir
+
+    def __exit__(self, *args):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.model_dir)
+
+
+def build_bilinear_predictor(**kwargs):
+    return TheanoNetPredictor(build_bilinear_net, ['x', 'u'], [(x_dim,), (u_dim,)],
+                              transformers=dict(x=Transformer(), u=Transformer()), name='BilinearNet', **kwargs)
+
+
+def get_expected_jacobians(predictor, X, U):
+    """
+    Returns the jacobians of y and z with respect to u of each data point
+    computed from the parameters of the net.
+    """
+    params = predictor.get_all_param_values()
+    W_x, b_x = params['x_dense.W'], params['x_dense.b']
+    W_u = params['u_dense.W']
+    W_z = params['z.W']
+    jac_y = (X.dot(W_x) + b_x)[:, :, None] * W_u.T[None, :, :]
+    jac_z = np.einsum('ji,njk->nik', W_z, jac_y)
+    return jac_y, jac_z
+
+
+def get_inputs(batch_size, seed=0):
+    random_state = np.random.RandomState(seed)
+    X = random_state.uniform(-1, 1, size=(max(batch_size, 1), x_dim)).astype(np.float32)
+    U = random_state.uniform(-1, 1, size=(max(batch_size, 1), u_dim)).astype(np.float32)
+    return X, U
+
+
+@tools.params('forward', 'batched', 'reverse', 'linear', None)
+def test_jacobian_modes(mode):
+    if theano is None:
+        raise unittest.SkipTest('theano or lasagne is not installed')
+    with TemporaryModelDir():
+        predictor = build_bilinear_predictor()
+        # the same jacobian function is used for the batch sizes 0 (a single unbatched data point), 1 and 4
+        for batch_size in [0, 1, 4]:
+            X, U = get_inputs(batch_size)
+            expected_jac_y, expected_jac_z = get_expected_jacobians(predictor, X, U)
+            if batch_size == 0:
+                X, U = X[0], U[0]
+                expected_jac_y, expected_jac_z = expected_jac_y[0], expected_jac_z[0]
+            (jac_y, jac_z), (y, z) = predictor.jacobian(['y', 'z'], 'u', [X, U], ret_outputs=True, mode=mode)
+            assert jac_y.shape == expected_jac_y.shape
+            assert jac_z.shape == expected_jac_z.shape
+            assert np.allclose(jac_y, expected_jac_y, atol=1e-5)
+            assert np.allclose(jac_z, expected_jac_z, atol=1e-5)
+            expected_y, expected_z = predictor.predict(['y', 'z'], [X, U])
+            assert np.allclose(y, expected_y, atol=1e-5)
+            assert np.allclose(z, expected_z, atol=1e-5)
+            # the jacobian of each data point of the batch is the same as the one of that data point by itself
+            if batch_size > 0:
+                for X_datum, U_datum, jac_z_datum in zip(X, U, jac_z):
+                    assert np.allclose(predictor.jacobian('z', 'u', [X_datum, U_datum], mode=mode), jac_z_datum,
+                                       atol=1e-5)
+
+
+@tools.params(False, True)
+def test_autotuned_jacobian_mode(ret_outputs):
+    if theano is None:
+        raise unittest.SkipTest('theano or lasagne is not installed')
+    with TemporaryModelDir():
+        predictor = build_bilinear_predictor(autotune_jacobian_mode=True)
+        X, U = get_inputs(4)
+        expected_jac_y, expected_jac_z = get_expected_jacobians(predictor, X, U)
+        jacs = predictor.jacobian(['y', 'z'], 'u', [X, U], ret_outputs=ret_outputs)
+        if ret_outputs:
+            (jac_y, jac_z), _ = jacs
+        else:
+            jac_y, jac_z = jacs
+        assert np.allclose(jac_y, expected_jac_y, atol=1e-5)
+        assert np.allclose(jac_z, expected_jac_z, atol=1e-5)
+        # the modes are timed with the functions that are used afterwards, and
+        # the reference jacobians use the default mode explicitly
+        for names, wrt_name, ret_outputs_, mode in predictor.jac_fns.keys():
+            assert ret_outputs_ == ret_outputs
+            assert mode in ('forward', 'batched', 'reverse', 'linear')
+        with open(predictor.get_jacobian_modes_fname()) as jacobian_modes_file:
+            jacobian_modes = yaml.load(jacobian_modes_file, Loader=Python2to3Loader)
+        key, = jacobian_modes.keys()
+        assert key.endswith('/outputs') == ret_outputs
+        assert jacobian_modes[key]['mode'] in jacobian_modes[key]['times']
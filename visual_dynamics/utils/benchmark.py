@@ -0,0 +1,211 @@
+"""
+Benchmarks of the throughput of the data pipeline, i.e. of reading,
+decoding and preprocessing minibatches from containers with DataGenerator
+and the parallel generators.
+"""
+from __future__ import division, print_function
+
+import itertools
+import multiprocessing
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import yaml
+
+from visual_dynamics.spaces import BoxSpace
+from visual_dynamics.utils import config
+from visual_dynamics.utils.container import ImageDataContainer
+from visual_dynamics.utils.generator import DataGenerator, ParallelGenerator, MultiprocessGenerator
+
+
+PARALLEL_GENERATORS = {'thread': ParallelGenerator, 'process': MultiprocessGenerator}
+
+
+def generate_synthetic_container(data_dir, num_trajs, num_steps, image_shape, image_storage='file', action_dim=4,
+                                 seed=0):
+    """
+    Creates a container with random images and actions, where each
+    trajectory has num_steps actions and num_steps + 1 images. The images
+    are smooth (upsampled noise) so that their JPEG encodings have realistic
+    sizes.
+    """
+    random_state = np.random.RandomState(seed)
+    height, width = image_shape[:2]
+    low_res_shape = (max(height // 8, 1), max(width // 8, 1)) + tuple(image_shape[2:])
+    with ImageDataContainer(data_dir, 'x', image_storage=image_storage) as container:
+        container.reserve(['image'], (num_trajs, num_steps + 1))
+        container.reserve(['action'], (num_trajs, num_steps))
+        for traj_iter in range(num_trajs):
+            for step_iter in range(num_steps + 1):
+                image = random_state.uniform(0, 256, size=low_res_shape)
+                image = np.repeat(np.repeat(image, 8, axis=0), 8, axis=1)[:height, :width]
+                image += random_state.uniform(-16, 16, size=image.shape)
+                image = np.clip(image, 0, 255).astype(np.uint8)
+                container.add_datum(traj_iter, step_iter, image=image)
+                if step_iter < num_steps:
+                    action = random_state.uniform(-1, 1, size=action_dim).astype(np.float32)
+                    container.add_datum(traj_iter, step_iter, action=action)
+
+
+def load_transformers(transformers_fname, action_dim=4):
+    """
+    Loads the transformers of the images and actions of a transformers config
+    file (e.g. config/transformer/transformer_32.yaml). The action space of
+    the synthetic containers is the box [-1, 1]^action_dim.
+    """
+    with open(transformers_fname) as transformers_file:
+        transformers_config = yaml.load(transformers_file, Loader=config.Python2to3Loader)
+    transformers = dict()
+    for data_name in ['image', 'action']:
+        if data_name not in transformers_config:
+            continue
+        if data_name == 'action':
+            replace_config = {'space': BoxSpace(-1, 1, shape=(action_dim,))}
+        else:
+            replace_config = {}
+        transformers[data_name] = config.from_config(transformers_config[data_name], replace_config=replace_config)
+    return transformers
+
+
+def get_io_counters(pids):
+    """
+    Returns the sum over the given processes of the number of bytes that
+    they read through system calls (rchar, which also counts the reads that
+    are served from the page cache) and from the storage (read_bytes). Reads
+    through memory maps are not counted. The counters are zero if they are
+    not available (e.g. on systems without /proc).
+    """
+    counters = dict(rchar=0, read_bytes=0)
+    for pid in pids:
+        try:
+            with open('/proc/%d/io' % pid) as io_file:
+                for line in io_file:
+                    key, value = line.split(':')
+                    if key in counters:
+                        counters[key] += int(value)
+        except (IOError, OSError):
+            continue
+    return counters
+
+
+def benchmark_generator(container_fnames, transformers=None, batch_size=32, shuffle=True, nb_worker=0,
+                        parallel='process', num_batches=50, num_warmup_batches=2,
+                        data_name_offset_pairs=None, **generator_kwargs):
+    """
+    Measures the throughput of a DataGenerator of the given containers. If
+    nb_worker is positive, the generator is wrapped in the parallel
+    generator given by parallel ('process' or 'thread') with that many
+    workers.
+
+    Returns a dict with the number of samples per second, the percentiles of
+    the latencies of the minibatches (in seconds), the number of bytes read
+    by this process and its workers and the CPU utilization (CPU time of
+    this process and its workers over the wall time, so it can be larger
+    than 1).
+    """
+    if data_name_offset_pairs is None:
+        data_name_offset_pairs = [('image', 0), ('action', 0), ('image', 1)]
+    start_times = os.times()
+    start_wall_time = time.time()
+    generator = DataGenerator(container_fnames,
+                              data_name_offset_pairs=data_name_offset_pairs,
+                              transformers=transformers,
+                              batch_size=batch_size,
+                              shuffle=shuffle,
+                              dtype=np.float32,
+                              **generator_kwargs)
+    if nb_worker > 0:
+        generator = PARALLEL_GENERATORS[parallel](generator, nb_worker=nb_worker)
+    try:
+        for _ in range(num_warmup_batches):
+            next(generator)
+        pids = [os.getpid()] + [process.pid for process in multiprocessing.active_children()]
+        start_io_counters = get_io_counters(pids)
+        latencies = []
+        batches_start_time = time.time()
+        for _ in range(num_batches):
+            batch_start_time = time.time()
+            next(generator)
+            latencies.append(time.time() - batch_start_time)
+        batches_time = time.time() - batches_start_time
+        io_counters = get_io_counters(pids)
+    finally:
+        generator.close()
+    # the CPU times of the worker processes are only accounted once they have been joined by close()
+    end_times = os.times()
+    cpu_time = sum(end_time - start_time for end_time, start_time in zip(end_times[:4], start_times[:4]))
+    return dict(samples_per_sec=num_batches * batch_size / batches_time,
+                batches_per_sec=num_batches / batches_time,
+                latency_p50=float(np.percentile(latencies, 50)),
+                latency_p99=float(np.percentile(latencies, 99)),
+                latency_mean=float(np.mean(latencies)),
+                bytes_read=io_counters['rchar'] - start_io_counters['rchar'],
+                storage_bytes_read=io_counters['read_bytes'] - start_io_counters['read_bytes'],
+                cpu_utilization=cpu_time / (time.time() - start_wall_time),
+                num_batches=num_batches)
+
+
+def run_benchmarks(data_dir, image_storages=('file', 'hdf5', 'raw'), transformers_fnames=(None,),
+                   nb_workers=(0,), batch_sizes=(32,), shuffles=(True,), parallels=('process',),
+                   num_containers=4, num_trajs=10, num_steps=10, image_shape=(256, 256, 3), num_batches=50,
+                   callback=None):
+    """
+    Runs benchmark_generator for every combination of the given settings on
+    synthetic containers, which are generated in data_dir (one set per image
+    storage) unless they already exist there. A transformers file name of
+    None uses no transformers. callback is called with each result.
+
+    Returns the list of results, where each result is the dict of metrics
+    along with the settings it was measured with.
+    """
+    results = []
+    for image_storage in image_storages:
+        container_fnames = []
+        for container_ind in range(num_containers):
+            container_fname = os.path.join(data_dir, '%s_%dx%dx%s_%d' % (image_storage, num_trajs, num_steps,
+                                                                      'x'.join(map(str, image_shape)),
+                                                                      container_ind))
+            if not os.path.exists(container_fname):
+                generate_synthetic_container(container_fname, num_trajs, num_steps, image_shape,
+                                             image_storage=image_storage, seed=container_ind)
+            container_fnames.append(container_fname)
+        for transformers_fname in transformers_fnames:
+            transformers = load_transformers(transformers_fname) if transformers_fname is not None else None
+            for nb_worker, batch_size, shuffle, parallel in itertools.product(nb_workers, batch_sizes, shuffles,
+                                                                               parallels):
+                if nb_worker == 0 and parallel != parallels[0]:
+                    continue  # the parallel generator is not used without workers
+                result = dict(image_storage=image_storage,
+                              transformers_fname=transformers_fname,
+                              nb_worker=nb_worker,
+                              parallel=parallel if nb_worker > 0 else None,
+                              batch_size=batch_size,
+                              shuffle=shuffle)
+                result.update(benchmark_generator(container_fnames, transformers=transformers,
+                                                  batch_size=batch_size, shuffle=shuffle, nb_worker=nb_worker,
+                                                  parallel=parallel, num_batches=num_batches))
+                results.append(result)
+                if callback is not None:
+                    callback(result)
+    return results
+
+
+def get_environment_info():
+    """
+    Returns information about the code and the machine that the benchmarks
+    ran on, so that results can be compared across commits.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                         stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit,
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                hostname=platform.node(),
+                platform=platform.platform(),
+                python_version=platform.python_version(),
+                cpu_count=multiprocessing.cpu_count())
@@ -0,0 +1,226 @@
+from __future__ import division, print_function
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from visual_dynamics.utils import config
+
+
+def get_hash(*objs):
+    """
+    Returns a hex digest that identifies the given objects. Objects that are
+    not strings are identified by their yaml config.
+    """
+    sha1 = hashlib.sha1()
+    for obj in objs:
+        if not isinstance(obj, str):
+            obj = config.to_yaml(obj)
+        sha1.update(obj.encode('utf-8'))
+        sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def get_data_dir_signature(data_dir):
+    """
+    Returns a string that changes whenever the data of the container in the
+    given directory changes, by comparing the names, sizes and modification
+    times of the directory and of the files in it, i.e. the info and hdf5
+    files and the image files ('file' storage) or the memory-mapped images
+    ('raw' storage).
+    """
+    data_dir = os.path.abspath(data_dir)
+    signature = [data_dir]
+    if os.path.isdir(data_dir):
+        stat = os.stat(data_dir)
+        signature.append('%d:%r' % (stat.st_size, stat.st_mtime))
+        # the files are summarized by a digest since there is a file per image for the 'file' storage
+        sha1 = hashlib.sha1()
+        num_files = 0
+        for fname in sorted(os.listdir(data_dir)):
+            if fname.endswith('.tmp'):  # files that are being written
+                continue
+            full_fname = os.path.join(data_dir, fname)
+            if not os.path.isfile(full_fname):
+                continue
+            stat = os.stat(full_fname)
+            sha1.update(('%s:%d:%r' % (fname, stat.st_size, stat.st_mtime)).encode('utf-8'))
+            sha1.update(b'\0')
+            num_files += 1
+        signature.append('%d files:%s' % (num_files, sha1.hexdigest()))
+    return ';'.join(signature)
+
+
+class PreprocessedDataCache(object):
+    def __init__(self, cache_dir, container, data_name, transformer, dtype=None):
+        """
+        On-disk cache of the preprocessed data of a single name of a
+        container. The preprocessed data is stored in a .npy file (along with
+        another .npy file that marks which data points are valid) that is read
+        and written through a memory map. The data points are preprocessed
+        lazily the first time they are requested, unless build() is called.
+
+        The cache files are identified by a hash of the transformer's config,
+        the dtype and the signature of the container's data, so that a cache
+        is automatically invalidated when any of these change.
+        """
+        self.cache_dir = cache_dir
+        self.data_name = data_name
+        self.transformer = transformer
+        self.dtype = dtype
+        self.data_size = int(container.get_data_size(data_name))
+        key = get_hash(data_name, str(np.dtype(dtype)) if dtype is not None else 'None',
+                       get_data_dir_signature(container.data_dir), transformer)
+        self.data_fname = os.path.join(cache_dir, '%s_%s.npy' % (data_name, key))
+        self.valid_fname = os.path.join(cache_dir, '%s_%s_valid.npy' % (data_name, key))
+        if not os.path.exists(self.valid_fname):
+            self._create_cache_files(container)
+        self.data = np.load(self.data_fname, mmap_mode='r+')
+        self.valid = np.load(self.valid_fname, mmap_mode='r+')
+
+    def _preprocess(self, datum):
+        return np.asarray(self.transformer.preprocess(datum), dtype=self.dtype)
+
+    def _create_cache_files(self, container):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        first_inds = tuple(int(ind) for ind in container.get_inds(0, self.data_name))
+        datum = self._preprocess(container.get_datum(*(first_inds + (self.data_name,))))
+        # create the files with temporary names and rename them once they are complete
+        tmp_suffix = '.%d.tmp' % os.getpid()
+        data = np.lib.format.open_memmap(self.data_fname + tmp_suffix, mode='w+', dtype=datum.dtype,
+                                         shape=(self.data_size,) + datum.shape)
+        del data
+        valid = np.lib.format.open_memmap(self.valid_fname + tmp_suffix, mode='w+', dtype=np.bool_,
+                                          shape=(self.data_size,))
+        valid[...] = False
+        del valid
+        os.rename(self.data_fname + tmp_suffix, self.data_fname)
+        os.rename(self.valid_fname + tmp_suffix, self.valid_fname)
+
+    def get_data(self, container, traj_inds, step_inds):
+        data_inds = container.get_data_inds(traj_inds, step_inds, self.data_name)
+        flat_data_inds = data_inds.reshape(-1)
+        missing_data_inds = np.unique(flat_data_inds[~self.valid[flat_data_inds]])
+        if len(missing_data_inds):
+            self._add_data(container, missing_data_inds)
+        data = np.take(self.data, flat_data_inds, axis=0)
+        return data.reshape(data_inds.shape + data.shape[1:])
+
+    def _add_data(self, container, data_inds):
+        inds = container.get_inds(data_inds, self.data_name)
+        raw_data = container.get_data(*(inds + (self.data_name,)))
+        self.data[data_inds] = np.asarray(self.transformer.preprocess_batch(raw_data), dtype=self.dtype)
+        # make sure the data is written before it's marked as valid
+        self.data.flush()
+        self.valid[data_inds] = True
+        self.valid.flush()
+
+    def build(self, container, batch_size=1000):
+        """
+        Preprocesses all the data points that are not yet in the cache.
+        """
+        missing_data_inds = np.where(~self.valid)[0]
+        for i in range(0, len(missing_data_inds), batch_size):
+            self._add_data(container, missing_data_inds[i:i + batch_size])
+
+    @property
+    def num_valid(self):
+        return int(self.valid.sum())
+
+
+class FrameCache(object):
+    def __init__(self, max_bytes):
+        """
+        Thread-safe in-memory LRU cache of frames (e.g. decoded or
+        preprocessed images) whose total size is bounded by max_bytes. The
+        least recently used frames are evicted when the budget is exceeded
+        and frames that are larger than the budget are never cached.
+
+        The same cache can be shared by several generators (and by the
+        threads of a ParallelGenerator) of the same process. Worker processes
+        that are forked afterwards get their own copy of the cache.
+
+        The cached frames are read-only and the number of hits and misses is
+        counted by get() and get_many().
+        """
+        self.max_bytes = int(max_bytes)
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        frame, = self.get_many([key])
+        return frame
+
+    def get_many(self, keys):
+        """
+        Returns the cached frame of each key, or None for the keys that are
+        not in the cache.
+        """
+        frames = []
+        with self._lock:
+            for key in keys:
+                frame = self._frames.pop(key, None)
+                if frame is None:
+                    self.misses += 1
+                else:
+                    self._frames[key] = frame  # most recently used
+                    self.hits += 1
+                frames.append(frame)
+        return frames
+
+    def put(self, key, frame):
+        self.put_many([key], [frame])
+
+    def put_many(self, keys, frames):
+        # copy the frames so that they don't keep alive the arrays they may be views of
+        frames = [np.array(frame) for frame in frames]
+        with self._lock:
+            for key, frame in zip(keys, frames):
+                if frame.nbytes > self.max_bytes:
+                    continue
+                old_frame = self._frames.pop(key, None)
+                if old_frame is not None:
+                    self.num_bytes -= old_frame.nbytes
+                frame.flags.writeable = False
+                self._frames[key] = frame
+                self.num_bytes += frame.nbytes
+                while self.num_bytes > self.max_bytes:
+                    _, evicted_frame = self._frames.popitem(last=False)
+                    self.num_bytes -= evicted_frame.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.num_bytes = 0
+
+    def reset_counters(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            num_lookups = self.hits + self.misses
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        hit_rate=self.hits / num_lookups if num_lookups else 0.0,
+                        num_frames=len(self._frames),
+                        num_bytes=self.num_bytes,
+                        max_bytes=self.max_bytes)
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _init_worker(self):
+        """
+        Should be called in a newly forked worker process so that it doesn't
+        use the lock of the parent process.
+        """
+        self._lock = threading.Lock()
@@ -3,15 +3,26 @@ from __future__ import division, print_function
 import io
 import os
 import sys
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
 
 import cv2
 import h5py
 import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from visual_dynamics.utils import config
 from visual_dynamics.utils import math_utils
 
 
+# decodes color images directly into RGB order if the installed OpenCV supports it
+IMREAD_COLOR_RGB = getattr(cv2, 'IMREAD_COLOR_RGB', None)
+
+
 def open_23(name, mode='r'):
     if sys.version_info.major == 3:
         return open(name, mode=mode)
@@ -27,11 +38,15 @@ def open_23(name, mode='r'):
 
 
 class DataContainer(object):
+    APPEND_CHUNK_SIZE = 64
+
     def __init__(self, data_dir, mode='r'):
         self.data_dir = self._require_data_dir(data_dir, mode)
         self.mode = mode
         self.info_file = None
         self.hdf5_file = None
+        # the trajectory lengths and the appendable datasets are also accessed by the image write threads
+        self._traj_lengths_lock = threading.RLock()
 
         info_fname = os.path.join(self.data_dir, 'info.yaml')
         self.info_file = open_23(info_fname, mode)
@@ -41,18 +56,22 @@ class DataContainer(object):
             self.info_dict = dict()
         self.data_shapes_dict = self.info_dict.get('data_shapes', None) or dict()
         self.datum_shapes_dict = self.info_dict.get('datum_shapes', None) or dict()
+        self.traj_lengths_dict = self.info_dict.get('traj_lengths', None) or dict()
+        self._traj_offsets_dict = dict()
+        # the info file is flushed whenever a trajectory is started after these many trajectories
+        self._num_flushed_trajs = max([len(traj_lengths) for traj_lengths in self.traj_lengths_dict.values()] or [0])
         data_fname = os.path.join(self.data_dir, 'data.h5')
         self.hdf5_file = h5py.File(data_fname, mode)
 
     def close(self):
+        if self.hdf5_file and self.mode != 'r':
+            self._trim_datasets()
+        if self.info_file and self.mode != 'r':
+            self.flush_info()
+        self._close_files()
+
+    def _close_files(self):
         if self.info_file:
-            if self.mode != 'r':
-                try:
-                    self.add_info(data_shapes=self.data_shapes_dict)
-                    self.add_info(datum_shapes=self.datum_shapes_dict)
-                    config.to_yaml(self.info_dict, self.info_file)
-                except io.UnsupportedOperation:  # container is probably in read mode
-                    pass
             self.info_file.close()
             self.info_file = None
         if self.hdf5_file:
@@ -65,6 +84,24 @@ class DataContainer(object):
     def __exit__(self, *args):
         self.close()
 
+    def flush_info(self):
+        try:
+            self.add_info(data_shapes=self.data_shapes_dict)
+            self.add_info(datum_shapes=self.datum_shapes_dict)
+            with self._traj_lengths_lock:
+                if self.traj_lengths_dict:
+                    self.add_info(traj_lengths=dict((name, list(traj_lengths))
+                                                    for name, traj_lengths in self.traj_lengths_dict.items()))
+            # the info file has either been read or flushed before, so overwrite it
+            self.info_file.seek(0)
+            self.info_file.truncate()
+            config.to_yaml(self.info_dict, self.info_file)
+            self.info_file.flush()
+            if self.hdf5_file:
+                self.hdf5_file.flush()
+        except io.UnsupportedOperation:  # container is probably in read mode
+            pass
+
     def add_info(self, **info_dict):
         self.info_dict.update(**info_dict)
 
@@ -81,6 +118,17 @@ class DataContainer(object):
         return info
 
     def reserve(self, names, shape):
+        """
+        Reserves the data of the given names with the given shape, which is
+        usually (num_trajs, num_steps). A shape of (num_trajs, None) or
+        (None, None) makes the data appendable: the trajectories can have
+        different lengths and the datasets grow as the data points are added,
+        where each data point should be either the next step of the last
+        trajectory or the first step of a new trajectory. The length of each
+        trajectory is recorded in the info file, which is flushed whenever a
+        new trajectory is started so that the previous trajectories can be
+        read even if the container is not closed.
+        """
         if isinstance(names, str):
             names = list([names])
         else:
@@ -89,6 +137,9 @@ class DataContainer(object):
             shape = tuple(shape)
         except TypeError:
             shape = tuple((shape,))
+        if None in shape and (len(shape) != 2 or shape[1] is not None):
+            raise ValueError('only the shapes (num_trajs, None) and (None, None) can be used for appendable data, '
+                             'but shape %s was given' % (shape,))
         for name in names:
             if name in self.data_shapes_dict and self.data_shapes_dict[name] != shape:
                 raise ValueError('unable to reserve for %s since it was already reserved with shape %s,'
@@ -101,12 +152,66 @@ class DataContainer(object):
                 raise ValueError('unable to add datum %s with shape %s since the shape %s was expected' %
                                  (name, value.shape, self.datum_shapes_dict[name]))
             self.datum_shapes_dict[name] = value.shape
-            datum_size = self.get_data_size(name)
-            shape = (datum_size, ) + value.shape
-            dset = self.hdf5_file.require_dataset(name, shape, value.dtype, exact=True)
-            datum_ind = self._get_datum_ind(*(inds + (name,)))
+            datum_ind = self._require_datum_ind(*(inds + (name,)))
+            dset = self._require_dataset(name, value.shape, value.dtype)
             dset[datum_ind] = value
 
+    def _require_datum_ind(self, *inds_and_name):
+        """
+        Like _get_datum_ind, but for appendable data, it first extends the
+        last trajectory or starts a new trajectory if the indices are the ones
+        of the next data point.
+        """
+        inds, name = inds_and_name[:-1], inds_and_name[-1]
+        if self.is_appendable(name) and len(inds) == 2:
+            traj_ind, step_ind = inds
+            started_traj = False
+            with self._traj_lengths_lock:
+                traj_lengths = self.traj_lengths_dict.setdefault(name, [])
+                if traj_ind >= len(traj_lengths) and step_ind == 0:
+                    max_num_trajs = self.get_data_shape(name)[0]
+                    if max_num_trajs is not None and traj_ind >= max_num_trajs:
+                        raise IndexError('index at position 0 is out of range for entry with name %s' % name)
+                    # trajectories that are skipped have no data points for this name
+                    traj_lengths.extend([0] * (traj_ind + 1 - len(traj_lengths)))
+                    started_traj = traj_ind >= self._num_flushed_trajs
+                if traj_ind == len(traj_lengths) - 1 and step_ind == traj_lengths[-1]:
+                    traj_lengths[-1] += 1
+                    self._traj_offsets_dict.pop(name, None)
+            if started_traj:
+                self._num_flushed_trajs = traj_ind + 1
+                self.flush_info()
+        return self._get_datum_ind(*inds_and_name)
+
+    def _require_dataset(self, name, datum_shape, dtype, **kwargs):
+        if not self.is_appendable(name):
+            return self.hdf5_file.require_dataset(name, (self.get_data_size(name),) + tuple(datum_shape), dtype,
+                                                  exact=True, **kwargs)
+        with self._traj_lengths_lock:
+            data_size = self.get_data_size(name)
+            # grow the dataset by whole chunks of data points so that it isn't resized for every data point
+            alloc_size = -(-data_size // self.APPEND_CHUNK_SIZE) * self.APPEND_CHUNK_SIZE
+            if name in self.hdf5_file:
+                dset = self.hdf5_file[name]
+                if dset.shape[0] < data_size:
+                    dset.resize(alloc_size, axis=0)
+            else:
+                kwargs.setdefault('chunks', (self.APPEND_CHUNK_SIZE,) + tuple(datum_shape))
+                dset = self.hdf5_file.create_dataset(name, (alloc_size,) + tuple(datum_shape), dtype,
+                                                     maxshape=(None,) + tuple(datum_shape), **kwargs)
+        return dset
+
+    def _trim_datasets(self):
+        """
+        Shrinks the appendable datasets to the number of data points that
+        were added.
+        """
+        for name in self.data_shapes_dict.keys():
+            if self.is_appendable(name) and name in self.hdf5_file:
+                dset = self.hdf5_file[name]
+                if dset.shape[0] > self.get_data_size(name):
+                    dset.resize(self.get_data_size(name), axis=0)
+
     def get_datum(self, *inds_and_datum_names):
         inds, datum_names = inds_and_datum_names[:-1], inds_and_datum_names[-1]
         if isinstance(datum_names, str):
@@ -121,6 +226,34 @@ class DataContainer(object):
             datum, = datum
         return datum
 
+    def get_data(self, traj_inds, step_inds, datum_names):
+        """
+        Batched version of get_datum. The index arrays are broadcasted
+        against each other and the returned data has the broadcasted shape
+        as its leading dimensions. The indices are sorted and de-duplicated
+        so that a single (coalesced) read is done per data name.
+        """
+        if isinstance(datum_names, str):
+            names = list([datum_names])
+        else:
+            names = list(datum_names)
+        data = []
+        for name in names:
+            data_inds = self.get_data_inds(traj_inds, step_inds, name)
+            data.append(self._read_data(name, data_inds))
+        if isinstance(datum_names, str):
+            data, = data
+        return data
+
+    def _read_data(self, name, data_inds):
+        unique_data_inds, inverse_inds = np.unique(data_inds, return_inverse=True)
+        dset = self.hdf5_file[name]
+        data = np.empty((data_inds.size,) + dset.shape[1:], dtype=dset.dtype)
+        if data_inds.size:
+            unique_data = dset[unique_data_inds]  # hdf5 requires the indices to be increasing
+            np.take(unique_data, inverse_inds.reshape(-1), axis=0, out=data)
+        return data.reshape(data_inds.shape + data.shape[1:])
+
     def get_datum_shape(self, name):
         shape = self.datum_shapes_dict.get(name, None)
         if shape is None:
@@ -134,10 +267,63 @@ class DataContainer(object):
         return shape
 
     def get_data_size(self, name):
+        if self.is_appendable(name):
+            return int(self.get_traj_lengths(name).sum())
         return np.prod(self.get_data_shape(name))
 
+    def is_appendable(self, name):
+        return None in self.get_data_shape(name)
+
+    def get_traj_lengths(self, name):
+        """
+        Returns the number of steps of each trajectory of the given name.
+        """
+        if self.is_appendable(name):
+            with self._traj_lengths_lock:
+                return np.array(self.traj_lengths_dict.get(name, []), dtype=int)
+        shape = self.get_data_shape(name)
+        if len(shape) != 2:
+            raise ValueError('data with name %s has shape %s, which is not of the form (num_trajs, num_steps)' %
+                             (name, shape))
+        num_trajs, num_steps = shape
+        return np.array([num_steps] * num_trajs, dtype=int)
+
+    def _get_traj_offsets(self, name):
+        with self._traj_lengths_lock:
+            traj_offsets = self._traj_offsets_dict.get(name)
+            if traj_offsets is None:
+                traj_offsets = np.r_[0, np.cumsum(self.get_traj_lengths(name))].astype(int)
+                self._traj_offsets_dict[name] = traj_offsets
+        return traj_offsets
+
+    def _iter_inds(self, name):
+        """
+        Iterates over the indices of all the data points of the given name in
+        the order of their flat indices.
+        """
+        if self.is_appendable(name):
+            for traj_ind, traj_length in enumerate(self.get_traj_lengths(name)):
+                for step_ind in range(traj_length):
+                    yield (traj_ind, step_ind)
+        else:
+            for inds in np.ndindex(*self.get_data_shape(name)):
+                yield inds
+
+    def get_inds(self, data_inds, name):
+        """
+        Inverse of get_data_inds. Returns a tuple of index arrays.
+        """
+        data_inds = np.asarray(data_inds, dtype=int)
+        if self.is_appendable(name):
+            traj_offsets = self._get_traj_offsets(name)
+            traj_inds = np.searchsorted(traj_offsets[1:], data_inds, side='right')
+            return traj_inds, data_inds - traj_offsets[traj_inds]
+        return np.unravel_index(data_inds, self.get_data_shape(name))
+
     def _get_canonical_inds(self, *inds_and_name):
         inds, name = inds_and_name[:-1], inds_and_name[-1]
+        if self.is_appendable(name):
+            return tuple(int(ind) for ind in self.get_inds(self.get_data_inds(*inds_and_name), name))
         inds = list(inds)
         shape = self.get_data_shape(name)
         for i, ind in enumerate(inds):
@@ -147,6 +333,9 @@ class DataContainer(object):
 
     def _check_ind_range(self, *inds_and_name):
         inds, name = inds_and_name[:-1], inds_and_name[-1]
+        if self.is_appendable(name):
+            self.get_data_inds(*inds_and_name)  # raises an IndexError if any index is out of range
+            return
         shape = self.get_data_shape(name)
         if len(inds) != len(shape):
             raise IndexError('the number of indices does not match the number of dimensions of the data')
@@ -156,6 +345,8 @@ class DataContainer(object):
 
     def _get_datum_ind(self, *inds_and_name):
         inds, name = inds_and_name[:-1], inds_and_name[-1]
+        if self.is_appendable(name):
+            return int(self.get_data_inds(*inds_and_name))
         inds = self._get_canonical_inds(*(inds + (name,)))
         self._check_ind_range(*(inds + (name,)))
         shape = self.get_data_shape(name)
@@ -166,6 +357,34 @@ class DataContainer(object):
         assert 0 <= datum_ind < self.get_data_size(name)
         return datum_ind
 
+    def get_data_inds(self, *inds_and_name):
+        """
+        Vectorized version of _get_datum_ind for (broadcastable) arrays of indices.
+        """
+        inds, name = inds_and_name[:-1], inds_and_name[-1]
+        shape = self.get_data_shape(name)
+        if len(inds) != len(shape):
+            raise IndexError('the number of indices does not match the number of dimensions of the data')
+        inds = np.broadcast_arrays(*[np.asarray(ind, dtype=int) for ind in inds])
+        if self.is_appendable(name):
+            traj_inds, step_inds = inds
+            traj_lengths = self.get_traj_lengths(name)
+            traj_inds = np.where(traj_inds < 0, traj_inds + len(traj_lengths), traj_inds)
+            if not np.all((0 <= traj_inds) & (traj_inds < len(traj_lengths))):
+                raise IndexError('index at position 0 is out of range for entry with name %s' % name)
+            traj_lengths = traj_lengths[traj_inds]
+            step_inds = np.where(step_inds < 0, step_inds + traj_lengths, step_inds)
+            if not np.all((0 <= step_inds) & (step_inds < traj_lengths)):
+                raise IndexError('index at position 1 is out of range for entry with name %s' % name)
+            return self._get_traj_offsets(name)[traj_inds] + step_inds
+        canonical_inds = []
+        for i, (ind, dim) in enumerate(zip(inds, shape)):
+            ind = np.where(ind < 0, ind + dim, ind)
+            if not np.all((0 <= ind) & (ind < dim)):
+                raise IndexError('index at position %d is out of range for entry with name %s' % (i, name))
+            canonical_inds.append(ind)
+        return np.ravel_multi_index(canonical_inds, shape)
+
     def _get_datum_inds(self, datum_ind, name):
         assert 0 <= datum_ind < self.get_data_size(name)
         shape = self.get_data_shape(name)
@@ -201,6 +420,135 @@ class DataContainer(object):
 
 
 class ImageDataContainer(DataContainer):
+    IMAGE_STORAGES = ('file', 'hdf5', 'raw')
+    DEPTH_STORAGES = ('packed', 'float16', 'uint16_mm')
+
+    def __init__(self, data_dir, mode='r', image_storage=None, depth_storage=None, num_write_threads=0,
+                 max_queued_writes=16, num_decode_threads=0):
+        """
+        Data container that stores the data whose name ends with 'image' as
+        images.
+
+        Args:
+            image_storage: 'file' stores each image in its own JPEG file in
+                the data directory. 'hdf5' stores the encoded bytes of the
+                images in variable-length datasets of the hdf5 file (chunked
+                per trajectory). 'raw' stores the decoded images of each name
+                in a fixed-shape .npy file that is read through a memory map,
+                so that reading the images doesn't require any decoding. The
+                storage is recorded in the info file so that it only needs to
+                be specified when creating a container.
+            depth_storage: how the data whose name ends with 'depth_image'
+                is stored. 'packed' packs the depths into 24-bit fixed point
+                images that are stored like the other images, which is lossy
+                for the 'file' and 'hdf5' storages. 'float16' and 'uint16_mm'
+                (depths in millimeters) store the depths as arrays, in the
+                hdf5 file (losslessly compressed) or, for the 'raw' storage,
+                in the .npy file, so that they are decoded with a single cast.
+                Defaults to 'float16' for new containers and to 'packed' for
+                containers that were created before this option existed.
+            num_write_threads: if positive, the images are encoded and
+                written asynchronously by this many threads, so that
+                add_datum doesn't block on the encoding. The images of the
+                same data point are always written by the same thread (in
+                the order they were added) and close() waits for all the
+                images to be written. Errors that happen while writing the
+                images are raised by close().
+            max_queued_writes: maximum number of images that can be queued
+                per write thread before add_datum blocks.
+            num_decode_threads: if positive, the images of a batched read
+                (get_data) are decoded by a pool of this many threads. The
+                images are decoded directly into the returned array.
+        """
+        self.num_decode_threads = num_decode_threads
+        self._decode_pool = None
+        self._decode_pool_lock = threading.Lock()
+        self._raw_images_dict = dict()
+        self._write_queues = []
+        self._write_threads = []
+        self._write_errors = []
+        super(ImageDataContainer, self).__init__(data_dir, mode=mode)
+        try:
+            self._init_storages(image_storage, depth_storage)
+        except ValueError:
+            # the storages are checked after the files are opened, so close them without flushing the info
+            self._close_files()
+            raise
+        if self.mode != 'r':
+            self.add_info(image_storage=self.image_storage)
+            self.add_info(depth_storage=self.depth_storage)
+            # raw images are copied into a memory map without encoding them, so they are always written synchronously
+            if self.image_storage != 'raw':
+                for _ in range(num_write_threads):
+                    write_queue = queue.Queue(maxsize=max_queued_writes)
+                    write_thread = threading.Thread(target=self._write_images_task, args=(write_queue,))
+                    write_thread.daemon = True
+                    write_thread.start()
+                    self._write_queues.append(write_queue)
+                    self._write_threads.append(write_thread)
+
+    def _init_storages(self, image_storage, depth_storage):
+        """
+        Sets the image and depth storages after checking them against the
+        ones recorded in the info file.
+        """
+        info_image_storage = self.info_dict.get('image_storage', 'file')
+        if image_storage is None:
+            image_storage = info_image_storage
+        elif image_storage != info_image_storage and (self.mode == 'r' or 'image_storage' in self.info_dict):
+            raise ValueError('unable to use image storage %s since the container uses image storage %s' %
+                             (image_storage, info_image_storage))
+        if image_storage not in self.IMAGE_STORAGES:
+            raise ValueError('image storage %s not recognized' % image_storage)
+        self.image_storage = image_storage
+        if 'depth_storage' in self.info_dict or self.mode == 'r':
+            info_depth_storage = self.info_dict.get('depth_storage', 'packed')
+        elif self.info_dict:  # existing container with packed depth images
+            info_depth_storage = 'packed'
+        else:
+            info_depth_storage = None
+        if depth_storage is None:
+            depth_storage = info_depth_storage or 'float16'
+        elif info_depth_storage is not None and depth_storage != info_depth_storage:
+            raise ValueError('unable to use depth storage %s since the container uses depth storage %s' %
+                             (depth_storage, info_depth_storage))
+        if depth_storage not in self.DEPTH_STORAGES:
+            raise ValueError('depth storage %s not recognized' % depth_storage)
+        self.depth_storage = depth_storage
+
+    def close(self):
+        self._stop_write_threads()
+        if self._decode_pool is not None:
+            self._decode_pool.close()
+            self._decode_pool.join()
+            self._decode_pool = None
+        write_errors, self._write_errors = self._write_errors, []
+        self._close_raw_images()
+        super(ImageDataContainer, self).close()
+        if write_errors:
+            inds_and_name, error = write_errors[0]
+            raise IOError('failed to write %d image(s); the error for image %r was:\n%s' %
+                          (len(write_errors), inds_and_name, error))
+
+    def _write_images_task(self, write_queue):
+        while True:
+            task = write_queue.get()
+            if task is None:
+                break
+            image, inds_and_name = task
+            try:
+                self._write_image(image, *inds_and_name)
+            except Exception:
+                self._write_errors.append((inds_and_name, traceback.format_exc()))
+
+    def _stop_write_threads(self):
+        for write_queue in self._write_queues:
+            write_queue.put(None)
+        for write_thread in self._write_threads:
+            write_thread.join()
+        self._write_queues = []
+        self._write_threads = []
+
     def add_datum(self, *inds, **datum_dict):
         other_dict = dict([item for item in datum_dict.items() if not item[0].endswith('image')])
         super(ImageDataContainer, self).add_datum(*inds, **other_dict)
@@ -210,13 +558,64 @@ class ImageDataContainer(DataContainer):
                 raise ValueError('unable to add datum %s with shape %s since the shape %s was expected' %
                                  (image_name, image.shape, self.datum_shapes_dict[image_name]))
             self.datum_shapes_dict[image_name] = image.shape
-            image_fname = self._get_image_fname(*(inds + (image_name,)))
-            if image.dtype == np.uint8:
-                if image.ndim == 3 and image.shape[2] == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            inds_and_name = inds + (image_name,)
+            if self.image_storage == 'raw' and self.is_appendable(image_name):
+                raise ValueError('unable to add image %s since appendable data cannot use the raw image storage; '
+                                 'convert the image storage once the data has been added' % image_name)
+            datum_ind = self._require_datum_ind(*inds_and_name)  # check the indices before queueing the image
+            if self._write_queues and not self._is_array_image(image_name):
+                if self.image_storage == 'hdf5':
+                    self._require_image_bytes_dataset(image_name)
+                # copy the image in case the caller modifies it before it is written
+                self._write_queues[datum_ind % len(self._write_queues)].put((np.array(image), inds_and_name))
+            else:
+                self._write_image(image, *inds_and_name)
+
+    def convert_image_storage(self, image_storage):
+        """
+        Moves the images to the given image storage. The encoded images are
+        moved between the 'file' and 'hdf5' storages without re-encoding them.
+        The container should be opened in 'r+' mode. The images are only
+        removed from the previous storage after the info file has been
+        updated.
+        """
+        if image_storage not in self.IMAGE_STORAGES:
+            raise ValueError('image storage %s not recognized' % image_storage)
+        if image_storage == self.image_storage:
+            return
+        # depth images that are stored as arrays stay in the hdf5 file unless they are moved to or from the raw storage
+        image_names = [name for name in self.data_shapes_dict.keys() if name.endswith('image') and
+                       (not self._is_array_image(name) or 'raw' in (image_storage, self.image_storage))]
+        for image_name in image_names:
+            for datum_ind, inds in enumerate(self._iter_inds(image_name)):
+                inds_and_name = inds + (image_name,)
+                if not self._has_image(*inds_and_name):
+                    continue
+                if image_storage == 'hdf5' and self.image_storage == 'file':
+                    image_bytes = np.fromfile(self._get_image_fname(*inds_and_name), dtype=np.uint8)
+                    self._require_image_bytes_dataset(image_name)[datum_ind] = image_bytes
+                elif image_storage == 'file' and self.image_storage == 'hdf5':
+                    self.hdf5_file[image_name][datum_ind].tofile(self._get_image_fname(*inds_and_name))
+                else:
+                    image = self._read_image(*inds_and_name)
+                    self._write_image(image, *inds_and_name, image_storage=image_storage)
+        self.hdf5_file.flush()
+        self._close_raw_images()
+        prev_image_storage, self.image_storage = self.image_storage, image_storage
+        self.add_info(image_storage=image_storage)
+        self.flush_info()
+        for image_name in image_names:
+            if self._is_array_image(image_name) and prev_image_storage != 'raw':
+                del self.hdf5_file[image_name]
+            elif prev_image_storage == 'file':
+                for inds in self._iter_inds(image_name):
+                    image_fname = self._get_image_fname(*(inds + (image_name,)))
+                    if os.path.isfile(image_fname):
+                        os.remove(image_fname)
+            elif prev_image_storage == 'hdf5':
+                del self.hdf5_file[image_name]
             else:
-                image = math_utils.pack_image(image)
-            cv2.imwrite(image_fname, image, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
+                os.remove(self._get_raw_images_fname(image_name))
 
     def _get_image_fname(self, *inds_and_name, **kwargs):
         inds, name = inds_and_name[:-1], inds_and_name[-1]
@@ -226,12 +625,111 @@ class ImageDataContainer(DataContainer):
         shape = self.get_data_shape(name)
         image_fmt = '%s'
         for dim in shape:
-            image_fmt += '_%0{:d}d'.format(len(str(dim-1)))
+            if dim is None:  # appendable data
+                image_fmt += '_%d'
+            else:
+                image_fmt += '_%0{:d}d'.format(len(str(dim-1)))
         image_fmt += ext
         image_fname = image_fmt % ((name,) + inds)
         image_fname = os.path.join(self.data_dir, image_fname)
         return image_fname
 
+    def _get_raw_images_fname(self, name):
+        return os.path.join(self.data_dir, name + '.npy')
+
+    def _require_image_bytes_dataset(self, name):
+        dtype = h5py.special_dtype(vlen=np.dtype(np.uint8))
+        if self.is_appendable(name):
+            return self._require_dataset(name, (), dtype)
+        if name in self.hdf5_file:
+            return self.hdf5_file[name]
+        shape = self.get_data_shape(name)
+        return self.hdf5_file.create_dataset(name, (self.get_data_size(name),), dtype=dtype, chunks=(shape[-1],))
+
+    def _require_raw_images(self, name, image=None):
+        """
+        Returns a memory map of the raw images of the given name, with the
+        data indices flattened into the leading dimension.
+        """
+        raw_images = self._raw_images_dict.get(name)
+        if raw_images is None:
+            if self.is_appendable(name):
+                data_shape = (self.get_data_size(name),)
+            else:
+                data_shape = tuple(self.get_data_shape(name))
+            raw_images_fname = self._get_raw_images_fname(name)
+            if os.path.isfile(raw_images_fname):
+                raw_images = np.load(raw_images_fname, mmap_mode='r' if self.mode == 'r' else 'r+')
+            elif image is not None:
+                raw_images = np.lib.format.open_memmap(raw_images_fname, mode='w+', dtype=image.dtype,
+                                                       shape=data_shape + image.shape)
+            else:
+                raise IOError('raw images file %s does not exist' % raw_images_fname)
+            raw_images = raw_images.reshape((self.get_data_size(name),) + raw_images.shape[len(data_shape):])
+            self._raw_images_dict[name] = raw_images
+        return raw_images
+
+    def _close_raw_images(self):
+        for raw_images in self._raw_images_dict.values():
+            if raw_images.flags.writeable:
+                raw_images.flush()
+        self._raw_images_dict = dict()
+
+    def _is_array_image(self, name):
+        return name.endswith('depth_image') and self.depth_storage != 'packed'
+
+    def _encode_depth_image(self, image):
+        if self.depth_storage == 'float16':
+            return np.asarray(image, dtype=np.float16)
+        else:
+            return np.clip(np.rint(np.asarray(image) * 1000.0), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
+    def _decode_depth_images(self, images):
+        images = images.astype(np.float32)
+        if self.depth_storage == 'uint16_mm':
+            np.divide(images, 1000.0, out=images)
+        return images
+
+    def _has_image(self, *inds_and_name, **kwargs):
+        name = inds_and_name[-1]
+        image_storage = kwargs.get('image_storage', self.image_storage)
+        if self._is_array_image(name) and image_storage != 'raw':
+            return name in self.hdf5_file
+        if image_storage == 'file':
+            return os.path.isfile(self._get_image_fname(*inds_and_name))
+        elif image_storage == 'hdf5':
+            return name in self.hdf5_file and len(self.hdf5_file[name][self._get_datum_ind(*inds_and_name)]) > 0
+        else:
+            return os.path.isfile(self._get_raw_images_fname(name))
+
+    def _write_image(self, image, *inds_and_name, **kwargs):
+        name = inds_and_name[-1]
+        image_storage = kwargs.get('image_storage', self.image_storage)
+        if self._is_array_image(name):
+            image = self._encode_depth_image(image)
+            if image_storage != 'raw':
+                # one chunk per depth image with a fast compression filter
+                dset = self._require_dataset(name, image.shape, image.dtype, chunks=(1,) + image.shape,
+                                             compression='lzf', shuffle=True)
+                dset[self._get_datum_ind(*inds_and_name)] = image
+                return
+        if image_storage == 'raw':
+            self._require_raw_images(name, image)[self._get_datum_ind(*inds_and_name)] = image
+            return
+        if image.dtype == np.uint8:
+            if image.ndim == 3 and image.shape[2] == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        else:
+            image = math_utils.pack_image(image)
+        if image_storage == 'file':
+            image_fname = self._get_image_fname(*inds_and_name)
+            if not cv2.imwrite(image_fname, image, [int(cv2.IMWRITE_JPEG_QUALITY), 100]):
+                raise IOError('failed to write image %s' % image_fname)
+        else:
+            _, image_bytes = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
+            dset = self._require_image_bytes_dataset(name)
+            dset[self._get_datum_ind(*inds_and_name)] = image_bytes.reshape(-1)
+
     def get_datum(self, *inds_and_datum_names):
         inds, datum_names = inds_and_datum_names[:-1], inds_and_datum_names[-1]
         if isinstance(datum_names, str):
@@ -243,17 +741,7 @@ class ImageDataContainer(DataContainer):
         image_names = [name for name in names if name.endswith('image')]
         image_datum = []
         for image_name in image_names:
-            image_fname = self._get_image_fname(*(inds + (image_name,)))
-            if not os.path.isfile(image_fname):
-                raise IOError('image file %s does not exist' % image_fname)
-            image = cv2.imread(image_fname)
-            if not image_name.endswith('depth_image'):
-                if image.ndim == 3 and image.shape[2] == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            else:
-
-                image = math_utils.unpack_image(image)
-            image_datum.append(image)
+            image_datum.append(self._read_image(*(inds + (image_name,))))
         # reorder items to follow the order of datum_names
         datum = []
         for datum_name in names:
@@ -265,31 +753,211 @@ class ImageDataContainer(DataContainer):
             datum, = datum
         return datum
 
+    def get_data(self, traj_inds, step_inds, datum_names):
+        if isinstance(datum_names, str):
+            names = list([datum_names])
+        else:
+            names = list(datum_names)
+        other_names = [name for name in names if not name.endswith('image')]
+        other_data = super(ImageDataContainer, self).get_data(traj_inds, step_inds, other_names)
+        image_names = [name for name in names if name.endswith('image')]
+        image_data = []
+        for image_name in image_names:
+            data_inds = self.get_data_inds(traj_inds, step_inds, image_name)
+            image_data.append(self._read_images(image_name, data_inds))
+        # reorder items to follow the order of datum_names
+        data = []
+        for datum_name in names:
+            if datum_name.endswith('image'):
+                data.append(image_data.pop(0))
+            else:
+                data.append(other_data.pop(0))
+        if isinstance(datum_names, str):
+            data, = data
+        return data
+
+    def _read_image(self, *inds_and_name):
+        name = inds_and_name[-1]
+        if self._is_array_image(name):
+            if self.image_storage == 'raw':
+                image = self._require_raw_images(name)[self._get_datum_ind(*inds_and_name)]
+            else:
+                image = self.hdf5_file[name][self._get_datum_ind(*inds_and_name)]
+            return self._decode_depth_images(image)
+        if self.image_storage == 'file':
+            image_bytes = self._read_image_file_bytes(*inds_and_name)
+        elif self.image_storage == 'hdf5':
+            image_bytes = self.hdf5_file[name][self._get_datum_ind(*inds_and_name)]
+        else:
+            return np.array(self._require_raw_images(name)[self._get_datum_ind(*inds_and_name)])
+        return self._decode_image_bytes(image_bytes, *inds_and_name)
+
+    def _read_image_file_bytes(self, *inds_and_name):
+        image_fname = self._get_image_fname(*inds_and_name)
+        if not os.path.isfile(image_fname):
+            raise IOError('image file %s does not exist' % image_fname)
+        return np.fromfile(image_fname, dtype=np.uint8)
+
+    def _decode_image_bytes(self, image_bytes, *inds_and_name, **kwargs):
+        """
+        Decodes an encoded image into RGB order, or into depths for the
+        packed depth images. If out is specified, the image is decoded into
+        it.
+        """
+        name = inds_and_name[-1]
+        out = kwargs.get('out')
+        if not len(image_bytes):
+            raise IOError('image %s at indices %r does not exist' % (name, inds_and_name[:-1]))
+        if name.endswith('depth_image'):
+            image = math_utils.unpack_image(cv2.imdecode(image_bytes, cv2.IMREAD_COLOR))
+        elif IMREAD_COLOR_RGB is not None:
+            # the color conversion is done by the decoder
+            image = cv2.imdecode(image_bytes, IMREAD_COLOR_RGB)
+        else:
+            return cv2.cvtColor(cv2.imdecode(image_bytes, cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB, dst=out)
+        if out is not None:
+            out[...] = image
+            return out
+        return image
+
+    def _get_decode_pool(self):
+        if self._decode_pool is None:
+            with self._decode_pool_lock:
+                if self._decode_pool is None:
+                    self._decode_pool = ThreadPool(self.num_decode_threads)
+        return self._decode_pool
+
+    def _read_images(self, name, data_inds):
+        if self._is_array_image(name):
+            if self.image_storage == 'raw':
+                images = np.take(self._require_raw_images(name), data_inds.reshape(-1), axis=0)
+                images = images.reshape(data_inds.shape + images.shape[1:])
+            else:
+                images = self._read_data(name, data_inds)
+            return self._decode_depth_images(images)
+        if self.image_storage == 'raw':
+            # single copy out of the memory map and no decoding
+            images = np.take(self._require_raw_images(name), data_inds.reshape(-1), axis=0)
+            return images.reshape(data_inds.shape + images.shape[1:])
+        unique_data_inds, inverse_inds = np.unique(data_inds, return_inverse=True)
+        if not len(unique_data_inds):
+            return np.empty(data_inds.shape + tuple(self.get_datum_shape(name)))
+        unique_inds = self.get_inds(unique_data_inds, name)
+        inds_and_names = [tuple(int(ind[i]) for ind in unique_inds) + (name,) for i in range(len(unique_data_inds))]
+        if self.image_storage == 'hdf5':
+            # read the encoded images of all the indices at once (the hdf5 file is not read concurrently)
+            all_image_bytes = self.hdf5_file[name][unique_data_inds]
+        else:
+            all_image_bytes = None  # the image files are read by the decoding tasks
+
+        def decode_image(i, out=None):
+            if all_image_bytes is None:
+                image_bytes = self._read_image_file_bytes(*inds_and_names[i])
+            else:
+                image_bytes = all_image_bytes[i]
+            return self._decode_image_bytes(image_bytes, *inds_and_names[i], out=out)
+
+        # the first image determines the shape and dtype of the preallocated images
+        image = decode_image(0)
+        unique_images = np.empty((len(unique_data_inds),) + image.shape, dtype=image.dtype)
+        unique_images[0] = image
+        if self.num_decode_threads > 0 and len(unique_data_inds) > 1:
+            # OpenCV releases the GIL while decoding, so the images are decoded concurrently
+            self._get_decode_pool().map(lambda i: decode_image(i, out=unique_images[i]),
+                                        range(1, len(unique_data_inds)))
+        else:
+            for i in range(1, len(unique_data_inds)):
+                decode_image(i, out=unique_images[i])
+        images = np.take(unique_images, inverse_inds.reshape(-1), axis=0)
+        return images.reshape(data_inds.shape + images.shape[1:])
+
 
 class MultiDataContainer(DataContainer):
     """
-    Light wrapper of multiple data containers to get basic information from a container while ensuring that all
-    containers have the same information.
+    Read-only view of multiple data containers as a single container. The
+    trajectories of the containers are concatenated into a global trajectory
+    index, so that the trajectories of a container come after the ones of the
+    previous containers. The info file of a container is only parsed, and its
+    hdf5 file is only opened, the first time it is needed.
     """
-    def __init__(self, data_dirs, mode='r'):
+    def __init__(self, data_dirs, mode='r', container_cls=ImageDataContainer, num_read_threads=0):
+        """
+        Args:
+            container_cls: class of the underlying containers.
+            num_read_threads: if positive, the batched reads that span
+                multiple containers are done in parallel by this many threads.
+        """
         if mode != 'r':
             raise NotImplementedError
-        self.containers = [ImageDataContainer(data_dir, mode=mode) for data_dir in data_dirs]
+        self.data_dirs = list(data_dirs)
+        self.mode = mode
+        self.container_cls = container_cls
+        self.num_read_threads = num_read_threads
+        self._containers = [None] * len(self.data_dirs)
+        self._info_dicts = [None] * len(self.data_dirs)
+        self._container_traj_offsets_dict = dict()
+        self._lock = threading.Lock()
+        self._read_pool = None
 
     def close(self):
-        for container in self.containers:
-            container.close()
+        if self._read_pool is not None:
+            self._read_pool.close()
+            self._read_pool.join()
+            self._read_pool = None
+        for container in self._containers:
+            if container is not None:
+                container.close()
+        self._containers = [None] * len(self.data_dirs)
+
+    @property
+    def containers(self):
+        return [self.get_container(container_ind) for container_ind in range(len(self.data_dirs))]
+
+    def get_container(self, container_ind):
+        container = self._containers[container_ind]
+        if container is None:
+            with self._lock:
+                container = self._containers[container_ind]
+                if container is None:
+                    container = self.container_cls(self.data_dirs[container_ind], mode=self.mode)
+                    self._containers[container_ind] = container
+        return container
+
+    def _get_info_dict(self, container_ind):
+        """
+        Returns the info of a container without opening its hdf5 file if the
+        container hasn't been opened yet.
+        """
+        container = self._containers[container_ind]
+        if container is not None:
+            return container.info_dict
+        info_dict = self._info_dicts[container_ind]
+        if info_dict is None:
+            info_fname = os.path.join(self.data_dirs[container_ind], 'info.yaml')
+            if not os.path.exists(info_fname):
+                raise IOError('data directory %s not found' % self.data_dirs[container_ind])
+            with open_23(info_fname) as info_file:
+                info_dict = config.from_yaml(info_file) or dict()
+            self._info_dicts[container_ind] = info_dict
+        return info_dict
 
     def add_info(self, **info_dict):
         raise NotImplementedError
 
     def get_info(self, info_names):
+        if isinstance(info_names, str):
+            names = list([info_names])
+        else:
+            names = list(info_names)
         info = None
-        for container in self.containers:
+        for container_ind in range(len(self.data_dirs)):
+            info_dict = self._get_info_dict(container_ind)
+            other_info = [info_dict[name] for name in names]
+            if isinstance(info_names, str):
+                other_info, = other_info
             if info is None:
-                info = container.get_info(info_names)
+                info = other_info
             else:
-                other_info = container.get_info(info_names)
                 try:
                     equal = other_info == info
                 except ValueError:
@@ -305,24 +973,182 @@ class MultiDataContainer(DataContainer):
         raise NotImplementedError
 
     def get_datum(self, *inds_and_datum_names):
-        raise NotImplementedError
+        inds, datum_names = inds_and_datum_names[:-1], inds_and_datum_names[-1]
+        if len(inds) != 2:
+            raise IndexError('the number of indices does not match the number of dimensions of the data')
+        traj_ind, step_ind = inds
+        if isinstance(datum_names, str):
+            names = list([datum_names])
+        else:
+            names = list(datum_names)
+        datum = []
+        for name in names:
+            container_ind, local_traj_ind = self._get_local_traj_inds(traj_ind, name)
+            datum.append(self.get_container(int(container_ind)).get_datum(int(local_traj_ind), step_ind, name))
+        if isinstance(datum_names, str):
+            datum, = datum
+        return datum
+
+    def get_data(self, traj_inds, step_inds, datum_names):
+        """
+        Batched version of get_datum, where traj_inds are global trajectory
+        indices. The data points are grouped by container, so that there is a
+        single batched read per container and data name.
+        """
+        if isinstance(datum_names, str):
+            names = list([datum_names])
+        else:
+            names = list(datum_names)
+        data = []
+        for name in names:
+            data.append(self._read_data_from_containers(traj_inds, step_inds, name))
+        if isinstance(datum_names, str):
+            data, = data
+        return data
+
+    def _read_data_from_containers(self, traj_inds, step_inds, name):
+        traj_inds, step_inds = np.broadcast_arrays(np.asarray(traj_inds, dtype=int), np.asarray(step_inds, dtype=int))
+        container_inds, local_traj_inds = self._get_local_traj_inds(traj_inds, name)
+        masks = [container_inds == container_ind for container_ind in np.unique(container_inds)]
+
+        def read_container_data(container_ind_and_mask):
+            container_ind, mask = container_ind_and_mask
+            return self.get_container(container_ind).get_data(local_traj_inds[mask], step_inds[mask], name)
+
+        container_inds_and_masks = list(zip(np.unique(container_inds), masks))
+        if self.num_read_threads > 0 and len(container_inds_and_masks) > 1:
+            if self._read_pool is None:
+                self._read_pool = ThreadPool(self.num_read_threads)
+            all_container_data = self._read_pool.map(read_container_data, container_inds_and_masks)
+        else:
+            all_container_data = [read_container_data(item) for item in container_inds_and_masks]
+        data = None
+        for mask, container_data in zip(masks, all_container_data):
+            if data is None:
+                data = np.empty(traj_inds.shape + container_data.shape[1:], dtype=container_data.dtype)
+            data[mask] = container_data
+        if data is None:
+            data = np.empty(traj_inds.shape + tuple(self.get_datum_shape(name)))
+        return data
 
     def get_datum_shape(self, name):
         shape = None
-        for container in self.containers:
+        for container_ind in range(len(self.data_dirs)):
+            other_shape = (self._get_info_dict(container_ind).get('datum_shapes', None) or dict()).get(name, None)
+            if other_shape is None:
+                raise ValueError('shape for name %s does not exist' % name)
+            other_shape = tuple(other_shape)
             if shape is None:
-                shape = container.get_datum_shape(name)
-            else:
-                other_shape = container.get_datum_shape(name)
-                if other_shape != shape:
-                    raise ValueError('shapes are inconsistent across containers: %r, %r' % (shape, other_shape))
+                shape = other_shape
+            elif other_shape != shape:
+                raise ValueError('shapes are inconsistent across containers: %r, %r' % (shape, other_shape))
         return shape
 
     def get_data_shape(self, name):
-        raise NotImplementedError
+        """
+        Returns (num_trajs, num_steps) if all the containers have the same
+        number of steps per trajectory, and (num_trajs, None) otherwise.
+        """
+        traj_lengths = self.get_traj_lengths(name)
+        shapes = [self._get_container_data_shape(container_ind, name) for container_ind in range(len(self.data_dirs))]
+        num_steps = shapes[0][1] if shapes else None
+        if any(shape[1] != num_steps for shape in shapes):
+            num_steps = None
+        return (len(traj_lengths), num_steps)
 
     def get_data_size(self, name):
-        size = 0
-        for container in self.containers:
-            size += container.get_data_size(name)
-        return size
+        return int(self.get_traj_lengths(name).sum())
+
+    def get_traj_lengths(self, name):
+        all_traj_lengths = [self._get_container_traj_lengths(container_ind, name)
+                            for container_ind in range(len(self.data_dirs))]
+        return np.concatenate([np.zeros(0, dtype=int)] + all_traj_lengths)
+
+    def _get_container_data_shape(self, container_ind, name):
+        shape = (self._get_info_dict(container_ind).get('data_shapes', None) or dict()).get(name, None)
+        if shape is None:
+            raise ValueError('shape is not reserved for name %s' % name)
+        shape = tuple(shape)
+        if len(shape) != 2:
+            raise ValueError('data with name %s has shape %s, which is not of the form (num_trajs, num_steps)' %
+                             (name, shape))
+        return shape
+
+    def _get_container_traj_lengths(self, container_ind, name):
+        num_trajs, num_steps = self._get_container_data_shape(container_ind, name)
+        if num_steps is None:  # appendable data
+            traj_lengths = (self._get_info_dict(container_ind).get('traj_lengths', None) or dict()).get(name, [])
+            return np.array(traj_lengths, dtype=int)
+        return np.array([num_steps] * num_trajs, dtype=int)
+
+    def _get_container_traj_offsets(self, name):
+        """
+        Returns the global trajectory index of the first trajectory of each
+        container, followed by the total number of trajectories.
+        """
+        container_traj_offsets = self._container_traj_offsets_dict.get(name)
+        if container_traj_offsets is None:
+            num_trajs_per_container = [len(self._get_container_traj_lengths(container_ind, name))
+                                       for container_ind in range(len(self.data_dirs))]
+            container_traj_offsets = np.r_[0, np.cumsum(num_trajs_per_container)].astype(int)
+            self._container_traj_offsets_dict[name] = container_traj_offsets
+        return container_traj_offsets
+
+    def _get_local_traj_inds(self, traj_inds, name):
+        """
+        Maps global trajectory indices to container indices and trajectory
+        indices within those containers.
+        """
+        container_traj_offsets = self._get_container_traj_offsets(name)
+        num_trajs = container_traj_offsets[-1]
+        traj_inds = np.asarray(traj_inds, dtype=int)
+        traj_inds = np.where(traj_inds < 0, traj_inds + num_trajs, traj_inds)
+        if not np.all((0 <= traj_inds) & (traj_inds < num_trajs)):
+            raise IndexError('index at position 0 is out of range for entry with name %s' % name)
+        container_inds = np.searchsorted(container_traj_offsets[1:], traj_inds, side='right')
+        return container_inds, traj_inds - container_traj_offsets[container_inds]
+
+
+class ContainerPool(object):
+    """
+    Thread-safe pool of read-only containers. Each thread gets its own handle
+    of a container, which is opened on first use and reused afterwards so that
+    the info file is only parsed and the hdf5 file is only opened once per
+    thread and data directory. The containers are created with the given
+    keyword arguments (e.g. num_decode_threads).
+    """
+    def __init__(self, container_cls=ImageDataContainer, **container_kwargs):
+        self.container_cls = container_cls
+        self.container_kwargs = container_kwargs
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._containers = []
+
+    def get_container(self, data_dir):
+        containers_dict = getattr(self._local, 'containers_dict', None)
+        if containers_dict is None:
+            containers_dict = self._local.containers_dict = dict()
+        container = containers_dict.get(data_dir)
+        if container is None:
+            container = self.container_cls(data_dir, mode='r', **self.container_kwargs)
+            containers_dict[data_dir] = container
+            with self._lock:
+                self._containers.append(container)
+        return container
+
+    def get_containers(self, data_dirs):
+        return [self.get_container(data_dir) for data_dir in data_dirs]
+
+    def close(self):
+        with self._lock:
+            containers, self._containers = self._containers, []
+            # containers_dict of other threads are invalidated by replacing the thread-local storage
+            self._local = threading.local()
+        for container in containers:
+            container.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
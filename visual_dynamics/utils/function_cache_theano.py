@@ -0,0 +1,202 @@
+"""
+On-disk cache of compiled Theano functions.
+
+Compiling the functions of the larger nets (e.g. the jacobians of the
+dilated VGG features) takes minutes, and every process that loads a
+predictor or a servoing policy compiles the same functions again.
+compile_function() is a replacement of theano.function that pickles the
+compiled function the first time it is compiled and unpickles it afterwards
+(which skips the graph optimizations, while the C code of the ops is reused
+from Theano's own compilation directory).
+
+The cached functions are keyed by the structure of the graph (including
+the names of the inputs, the types and shapes of the shared variables and
+the values of the constants), the arguments of theano.function and the
+Theano flags that affect the compiled code. The values of the shared
+variables are not stored in the cache: the shared variables of a loaded
+function are swapped for the ones of the given graph, so that the function
+uses (and updates) the current parameters.
+
+The cache is disabled by default. It is enabled by setting the
+VISUAL_DYNAMICS_FUNCTION_CACHE_DIR environment variable to the cache
+directory, or with set_function_cache_dir(). An empty string disables it.
+"""
+from __future__ import division, print_function
+
+import hashlib
+import os
+import pickle
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+
+_function_cache_dir = os.environ.get('VISUAL_DYNAMICS_FUNCTION_CACHE_DIR', '')
+
+# Theano flags that affect the compiled functions
+THEANO_FLAGS = ['floatX', 'device', 'mode', 'linker', 'optimizer', 'optimizer_including', 'optimizer_excluding',
+                'cxx', 'gcc.cxxflags', 'blas.ldflags', 'on_opt_error', 'cast_policy', 'int_division']
+
+MIN_RECURSION_LIMIT = 50000  # the graphs of the larger nets are pickled recursively
+
+
+def get_function_cache_dir():
+    return _function_cache_dir
+
+
+def set_function_cache_dir(function_cache_dir):
+    """
+    Sets the directory of the cached functions, or disables the cache if
+    function_cache_dir is None or an empty string.
+    """
+    global _function_cache_dir
+    _function_cache_dir = function_cache_dir
+
+
+def get_theano_flags():
+    flags = OrderedDict([('version', theano.__version__)])
+    for flag in THEANO_FLAGS:
+        value = theano.config
+        try:
+            for attr in flag.split('.'):
+                value = getattr(value, attr)
+        except AttributeError:
+            continue
+        flags[flag] = str(value)
+    return flags
+
+
+def _get_outputs_and_updates(outputs, updates):
+    if outputs is None:
+        outputs = []
+    elif not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    updates = list(updates.items()) if isinstance(updates, dict) else list(updates or [])
+    return list(outputs), updates
+
+
+def get_shared_variables(outputs, updates=None):
+    """
+    Returns the shared variables of the graph of the outputs and updates,
+    in an order that only depends on the structure of the graph.
+    """
+    outputs, updates = _get_outputs_and_updates(outputs, updates)
+    variables = outputs + [value for _, value in updates] + [shared_var for shared_var, _ in updates]
+    return [variable for variable in theano.gof.graph.inputs(variables) if isinstance(variable, SharedVariable)]
+
+
+def get_function_key(inputs, outputs, updates=None, **kwargs):
+    """
+    Returns a hex digest that identifies the function that theano.function
+    would compile for the given arguments.
+    """
+    outputs, updates = _get_outputs_and_updates(outputs, updates)
+    sha1 = hashlib.sha1()
+
+    def update(*strs):
+        for str_ in strs:
+            sha1.update(str(str_).encode('utf-8'))
+            sha1.update(b'\0')
+
+    update('inputs', *[(input_.name, input_.type) for input_ in inputs])
+    update('outputs', theano.printing.debugprint(outputs, file='str', print_type=True))
+    update('updates', theano.printing.debugprint([value for _, value in updates], file='str', print_type=True))
+    variables = outputs + [value for _, value in updates]
+    for variable in theano.gof.graph.inputs(variables):
+        if isinstance(variable, SharedVariable):
+            value = variable.get_value(borrow=True, return_internal_type=True)
+            update('shared', variable.name, variable.type, getattr(value, 'shape', None))
+        elif isinstance(variable, theano.gof.Constant):
+            data = np.asarray(variable.data)
+            update('constant', variable.type, data.shape)
+            sha1.update(np.ascontiguousarray(data).view(np.uint8).tobytes())
+    update('updated', *[(shared_var.name, shared_var.type) for shared_var, _ in updates])
+    update('kwargs', *sorted(kwargs.items()))
+    update('flags', *get_theano_flags().items())
+    return sha1.hexdigest()
+
+
+class _recursion_limit(object):
+    def __enter__(self):
+        self.recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(self.recursion_limit, MIN_RECURSION_LIMIT))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.setrecursionlimit(self.recursion_limit)
+
+
+def _get_placeholder(shared_var):
+    # empty value (except for the broadcastable dimensions) of the same type
+    value = shared_var.get_value(borrow=True, return_internal_type=True)
+    shape = tuple(1 if broadcastable else 0 for broadcastable in shared_var.broadcastable)
+    return theano.shared(np.zeros(shape, dtype=value.dtype), name=shared_var.name,
+                         broadcastable=shared_var.broadcastable)
+
+
+def save_function(fn, function_fname, shared_vars):
+    """
+    Pickles the compiled function fn without the values of its shared
+    variables, which are replaced by placeholders. Their indices in
+    shared_vars (see get_shared_variables) are stored along with the
+    function.
+    """
+    fn_shared_vars = fn.get_shared()
+    shared_var_inds = [shared_vars.index(shared_var) for shared_var in fn_shared_vars]
+    fn = fn.copy(swap={shared_var: _get_placeholder(shared_var) for shared_var in fn_shared_vars})
+    function_dir = os.path.dirname(function_fname)
+    if not os.path.exists(function_dir):
+        os.makedirs(function_dir)
+    # write the file with a temporary name and rename it once it is complete
+    tmp_function_fname = function_fname + '.%d.tmp' % os.getpid()
+    with _recursion_limit(), open(tmp_function_fname, 'wb') as function_file:
+        pickle.dump((shared_var_inds, fn), function_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_function_fname, function_fname)
+
+
+def load_function(function_fname, shared_vars):
+    """
+    Unpickles a function saved by save_function and swaps its placeholders
+    for the respective shared variables of shared_vars.
+    """
+    with _recursion_limit(), open(function_fname, 'rb') as function_file:
+        shared_var_inds, fn = pickle.load(function_file)
+    return fn.copy(swap={placeholder: shared_vars[shared_var_ind]
+                         for placeholder, shared_var_ind in zip(fn.get_shared(), shared_var_inds)})
+
+
+def compile_function(description, inputs, outputs=None, updates=None, **kwargs):
+    """
+    Same as theano.function(inputs, outputs, updates=updates, **kwargs)
+    except that the compiled function is loaded from the function cache
+    if it is there, and it is stored there otherwise. description is used
+    in the printed messages, e.g. 'prediction'.
+    """
+    function_cache_dir = get_function_cache_dir()
+    if function_cache_dir:
+        function_fname = os.path.join(function_cache_dir,
+                                      '%s.pkl' % get_function_key(inputs, outputs, updates=updates, **kwargs))
+        shared_vars = get_shared_variables(outputs, updates=updates)
+        if os.path.exists(function_fname):
+            start_time = time.time()
+            print("Loading %s function from %s..." % (description, function_fname))
+            try:
+                fn = load_function(function_fname, shared_vars)
+            except Exception as e:  # e.g. a file written by an incompatible version of Theano
+                print("... failed to load the function (%s: %s)" % (type(e).__name__, e))
+            else:
+                print("... finished in %.2f s" % (time.time() - start_time))
+                return fn
+    start_time = time.time()
+    print("Compiling %s function..." % description)
+    fn = theano.function(inputs, outputs, updates=updates, **kwargs)
+    print("... finished in %.2f s" % (time.time() - start_time))
+    if not function_cache_dir:
+        return fn
+    try:
+        save_function(fn, function_fname, shared_vars)
+    except Exception as e:  # the compiled function is still usable
+        print("Failed to save the %s function to %s (%s: %s)" % (description, function_fname, type(e).__name__, e))
+    return fn
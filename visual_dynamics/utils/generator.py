@@ -1,19 +1,20 @@
 from __future__ import division, print_function
 
-import contextlib
+import multiprocessing
 import os
 import threading
 import time
+import traceback
+from collections import OrderedDict
 
-if not hasattr(contextlib, 'ExitStack'):
-    import contextlib2 as contextlib
 import numpy as np
 try:
     import queue
 except ImportError:
     import Queue as queue
 
-from visual_dynamics.utils.container import ImageDataContainer
+from visual_dynamics.utils.cache import PreprocessedDataCache, get_hash
+from visual_dynamics.utils.container import ContainerPool
 from visual_dynamics.utils.transformer import Transformer, OpsTransformer, ImageTransformer, CompositionTransformer
 
 
@@ -54,6 +55,7 @@ class ParallelGenerator(object):
         self.wait_time = wait_time
         self.data_gen_queue, self._data_stop, self.generator_threads = \
             generator_queue(generator, max_q_size=max_q_size, wait_time=wait_time, nb_worker=nb_worker)
+        self._generator = generator
         self._size = generator.size
 
     def __iter__(self):
@@ -73,9 +75,175 @@ class ParallelGenerator(object):
         return self.__next__()
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         self._data_stop.set()
         for thread in self.generator_threads:
             thread.join()
+        if hasattr(self._generator, 'close'):
+            self._generator.close()
+
+    @property
+    def size(self):
+        return self._size
+
+
+def get_multiprocessing_context():
+    # workers inherit the generator from the parent process, so they need to be forked
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+
+def _multiprocess_generator_worker(generator, index_queue, result_queue, slots, slot_offsets):
+    generator._init_worker()
+    while True:
+        task = index_queue.get()
+        if task is None:
+            break
+        batch_ind, slot_ind, excerpt = task
+        try:
+            batch_data = generator.get_batch_data(excerpt)
+            slot = np.frombuffer(slots[slot_ind], dtype=np.uint8)
+            datum_infos = []
+            for datum, offset in zip(batch_data, slot_offsets):
+                datum = np.ascontiguousarray(datum)
+                slot_datum = slot[offset:offset + datum.nbytes].view(datum.dtype).reshape(datum.shape)
+                slot_datum[...] = datum
+                datum_infos.append((datum.shape, datum.dtype.str))
+            result_queue.put((batch_ind, slot_ind, datum_infos, None))
+        except Exception:
+            result_queue.put((batch_ind, slot_ind, None, traceback.format_exc()))
+
+
+class MultiprocessGenerator(object):
+    def __init__(self, generator, max_q_size=10, nb_worker=1, timeout=1.0):
+        """
+        Computes the minibatches of a DataGenerator in nb_worker worker
+        processes. The parent process decides the excerpt of every minibatch
+        (so the minibatches are returned in the same order as the ones of the
+        wrapped generator) and the workers write the minibatches into
+        max_q_size preallocated shared memory slots, so the data is never
+        pickled. At most max_q_size minibatches are prefetched.
+
+        Exceptions raised in the workers are re-raised when the corresponding
+        minibatch is requested. The workers are shut down by close().
+        """
+        self._workers = []
+        self._generator = generator
+        self._size = generator.size
+        self.timeout = timeout
+        self._next_batch_ind = 0
+        self._num_dispatched = 0
+        self._done_dispatching = False
+        self._results = dict()
+        # state of the generator after each of the dispatched minibatches
+        self._state_dict = generator.state_dict()
+        self._batch_state_dicts = dict()
+
+        # the first minibatch is computed in this process to determine the size of the slots
+        try:
+            self._first_batch_data = generator.get_batch_data(generator.get_next_excerpt())
+            self._first_batch_state_dict = generator.state_dict()
+        except StopIteration:
+            self._first_batch_data = None
+            self._done_dispatching = True
+        self._next_batch_ind = self._num_dispatched = 1
+        self.slot_offsets = []
+        slot_nbytes = 0
+        for datum in (self._first_batch_data or []):
+            self.slot_offsets.append(slot_nbytes)
+            slot_nbytes += (datum.nbytes + 63) // 64 * 64  # align each datum to 64 bytes
+
+        ctx = get_multiprocessing_context()
+        self._slots = [ctx.RawArray('B', max(slot_nbytes, 1)) for _ in range(max_q_size)]
+        self._free_slot_inds = list(range(max_q_size))
+        self._index_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        for _ in range(nb_worker if not self._done_dispatching else 0):
+            worker = ctx.Process(target=_multiprocess_generator_worker,
+                                 args=(generator, self._index_queue, self._result_queue, self._slots,
+                                       self.slot_offsets))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        self._dispatch()
+
+    def _dispatch(self):
+        while not self._done_dispatching and self._free_slot_inds:
+            try:
+                excerpt = self._generator.get_next_excerpt()
+            except StopIteration:
+                self._done_dispatching = True
+                break
+            self._batch_state_dicts[self._num_dispatched] = self._generator.state_dict()
+            self._index_queue.put((self._num_dispatched, self._free_slot_inds.pop(), excerpt))
+            self._num_dispatched += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first_batch_data is not None:
+            batch_data, self._first_batch_data = self._first_batch_data, None
+            self._state_dict = self._first_batch_state_dict
+            return batch_data
+        if self._next_batch_ind == self._num_dispatched:
+            raise StopIteration
+        while self._next_batch_ind not in self._results:
+            try:
+                batch_ind, slot_ind, datum_infos, error = self._result_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError('a worker process of the generator exited unexpectedly')
+                continue
+            self._results[batch_ind] = (slot_ind, datum_infos, error)
+        slot_ind, datum_infos, error = self._results.pop(self._next_batch_ind)
+        self._state_dict = self._batch_state_dicts.pop(self._next_batch_ind)
+        self._next_batch_ind += 1
+        batch_data = []
+        if error is None:
+            slot = np.frombuffer(self._slots[slot_ind], dtype=np.uint8)
+            for (shape, dtype), offset in zip(datum_infos, self.slot_offsets):
+                nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+                # copy the datum so that the slot can be reused
+                batch_data.append(slot[offset:offset + nbytes].view(dtype).reshape(shape).copy())
+        self._free_slot_inds.append(slot_ind)
+        self._dispatch()
+        if error is not None:
+            raise RuntimeError('exception in worker process of the generator:\n%s' % error)
+        return tuple(batch_data)
+
+    def next(self):
+        # python 2 compatible
+        return self.__next__()
+
+    def state_dict(self):
+        """
+        Returns the state of the wrapped generator right after the last
+        minibatch that was returned (i.e. ignoring the prefetched ones).
+        """
+        return dict(self._state_dict)
+
+    def close(self):
+        for _ in self._workers:
+            self._index_queue.put(None)
+        for worker in self._workers:
+            worker.join(self.timeout)
+            if worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        self._generator.close()
+
+    def __del__(self):
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @property
     def size(self):
@@ -83,7 +251,8 @@ class ParallelGenerator(object):
 
 
 class DataGenerator(object):
-    def __init__(self, container_fnames, data_name_offset_pairs, transformers=None, once=False, batch_size=0, shuffle=False, dtype=None):
+    def __init__(self, container_fnames, data_name_offset_pairs, transformers=None, once=False, batch_size=0, shuffle=False, dtype=None,
+                 cache_dir=None, seed=None, frame_cache=None, cache_preprocessed_frames=False, num_decode_threads=0):
         """
         Iterate through all the data once or indefinitely. The data from
         contiguous files are treated as if they are contiguous. All of the
@@ -91,12 +260,35 @@ class DataGenerator(object):
         the data is iterated in a random order, and this order differs for each
         pass of the data.
 
-        Note: this is not as efficient as it could be when shuffle=False since
-        each data point is retrieved one by one regardless of the value of
-        shuffle.
+        The data of a minibatch is read with a single batched read per
+        container and data name.
+
+        The containers are opened once per thread (the first time they are
+        needed) and reused across minibatches. They are closed when close()
+        is called.
 
         A batch_size of 0 denotes to return data of batch size 1 but with the
         leading singleton dimensioned squeezed.
+
+        If cache_dir is specified, the preprocessed data of the names that
+        have a transformer is cached in that directory (see
+        PreprocessedDataCache) and later passes over the data read it from
+        there instead of reading and preprocessing the data again.
+
+        If frame_cache (a FrameCache) is specified, the images (the data whose
+        name ends with 'image') are kept in that in-memory cache once they are
+        decoded, so that later passes over the data don't read and decode them
+        again. If cache_preprocessed_frames is True, the images are cached
+        after they are preprocessed instead. The same frame cache can be
+        shared by several generators.
+
+        If num_decode_threads is positive, the images of a minibatch are
+        decoded by a pool of this many threads per container handle.
+
+        The random order of each pass is determined by seed and the index of
+        the pass, so the position in the data can be saved with state_dict()
+        and restored with load_state_dict(). If seed is None, a seed is drawn
+        from numpy's global random number generator.
         """
         if isinstance(container_fnames, str):
             container_fnames = [container_fnames]
@@ -109,7 +301,18 @@ class DataGenerator(object):
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.dtype = dtype
+        self.cache_dir = cache_dir
+        self.frame_cache = frame_cache
+        self.cache_preprocessed_frames = cache_preprocessed_frames
+        self._frame_cache_tags = dict()
+        self.seed = seed if seed is not None else np.random.randint(2 ** 31)
+        self._excerpt_ind = 0
+        self._shard_id, self._num_shards = 0, 1
+        self._epoch_indices = dict()
         self._lock = threading.Lock()
+        self.num_decode_threads = num_decode_threads
+        self._container_pool = ContainerPool(num_decode_threads=self.num_decode_threads)
+        self._caches_dict = dict()
 
         offset_limits = dict()
         for data_name, offset in data_name_offset_pairs:
@@ -132,20 +335,23 @@ class DataGenerator(object):
         for data_name, (offset_min, offset_max) in offset_limits.items():
             offset_limits[data_name] = (offset_min - offset_all_min,
                                         offset_max - offset_all_min)
-        with contextlib.ExitStack() as stack:
-            containers = [stack.enter_context(ImageDataContainer(fname)) for fname in self._container_fnames]
-            num_steps_per_traj = []
-            num_steps_per_container = []
-            num_trajs_per_container = []
-            for container in containers:
-                data_name_to_data_sizes = {}
-                for data_name, (offset_min, offset_max) in offset_limits.items():
-                    num_trajs, num_steps = container.get_data_shape(data_name)
-                    data_name_to_data_sizes[data_name] = np.array([num_steps - offset_max] * num_trajs)
-                data_sizes = np.array(list(data_name_to_data_sizes.values())).min(axis=0)
-                num_steps_per_traj.extend(data_sizes)
-                num_steps_per_container.append(data_sizes.sum())
-                num_trajs_per_container.append(len(data_sizes))
+        containers = self._container_pool.get_containers(self._container_fnames)
+        num_steps_per_traj = []
+        num_steps_per_container = []
+        num_trajs_per_container = []
+        for container in containers:
+            data_name_to_data_sizes = {}
+            for data_name, (offset_min, offset_max) in offset_limits.items():
+                # trajectories may have different lengths (e.g. in appendable containers), in which case the
+                # trajectories that are too short for the offsets have no valid steps
+                traj_lengths = container.get_traj_lengths(data_name)
+                data_name_to_data_sizes[data_name] = np.maximum(traj_lengths - offset_max, 0)
+            # only use the trajectories that exist for all the data names
+            num_trajs = min(len(data_sizes) for data_sizes in data_name_to_data_sizes.values())
+            data_sizes = np.array([data_sizes[:num_trajs] for data_sizes in data_name_to_data_sizes.values()]).min(axis=0)
+            num_steps_per_traj.extend(data_sizes)
+            num_steps_per_container.append(data_sizes.sum())
+            num_trajs_per_container.append(len(data_sizes))
         self._num_steps_per_traj = num_steps_per_traj
         self._num_steps_per_container = num_steps_per_container
         self._num_trajs_per_container = num_trajs_per_container
@@ -153,7 +359,6 @@ class DataGenerator(object):
         self._num_steps_per_container_cs = np.r_[0, np.cumsum(num_steps_per_container)]
         self._num_trajs_per_container_cs = np.r_[0, np.cumsum(num_trajs_per_container)]
         assert self._num_steps_per_traj_cs[-1] == self._num_steps_per_container_cs[-1]
-        self._excerpt_generator = self._get_excerpt_generator()
 
     @property
     def batch_size(self):
@@ -183,62 +388,239 @@ class DataGenerator(object):
         traj_iter = all_traj_iter - self._num_trajs_per_container_cs[container_ind]
         return container_ind, traj_iter, step_iter
 
-    def _get_excerpt_generator(self):
-        indices = []
-        continue_extending = True
-        while True:
-            if len(indices) < self._batch_size and continue_extending:
-                if self.shuffle:
-                    new_indices = np.random.permutation(self.size)
+    def _get_data(self, containers, container_inds, traj_inds, step_inds, data_name, preprocess=False):
+        """
+        Reads the data from all the containers with one batched read per
+        container. The leading dimensions of the returned data are the
+        broadcasted shape of traj_inds and step_inds.
+        """
+        traj_inds, step_inds = np.broadcast_arrays(traj_inds, step_inds)
+        data = None
+        for container_ind in np.unique(container_inds):
+            mask = container_inds == container_ind
+            container = containers[container_ind]
+            cache = self._get_cache(container_ind, container, data_name) if preprocess else None
+            if cache is None and self.frame_cache is not None and data_name.endswith('image'):
+                container_data = self._get_cached_frames(container, traj_inds[mask], step_inds[mask], data_name,
+                                                         preprocess=preprocess)
+            elif preprocess:
+                if cache is not None:
+                    container_data = cache.get_data(container, traj_inds[mask], step_inds[mask])
                 else:
-                    new_indices = np.arange(self.size)
-                indices.extend(new_indices)
-                if self.once:
-                    continue_extending = False
-            excerpt = np.asarray(indices[0:self._batch_size])
-            del indices[0:self._batch_size]
-            yield excerpt
+                    container_data = container.get_data(traj_inds[mask], step_inds[mask], data_name)
+                    container_data = self._preprocess(data_name, container_data, step_inds.ndim)
+            else:
+                container_data = container.get_data(traj_inds[mask], step_inds[mask], data_name)
+            if data is None:
+                data = np.empty(step_inds.shape + container_data.shape[step_inds.ndim:], dtype=container_data.dtype)
+            data[mask] = container_data
+        return data
+
+    def _preprocess(self, data_name, data, batch_ndim):
+        transformer = self.transformers_dict.get(data_name, Transformer())
+        batch_shape = data.shape[:batch_ndim]
+        # flatten the batch axes into a single one and preprocess all the data at once
+        data = data.reshape((-1,) + data.shape[batch_ndim:])
+        if self.dtype is not None:
+            out = np.empty(transformer.preprocess_batch_shape(data.shape), dtype=self.dtype)
+            preprocessed_data = transformer.preprocess_batch(data, out=out)
+        else:
+            preprocessed_data = np.asarray(transformer.preprocess_batch(data))
+        return preprocessed_data.reshape(batch_shape + preprocessed_data.shape[1:])
+
+    def _get_cached_frames(self, container, traj_inds, step_inds, data_name, preprocess=False):
+        """
+        Like _get_data for a single container and 1-dimensional indices, but
+        only the frames that are not in the frame cache are read (and
+        preprocessed if cache_preprocessed_frames is True).
+        """
+        cache_preprocessed = preprocess and self.cache_preprocessed_frames
+        tag = self._get_frame_cache_tag(data_name) if cache_preprocessed else None
+        keys = [(container.data_dir, data_name, tag, int(traj_ind), int(step_ind))
+                for traj_ind, step_ind in zip(traj_inds, step_inds)]
+        frames = self.frame_cache.get_many(keys)
+        missing_inds = np.array([i for i, frame in enumerate(frames) if frame is None], dtype=int)
+        if len(missing_inds):
+            missing_frames = container.get_data(traj_inds[missing_inds], step_inds[missing_inds], data_name)
+            if cache_preprocessed:
+                missing_frames = self._preprocess(data_name, missing_frames, 1)
+            self.frame_cache.put_many([keys[i] for i in missing_inds], missing_frames)
+            for i, frame in zip(missing_inds, missing_frames):
+                frames[i] = frame
+        data = np.stack(frames)
+        if preprocess and not cache_preprocessed:
+            data = self._preprocess(data_name, data, 1)
+        return data
+
+    def _get_frame_cache_tag(self, data_name):
+        # identifies the preprocessing so that generators with different transformers can share a frame cache
+        tag = self._frame_cache_tags.get(data_name)
+        if tag is None:
+            tag = get_hash(self.transformers_dict.get(data_name, Transformer()),
+                           str(np.dtype(self.dtype)) if self.dtype is not None else 'None')
+            self._frame_cache_tags[data_name] = tag
+        return tag
+
+    def _get_cache(self, container_ind, container, data_name):
+        if self.cache_dir is None or data_name not in self.transformers_dict:
+            return None
+        with self._lock:
+            cache = self._caches_dict.get((container_ind, data_name))
+            if cache is None:
+                cache = PreprocessedDataCache(self.cache_dir, container, data_name,
+                                              self.transformers_dict[data_name], dtype=self.dtype)
+                self._caches_dict[(container_ind, data_name)] = cache
+        return cache
+
+    def _get_epoch_indices(self, epoch):
+        indices = self._epoch_indices.get(epoch)
+        if indices is None:
+            if self.shuffle:
+                indices = np.random.RandomState([self.seed, epoch]).permutation(self.size)
+            else:
+                indices = np.arange(self.size)
+            # only keep the indices of the epochs that the current minibatch may straddle
+            self._epoch_indices = dict((epoch_, indices_) for (epoch_, indices_) in self._epoch_indices.items()
+                                       if epoch_ == epoch - 1)
+            self._epoch_indices[epoch] = indices
+        return indices
+
+    def _get_excerpt(self, excerpt_ind):
+        """
+        Returns the indices of the excerpt_ind-th minibatch of the sequence
+        of all the passes over the data.
+        """
+        start = excerpt_ind * self._batch_size
+        stop = start + self._batch_size
+        if self.once:
+            stop = min(stop, self.size)
+        if start >= stop or self.size == 0:
+            return np.array([], dtype=int)
+        epochs = range(start // self.size, (stop - 1) // self.size + 1)
+        indices = np.concatenate([self._get_epoch_indices(epoch) for epoch in epochs])
+        indices_start = epochs[0] * self.size
+        return indices[start - indices_start:stop - indices_start]
+
+    def shard(self, shard_id, num_shards):
+        """
+        Makes this generator only return every num_shards-th minibatch,
+        starting from the shard_id-th one. The minibatches of the num_shards
+        shards are disjoint and, interleaved, they are the minibatches of the
+        non-sharded generator.
+        """
+        if not 0 <= shard_id < num_shards:
+            raise ValueError('shard_id should be between 0 and %d, but %d was given' % (num_shards - 1, shard_id))
+        with self._lock:
+            self._shard_id, self._num_shards = shard_id, num_shards
+            self._excerpt_ind += (shard_id - self._excerpt_ind) % num_shards
+        return self
+
+    def state_dict(self):
+        with self._lock:
+            return dict(seed=int(self.seed),
+                        excerpt_ind=int(self._excerpt_ind),
+                        batch_size=int(self._batch_size),
+                        size=int(self.size))
+
+    def load_state_dict(self, state_dict):
+        if state_dict['batch_size'] != self._batch_size or state_dict['size'] != self.size:
+            raise ValueError('the state was saved from a generator with batch size %d and size %d, but this '
+                             'generator has batch size %d and size %d' %
+                             (state_dict['batch_size'], state_dict['size'], self._batch_size, self.size))
+        with self._lock:
+            self.seed = state_dict['seed']
+            self._epoch_indices = dict()
+            self._excerpt_ind = state_dict['excerpt_ind']
+            self._excerpt_ind += (self._shard_id - self._excerpt_ind) % self._num_shards
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        with contextlib.ExitStack() as stack:
-            containers = [stack.enter_context(ImageDataContainer(fname)) for fname in self._container_fnames]
-            with self._lock:
-                excerpt = next(self._excerpt_generator)
+        return self.get_batch_data(self.get_next_excerpt())
+
+    def get_next_excerpt(self):
+        """
+        Returns the indices of the data points of the next minibatch. This
+        and get_batch_data can be called from different threads or processes.
+        """
+        with self._lock:
+            excerpt = self._get_excerpt(self._excerpt_ind)
             if len(excerpt) == 0:
                 raise StopIteration
-            batch_data = []
-            for data_name, offset in self._data_name_offset_pairs:
-                transformer = self.transformers_dict.get(data_name, Transformer())
-                datum = None  # initialize later to use dtype of first single_datum
-                for i, all_ind in enumerate(excerpt):
-                    container_ind, traj_iter, step_iter = self._get_local_inds(all_ind)
-                    if isinstance(offset, int):
-                        offsets = [offset]
-                    elif isinstance(offset, slice):
-                        offsets = np.arange(offset.start, offset.stop, offset.step)
-                    single_datum_list = []
-                    for int_offset in offsets:
-                        single_datum = containers[container_ind].get_datum(traj_iter, step_iter + int_offset, data_name)
-                        single_datum = np.asarray(transformer.preprocess(single_datum), dtype=self.dtype)
-                        single_datum_list.append(single_datum)
-                    single_datum = np.asarray(single_datum_list)
-                    if isinstance(offset, int):
-                        single_datum = np.squeeze(single_datum, axis=0)
-                    if datum is None:
-                        datum = np.empty(((len(excerpt),) + single_datum.shape), dtype=single_datum.dtype)
-                    datum[i, ...] = single_datum
-                batch_data.append(datum)
-            if self.squeeze:
-                batch_data = [np.squeeze(datum, axis=0) for datum in batch_data]
-            return tuple(batch_data)
+            self._excerpt_ind += self._num_shards
+        return excerpt
+
+    def get_batch_data(self, excerpt):
+        containers = self._container_pool.get_containers(self._container_fnames)
+        container_inds, traj_iters, step_iters = self._get_local_inds(excerpt)
+        # group the offsets of each data name so that the data points that are
+        # requested more than once (e.g. the same image at offsets 0 and 1 of
+        # consecutive steps) are only read and preprocessed once
+        data_name_offsets = OrderedDict()
+        for data_name, offset in self._data_name_offset_pairs:
+            if isinstance(offset, int):
+                offsets = np.array([offset])
+            elif isinstance(offset, slice):
+                offsets = np.arange(offset.start, offset.stop, offset.step)
+            else:
+                offsets = np.asarray(offset)
+            data_name_offsets.setdefault(data_name, []).append(offsets)
+        data_name_data = {}
+        for data_name, offsets_list in data_name_offsets.items():
+            offsets = np.concatenate(offsets_list)
+            step_inds = step_iters[:, None] + offsets[None, :]
+            data = self._get_unique_data(containers, container_inds, traj_iters, step_inds, data_name)
+            split_inds = np.cumsum([len(offsets) for offsets in offsets_list])[:-1]
+            data_name_data[data_name] = iter(np.split(data, split_inds, axis=1))
+        batch_data = []
+        for data_name, offset in self._data_name_offset_pairs:
+            datum = next(data_name_data[data_name])
+            if isinstance(offset, int):
+                datum = np.squeeze(datum, axis=1)
+            batch_data.append(datum)
+        if self.squeeze:
+            batch_data = [np.squeeze(datum, axis=0) for datum in batch_data]
+        return tuple(batch_data)
+
+    def _get_unique_data(self, containers, container_inds, traj_iters, step_inds, data_name):
+        """
+        Returns the preprocessed data of data_name of shape step_inds.shape,
+        where each unique (container, trajectory, step) is only read and
+        preprocessed once.
+        """
+        container_inds, traj_inds, step_inds = np.broadcast_arrays(container_inds[:, None], traj_iters[:, None],
+                                                                   step_inds)
+        inds = np.stack([container_inds.ravel(), traj_inds.ravel(), step_inds.ravel()], axis=1)
+        unique_inds, inverse = np.unique(inds, axis=0, return_inverse=True)
+        unique_data = self._get_data(containers, unique_inds[:, 0], unique_inds[:, 1], unique_inds[:, 2],
+                                     data_name, preprocess=True)
+        data = np.take(unique_data, inverse.reshape(-1), axis=0)
+        return data.reshape(step_inds.shape + unique_data.shape[1:])
 
     def next(self):
         # python 2 compatible
         return self.__next__()
 
+    def close(self):
+        self._container_pool.close()
+
+    def _init_worker(self):
+        """
+        Should be called in a newly forked worker process so that it doesn't
+        use the locks or the container handles of the parent process.
+        """
+        self._lock = threading.Lock()
+        self._container_pool = ContainerPool(num_decode_threads=self.num_decode_threads)
+        if self.frame_cache is not None:
+            self.frame_cache._init_worker()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def size(self):
         """
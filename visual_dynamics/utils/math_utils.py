@@ -4,33 +4,97 @@ import numpy as np
 
 
 class OnlineStatistics(object):
-    def __init__(self, axis=0):
+    def __init__(self, axis=0, covariance=False):
+        """
+        Mean and variance of data that is added in batches, reduced over the
+        given axis (or axes). The statistics are accumulated in float64 with
+        the pairwise update of Chan et al. (i.e. Welford's algorithm for
+        batches), which is numerically stable, and statistics of different
+        parts of the data (e.g. computed by different workers) can be merged.
+
+        Args:
+            covariance: if True, the covariance between the elements of the
+                non-reduced axes (e.g. the channels) is also accumulated.
+        """
         self.axis = axis
+        self.covariance = covariance
         self.n = None
-        self.s = None
-        self.s2 = None
+        self._mean = None
+        self._m2 = None
+        self._c2 = None
         self.reset()
 
     def reset(self):
         self.n = 0
-        self.s = 0.0
-        self.s2 = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0  # sum of the squared differences from the mean
+        self._c2 = 0.0  # sum of the outer products of the differences from the mean
+
+    def _get_axes(self, ndim):
+        axes = self.axis if isinstance(self.axis, (list, tuple)) else (self.axis,)
+        return tuple(axis % ndim for axis in axes)
 
     def add_data(self, data):
-        if isinstance(self.axis, (list, tuple)):
-            self.n += np.prod([data.shape[axis] for axis in self.axis])
+        data = np.asarray(data)
+        axes = self._get_axes(data.ndim)
+        n = int(np.prod([data.shape[axis] for axis in axes]))
+        if n == 0:
+            return
+        mean = data.mean(axis=axes, dtype=np.float64, keepdims=True)
+        diff = data - mean
+        if self.covariance:
+            other_axes = [axis for axis in range(data.ndim) if axis not in axes]
+            diff_matrix = diff.transpose(axes + tuple(other_axes)).reshape((n, -1))
+            c2 = diff_matrix.T.dot(diff_matrix)
         else:
-            self.n += data.shape[self.axis]
-        self.s += data.sum(axis=self.axis)
-        self.s2 += (data ** 2).sum(axis=self.axis)
+            c2 = 0.0
+        m2 = np.square(diff, out=diff).sum(axis=axes)
+        self._merge(n, mean.squeeze(axis=axes), m2, c2)
+
+    def merge(self, other):
+        """
+        Updates these statistics with the ones of other, as if the data added
+        to other had been added to this one.
+        """
+        if self.axis != other.axis or self.covariance != other.covariance:
+            raise ValueError('unable to merge statistics with axis %r and covariance %r into statistics with axis %r '
+                             'and covariance %r' % (other.axis, other.covariance, self.axis, self.covariance))
+        self._merge(other.n, other._mean, other._m2, other._c2)
+        return self
+
+    def _merge(self, n, mean, m2, c2):
+        if n == 0:
+            return
+        total_n = self.n + n
+        delta = mean - self._mean
+        self._mean = self._mean + delta * (n / total_n)
+        self._m2 = self._m2 + m2 + np.square(delta) * (self.n * n / total_n)
+        if self.covariance:
+            delta = np.reshape(delta, -1)
+            self._c2 = self._c2 + c2 + np.outer(delta, delta) * (self.n * n / total_n)
+        self.n = total_n
 
     @property
     def mean(self):
-        return self.s / self.n
+        return self._mean
+
+    @property
+    def var(self):
+        return self._m2 / self.n
 
     @property
     def std(self):
-        return np.sqrt((self.s2 - (self.s ** 2) / self.n) / self.n)
+        return np.sqrt(self.var)
+
+    @property
+    def cov(self):
+        """
+        Covariance matrix between the (flattened) elements of the non-reduced
+        axes.
+        """
+        if not self.covariance:
+            raise ValueError('the covariance is only accumulated if covariance is True')
+        return self._c2 / self.n
 
 
 def divide_nonzero(a, b):
@@ -106,9 +170,12 @@ def pack_image(image, fixed_point_min=0.01, fixed_point_max=100.0):
 
 
 def unpack_image(fixed_point_image, fixed_point_min=0.01, fixed_point_max=100.0):
-    fixed_point_image = np.concatenate([fixed_point_image, np.zeros(fixed_point_image.shape[:-1] + (1,), dtype=np.uint8)], axis=-1)
-    fixed_point_image = fixed_point_image.view(np.uint32).astype(int).squeeze()
-    fixed_point_image = fixed_point_min + fixed_point_image * (fixed_point_max - fixed_point_min) / (2 ** 24)
+    # copy the 3 bytes into a zeroed 4-byte buffer so that it can be viewed as uint32 without concatenating
+    uint32_image = np.zeros(fixed_point_image.shape[:-1] + (4,), dtype=np.uint8)
+    uint32_image[..., :3] = fixed_point_image
+    fixed_point_image = uint32_image.view(np.uint32)[..., 0].astype(np.float64)
+    fixed_point_image *= (fixed_point_max - fixed_point_min) / (2 ** 24)
+    fixed_point_image += fixed_point_min
     image = fixed_point_image.astype(np.float32)
     image = np.expand_dims(image, axis=-1)
     return image
@@ -80,9 +80,11 @@ class FeaturePredictorServoingImageVisualizer(object):
 def do_rollouts(env, pol, num_trajs, num_steps, target_distance=0,
                 output_dir=None, image_visualizer=None, record_file=None,
                 verbose=False, gamma=0.9, seeds=None, reset_states=None,
-                cv2_record_file=None, image_transformer=None, ret_rewards_only=False, close_env=False):
+                cv2_record_file=None, image_transformer=None, ret_rewards_only=False, close_env=False,
+                num_write_threads=0):
     """
     image_transformer is for the returned observations and for cv2's video writer
+    num_write_threads is the number of threads that write the images to output_dir (0 to write them synchronously)
     """
     random_state = np.random.get_state()
     if reset_states is None:
@@ -90,7 +92,7 @@ def do_rollouts(env, pol, num_trajs, num_steps, target_distance=0,
     else:
         num_trajs = min(num_trajs, len(reset_states))
     if output_dir:
-        container = ImageDataContainer(output_dir, 'x')
+        container = ImageDataContainer(output_dir, 'x', num_write_threads=num_write_threads)
         container.reserve(list(env.observation_space.spaces.keys()) + ['state'], (num_trajs, num_steps + 1))
         container.reserve(['action', 'reward'], (num_trajs, num_steps))
         container.add_info(environment_config=env.get_config())
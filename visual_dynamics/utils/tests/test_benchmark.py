@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+
+from nose2 import tools
+
+from visual_dynamics.utils.benchmark import run_benchmarks, load_transformers
+
+transformers_fname = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config', 'transformer',
+                                  'transformer_32.yaml')
+
+
+@tools.params(('file', 0, None),
+              ('hdf5', 2, 'thread'),
+              ('raw', 2, 'process'))
+def test_run_benchmarks(image_storage, nb_worker, parallel):
+    data_dir = tempfile.mkdtemp()
+    try:
+        results = run_benchmarks(data_dir,
+                                 image_storages=[image_storage],
+                                 transformers_fnames=[None, transformers_fname],
+                                 nb_workers=[nb_worker],
+                                 batch_sizes=[4],
+                                 parallels=[parallel or 'process'],
+                                 num_containers=2,
+                                 num_trajs=2,
+                                 num_steps=3,
+                                 num_batches=3)
+    finally:
+        shutil.rmtree(data_dir)
+    assert len(results) == 2
+    for result in results:
+        assert result['image_storage'] == image_storage
+        assert result['nb_worker'] == nb_worker
+        assert result['parallel'] == parallel
+        assert result['samples_per_sec'] > 0
+        assert 0 <= result['latency_p50'] <= result['latency_p99']
+        assert result['cpu_utilization'] > 0
+
+
+def test_load_transformers():
+    transformers = load_transformers(transformers_fname, action_dim=4)
+    assert set(transformers.keys()) == {'image', 'action'}
@@ -0,0 +1,144 @@
+import os
+import tempfile
+
+import numpy as np
+
+from visual_dynamics.utils.cache import FrameCache, PreprocessedDataCache, get_data_dir_signature
+from visual_dynamics.utils.container import ImageDataContainer
+from visual_dynamics.utils.generator import DataGenerator, ParallelGenerator
+from visual_dynamics.utils.transformer import OpsTransformer, ImageTransformer, CompositionTransformer
+
+container_fname = os.path.join(tempfile.mkdtemp(), 'data')
+num_trajs, num_steps = 3, 5
+
+with ImageDataContainer(container_fname, 'x') as container:
+    container.reserve(['image', 'action'], (num_trajs, num_steps))
+    for traj_iter in range(num_trajs):
+        for step_iter in range(num_steps):
+            container.add_datum(traj_iter, step_iter,
+                                image=np.random.randint(0, 256, size=(32, 32, 3)).astype(np.uint8),
+                                action=np.random.random(4).astype(np.float32))
+
+
+def get_transformers(scale_size=0.5):
+    image_transformer = CompositionTransformer(
+        [ImageTransformer(scale_size=scale_size, crop_size=(8, 8)),
+         OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=(2, 0, 1))])
+    return {'image': image_transformer, 'action': OpsTransformer(scale=0.1)}
+
+
+def get_all_batch_data(transformers, cache_dir=None, **kwargs):
+    data_name_offset_pairs = [('image', 0), ('action', 0), ('image', 1)]
+    with DataGenerator(container_fname, data_name_offset_pairs, transformers=transformers, once=True, batch_size=4,
+                       shuffle=False, dtype=np.float32, cache_dir=cache_dir, **kwargs) as generator:
+        return [np.concatenate(data) for data in zip(*generator)]
+
+
+def test_cached_generator():
+    cache_dir = tempfile.mkdtemp()
+    transformers = get_transformers()
+    all_batch_data = get_all_batch_data(transformers)
+    for _ in range(2):  # build the cache lazily and then read from it
+        cached_all_batch_data = get_all_batch_data(transformers, cache_dir=cache_dir)
+        for data, cached_data in zip(all_batch_data, cached_all_batch_data):
+            assert data.dtype == cached_data.dtype
+            assert np.allclose(data, cached_data, atol=1e-6)
+    with ImageDataContainer(container_fname) as container:
+        cache = PreprocessedDataCache(cache_dir, container, 'image', transformers['image'], dtype=np.float32)
+        assert cache.num_valid == num_trajs * num_steps
+    assert len(os.listdir(cache_dir)) == 4
+
+
+def test_cache_invalidation():
+    cache_dir = tempfile.mkdtemp()
+    with ImageDataContainer(container_fname) as container:
+        cache = PreprocessedDataCache(cache_dir, container, 'image', get_transformers()['image'])
+        cache.build(container)
+        assert cache.num_valid == num_trajs * num_steps
+        # a different transformer config uses a different cache
+        other_cache = PreprocessedDataCache(cache_dir, container, 'image', get_transformers(scale_size=0.25)['image'])
+        assert other_cache.data_fname != cache.data_fname
+        assert other_cache.num_valid == 0
+    # changes to the data use a different cache
+    data_fname = os.path.join(container_fname, 'data.h5')
+    os.utime(data_fname, (os.path.getatime(data_fname), os.path.getmtime(data_fname) + 1.0))
+    with ImageDataContainer(container_fname) as container:
+        other_cache = PreprocessedDataCache(cache_dir, container, 'image', get_transformers()['image'])
+        assert other_cache.data_fname != cache.data_fname
+        assert other_cache.num_valid == 0
+
+
+
+def test_data_dir_signature():
+    for image_storage, image_fname in [('file', 'image_0_0.jpg'), ('raw', 'image.npy')]:
+        data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+        with ImageDataContainer(data_dir, 'x', image_storage=image_storage) as container:
+            container.reserve(['image'], (1, 2))
+            for step_iter in range(2):
+                container.add_datum(0, step_iter, image=np.zeros((8, 8, 3), dtype=np.uint8))
+        signature = get_data_dir_signature(data_dir)
+        with ImageDataContainer(data_dir) as container:
+            container.get_data(np.array([0, 0]), np.array([0, 1]), ['image'])
+        assert get_data_dir_signature(data_dir) == signature
+        # images that are rewritten in place invalidate the signature
+        image_fname = os.path.join(data_dir, image_fname)
+        os.utime(image_fname, (os.path.getatime(image_fname), os.path.getmtime(image_fname) + 1.0))
+        assert get_data_dir_signature(data_dir) != signature
+
+
+def test_frame_cache_eviction():
+    frame = np.zeros((10, 10), dtype=np.uint8)
+    cache = FrameCache(3 * frame.nbytes)
+    for i in range(3):
+        cache.put(i, frame + i)
+    assert cache.get(0) is not None  # 0 is now more recently used than 1
+    cache.put(3, frame + 3)
+    assert len(cache) == 3 and cache.num_bytes == 3 * frame.nbytes
+    assert cache.get(1) is None
+    assert [cached_frame[0, 0] for cached_frame in cache.get_many([0, 2, 3])] == [0, 2, 3]
+    assert not cache.get(0).flags.writeable
+    cache.put(4, np.zeros((20, 20), dtype=np.uint8))  # larger than the budget
+    assert cache.get(4) is None
+    stats = cache.stats()
+    assert stats['hits'] == 5 and stats['misses'] == 2
+
+
+def test_frame_cached_generator():
+    transformers = get_transformers()
+    all_batch_data = get_all_batch_data(transformers)
+    for cache_preprocessed_frames in [False, True]:
+        frame_cache = FrameCache(2 ** 20)
+        for i in range(2):  # fill the cache and then read from it
+            cached_all_batch_data = get_all_batch_data(transformers, frame_cache=frame_cache,
+                                                       cache_preprocessed_frames=cache_preprocessed_frames)
+            for data, cached_data in zip(all_batch_data, cached_all_batch_data):
+                assert data.dtype == cached_data.dtype
+                assert np.allclose(data, cached_data, atol=1e-6)
+            assert frame_cache.misses == num_trajs * num_steps
+            assert frame_cache.hits == i * num_trajs * num_steps
+    # generators with different transformers can share the same frame cache of preprocessed images
+    frame_cache = FrameCache(2 ** 20)
+    get_all_batch_data(transformers, frame_cache=frame_cache, cache_preprocessed_frames=True)
+    other_transformers = get_transformers(scale_size=0.25)
+    other_all_batch_data = get_all_batch_data(other_transformers)
+    cached_other_all_batch_data = get_all_batch_data(other_transformers, frame_cache=frame_cache,
+                                                     cache_preprocessed_frames=True)
+    for data, cached_data in zip(other_all_batch_data, cached_other_all_batch_data):
+        assert np.allclose(data, cached_data, atol=1e-6)
+
+
+def test_frame_cached_parallel_generator():
+    frame_cache = FrameCache(4 * 32 * 32 * 3)  # smaller than the data so that frames are evicted concurrently
+    generator = DataGenerator(container_fname, [('image', 0), ('image', 1)], batch_size=4, shuffle=True,
+                              frame_cache=frame_cache)
+    with ImageDataContainer(container_fname) as container:
+        all_images = container.get_data(np.arange(num_trajs)[:, None], np.arange(num_steps)[None, :], 'image')
+    image_bytes_to_next = dict((all_images[traj_iter, step_iter].tobytes(), all_images[traj_iter, step_iter + 1])
+                               for traj_iter in range(num_trajs) for step_iter in range(num_steps - 1))
+    parallel_generator = ParallelGenerator(generator, nb_worker=4)
+    for _, (images, next_images) in zip(range(50), parallel_generator):
+        for image, next_image in zip(images, next_images):
+            assert np.all(image_bytes_to_next[image.tobytes()] == next_image)
+    parallel_generator.close()
+    assert len(frame_cache) <= 4
+    assert frame_cache.hits + frame_cache.misses > 0
@@ -0,0 +1,331 @@
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from nose2 import tools
+
+from visual_dynamics.utils import config
+from visual_dynamics.utils.container import DataContainer, ImageDataContainer, MultiDataContainer, ContainerPool
+
+container_fname = os.path.join(tempfile.mkdtemp(), 'data')
+num_trajs, num_steps = 3, 5
+image_shape = (16, 16, 3)
+images = np.random.randint(0, 256, size=(num_trajs, num_steps) + image_shape).astype(np.uint8)
+actions = np.random.random((num_trajs, num_steps, 4)).astype(np.float32)
+
+with ImageDataContainer(container_fname, 'x') as container:
+    container.reserve(['image', 'action'], (num_trajs, num_steps))
+    for traj_iter in range(num_trajs):
+        for step_iter in range(num_steps):
+            container.add_datum(traj_iter, step_iter,
+                                image=images[traj_iter, step_iter],
+                                action=actions[traj_iter, step_iter])
+
+
+def test_container_pool_reuse():
+    with ContainerPool() as container_pool:
+        container = container_pool.get_container(container_fname)
+        assert container_pool.get_container(container_fname) is container
+        assert np.allclose(container.get_datum(1, 2, 'action'), actions[1, 2])
+
+        other_containers = []
+        thread = threading.Thread(target=lambda: other_containers.append(container_pool.get_container(container_fname)))
+        thread.start()
+        thread.join()
+        other_container, = other_containers
+        assert other_container is not container
+    assert container.hdf5_file is None
+    assert other_container.hdf5_file is None
+
+
+def test_get_data():
+    traj_inds = np.array([2, 0, 2, 1, -1])[:, None]
+    step_inds = np.array([[4, 0], [1, 1], [4, 3], [0, -1], [2, 2]])
+    with ImageDataContainer(container_fname) as container:
+        image_data, action_data = container.get_data(traj_inds, step_inds, ['image', 'action'])
+        assert image_data.shape == step_inds.shape + image_shape
+        assert action_data.shape == step_inds.shape + (4,)
+        for ind in np.ndindex(*step_inds.shape):
+            traj_ind, step_ind = traj_inds[ind[0], 0], step_inds[ind]
+            image, action = container.get_datum(traj_ind, step_ind, ['image', 'action'])
+            assert np.all(image_data[ind] == image)
+            assert np.all(action_data[ind] == actions[traj_ind, step_ind])
+
+
+def test_convert_image_storage():
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    shutil.copytree(container_fname, data_dir)
+    with ImageDataContainer(data_dir) as container:
+        file_images = container.get_data(np.arange(num_trajs)[:, None], np.arange(num_steps)[None, :], 'image')
+    for image_storage in ['hdf5', 'file', 'hdf5', 'raw']:
+        with ImageDataContainer(data_dir, 'r+') as container:
+            container.convert_image_storage(image_storage)
+        assert any(fname.endswith('.jpg') for fname in os.listdir(data_dir)) == (image_storage == 'file')
+        assert any(fname.endswith('.npy') for fname in os.listdir(data_dir)) == (image_storage == 'raw')
+        with ImageDataContainer(data_dir) as container:
+            assert container.image_storage == image_storage
+            images = container.get_data(np.arange(num_trajs)[:, None], np.arange(num_steps)[None, :], 'image')
+            assert np.all(images == file_images)
+            assert np.all(container.get_datum(1, 2, 'image') == file_images[1, 2])
+            assert np.allclose(container.get_datum(1, 2, 'action'), actions[1, 2])
+    # converting from the raw storage re-encodes the images
+    with ImageDataContainer(data_dir, 'r+') as container:
+        container.convert_image_storage('file')
+    with ImageDataContainer(data_dir) as container:
+        images = container.get_data(np.arange(num_trajs)[:, None], np.arange(num_steps)[None, :], 'image')
+        assert np.abs(images.astype(int) - file_images).mean() < 10.0
+
+
+def test_hdf5_image_storage():
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', image_storage='hdf5') as container:
+        container.reserve(['image'], (num_trajs, num_steps))
+        for traj_iter in range(num_trajs):
+            for step_iter in range(num_steps):
+                container.add_datum(traj_iter, step_iter, image=images[traj_iter, step_iter])
+    assert not any(fname.endswith('.jpg') for fname in os.listdir(data_dir))
+    with ImageDataContainer(container_fname) as file_container, ImageDataContainer(data_dir) as container:
+        assert container.image_storage == 'hdf5'
+        for traj_iter, step_iter in [(0, 0), (2, 4), (1, -1)]:
+            assert np.all(container.get_datum(traj_iter, step_iter, 'image') ==
+                          file_container.get_datum(traj_iter, step_iter, 'image'))
+
+
+@tools.params('file', 'hdf5', 'raw')
+def test_async_image_writes(image_storage):
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', image_storage=image_storage, num_write_threads=3,
+                            max_queued_writes=2) as container:
+        container.reserve(['image', 'action'], (num_trajs, num_steps))
+        image = np.empty(image_shape, dtype=np.uint8)
+        for traj_iter in range(num_trajs):
+            for step_iter in range(num_steps):
+                image[...] = images[traj_iter, step_iter]  # the same buffer is reused for every image
+                container.add_datum(traj_iter, step_iter, image=image, action=actions[traj_iter, step_iter])
+    with ImageDataContainer(container_fname) as file_container, ImageDataContainer(data_dir) as container:
+        all_inds = (np.arange(num_trajs)[:, None], np.arange(num_steps)[None, :])
+        if image_storage == 'raw':
+            expected_images = images
+        else:
+            expected_images = file_container.get_data(*(all_inds + ('image',)))
+        assert np.all(container.get_data(*(all_inds + ('image',))) == expected_images)
+        assert np.allclose(container.get_data(*(all_inds + ('action',))), actions)
+
+
+def test_async_image_write_errors():
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    container = ImageDataContainer(data_dir, 'x', image_storage='hdf5', num_write_threads=2)
+    container.reserve(['image', 'other_image'], (num_trajs, num_steps))
+    container.add_datum(0, 0, image=images[0, 0])
+    container.add_datum(0, 0, other_image=np.zeros((16, 16, 5), dtype=np.uint8))  # can't be encoded as a JPEG
+    try:
+        container.close()
+    except IOError:
+        pass
+    else:
+        assert False, 'the error of the write thread was not raised'
+    assert container.hdf5_file is None
+    with ImageDataContainer(container_fname) as file_container, ImageDataContainer(data_dir) as container:
+        assert np.all(container.get_datum(0, 0, 'image') == file_container.get_datum(0, 0, 'image'))
+
+
+@tools.params(('file', 0), ('hdf5', 0), ('hdf5', 2))
+def test_appendable_container(image_storage, num_write_threads):
+    traj_lengths = [num_steps, 2, 0, 1, num_steps]
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', image_storage=image_storage,
+                            num_write_threads=num_write_threads) as container:
+        container.reserve(['image', 'action'], (None, None))
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            for step_iter in range(traj_length):
+                container.add_datum(traj_iter, step_iter, image=images[traj_iter % num_trajs, step_iter],
+                                    action=actions[traj_iter % num_trajs, step_iter])
+        try:
+            container.add_datum(1, 3, action=actions[0, 0])
+        except IndexError:
+            pass
+        else:
+            assert False, 'adding a data point that is not the next one of the last trajectory should fail'
+    with ImageDataContainer(container_fname) as file_container, ImageDataContainer(data_dir) as container:
+        assert container.get_traj_lengths('image').tolist() == traj_lengths
+        assert container.get_data_size('action') == sum(traj_lengths)
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            step_inds = np.arange(traj_length)
+            image_data, action_data = container.get_data(traj_iter, step_inds, ['image', 'action'])
+            assert np.all(image_data == file_container.get_data(traj_iter % num_trajs, step_inds, 'image'))
+            assert np.allclose(action_data, actions[traj_iter % num_trajs, :traj_length])
+        assert np.allclose(container.get_datum(-2, -1, 'action'), actions[0, 0])
+        try:
+            container.get_datum(2, 0, 'action')
+        except IndexError:
+            pass
+        else:
+            assert False, 'reading past the end of a trajectory should fail'
+
+
+def test_appendable_container_flushing():
+    traj_lengths = [DataContainer.APPEND_CHUNK_SIZE + 1, 2]
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with DataContainer(data_dir, 'x') as container:
+        container.reserve('action', (None, None))
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            for step_iter in range(traj_length):
+                container.add_datum(traj_iter, step_iter, action=actions[0, 0])
+            # the datasets grow by whole chunks
+            assert container.hdf5_file['action'].shape[0] % DataContainer.APPEND_CHUNK_SIZE == 0
+        # the trajectories that were completed before the last one was started are in the info file
+        with open(os.path.join(data_dir, 'info.yaml')) as info_file:
+            info_dict = config.from_yaml(info_file)
+        assert info_dict['traj_lengths']['action'] == traj_lengths[:-1] + [1]
+    with DataContainer(data_dir) as container:
+        assert container.get_traj_lengths('action').tolist() == traj_lengths
+        assert container.hdf5_file['action'].shape[0] == sum(traj_lengths)
+
+
+def test_appendable_container_raw_conversion():
+    traj_lengths = [num_steps, 3, 1]
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', image_storage='hdf5') as container:
+        container.reserve('image', (len(traj_lengths), None))
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            for step_iter in range(traj_length):
+                container.add_datum(traj_iter, step_iter, image=images[traj_iter, step_iter])
+        try:
+            container.add_datum(len(traj_lengths), 0, image=images[0, 0])
+        except IndexError:
+            pass
+        else:
+            assert False, 'adding more trajectories than reserved should fail'
+    with ImageDataContainer(data_dir) as container:
+        hdf5_images = [container.get_data(traj_iter, np.arange(traj_length), 'image')
+                       for traj_iter, traj_length in enumerate(traj_lengths)]
+    with ImageDataContainer(data_dir, 'r+') as container:
+        container.convert_image_storage('raw')
+    with ImageDataContainer(data_dir) as container:
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            assert np.all(container.get_data(traj_iter, np.arange(traj_length), 'image') == hdf5_images[traj_iter])
+
+
+@tools.params(0, 2)
+def test_multi_data_container(num_read_threads):
+    # second container with variable-length trajectories
+    traj_lengths = [2, num_steps, 1]
+    other_container_fname = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(other_container_fname, 'x') as container:
+        container.reserve(['image', 'action'], (None, None))
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            for step_iter in range(traj_length):
+                container.add_datum(traj_iter, step_iter, image=images[traj_iter, step_iter],
+                                    action=actions[traj_iter, step_iter])
+    data_dirs = [container_fname, other_container_fname, container_fname]
+    all_traj_lengths = [num_steps] * num_trajs + traj_lengths + [num_steps] * num_trajs
+    with MultiDataContainer(data_dirs, num_read_threads=num_read_threads) as multi_container:
+        assert multi_container.get_datum_shape('image') == image_shape
+        assert multi_container.get_data_shape('action') == (len(all_traj_lengths), None)
+        assert multi_container.get_traj_lengths('action').tolist() == all_traj_lengths
+        assert multi_container.get_data_size('action') == sum(all_traj_lengths)
+        # the containers are only opened when their data is read
+        assert all(container is None for container in multi_container._containers)
+        assert np.allclose(multi_container.get_datum(num_trajs + 1, 3, 'action'), actions[1, 3])
+        assert [container is not None for container in multi_container._containers] == [False, True, False]
+
+        traj_inds = np.array([0, 3, 5, -1, num_trajs + 1, 2])
+        step_inds = np.array([4, 1, 0, -2, 4, 0])
+        image_data, action_data = multi_container.get_data(traj_inds, step_inds, ['image', 'action'])
+        for traj_ind, step_ind, image, action in zip(traj_inds, step_inds, image_data, action_data):
+            expected_image, expected_action = multi_container.get_datum(traj_ind, step_ind, ['image', 'action'])
+            assert np.all(image == expected_image)
+            assert np.allclose(action, expected_action)
+        assert np.allclose(action_data[:3], [actions[0, 4], actions[0, 1], actions[2, 0]])
+        assert np.allclose(action_data[3], actions[-1, -2])
+        try:
+            multi_container.get_data([0, len(all_traj_lengths)], 0, 'action')
+        except IndexError:
+            pass
+        else:
+            assert False, 'reading a trajectory past the last container should fail'
+    assert all(container is None for container in multi_container._containers)
+
+
+depth_images = np.random.uniform(0.5, 50.0, size=(num_trajs, num_steps) + image_shape[:2] + (1,)).astype(np.float32)
+
+
+@tools.params(('packed', 'hdf5', None),
+              ('float16', 'file', 2e-2),
+              ('float16', 'hdf5', 2e-2),
+              ('float16', 'raw', 2e-2),
+              ('uint16_mm', 'hdf5', 5e-4),
+              ('uint16_mm', 'raw', 5e-4))
+def test_depth_storage(depth_storage, image_storage, atol):
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', image_storage=image_storage, depth_storage=depth_storage) as container:
+        container.reserve(['image', 'depth_image'], (num_trajs, num_steps))
+        for traj_iter in range(num_trajs):
+            for step_iter in range(num_steps):
+                container.add_datum(traj_iter, step_iter, image=images[traj_iter, step_iter],
+                                    depth_image=depth_images[traj_iter, step_iter])
+    with ImageDataContainer(data_dir) as container:
+        assert container.depth_storage == depth_storage
+        all_inds = (np.arange(num_trajs)[:, None], np.arange(num_steps)[None, :])
+        data_depth_images = container.get_data(*(all_inds + ('depth_image',)))
+        assert data_depth_images.dtype == np.float32
+        assert data_depth_images.shape == depth_images.shape
+        if atol is not None:  # the packed depth images have JPEG artifacts
+            assert np.allclose(data_depth_images, depth_images, atol=atol)
+        assert np.all(container.get_datum(1, 2, 'depth_image') == data_depth_images[1, 2])
+    if depth_storage != 'packed' and image_storage != 'raw':
+        # array depth images are moved along with the other images to and from the raw storage
+        for other_image_storage in ['raw', image_storage]:
+            with ImageDataContainer(data_dir, 'r+') as container:
+                container.convert_image_storage(other_image_storage)
+            with ImageDataContainer(data_dir) as container:
+                assert np.all(container.get_data(*(all_inds + ('depth_image',))) == data_depth_images)
+
+
+def test_depth_storage_of_old_containers():
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', depth_storage='packed') as container:
+        container.reserve('depth_image', (num_trajs, num_steps))
+        container.add_datum(0, 0, depth_image=depth_images[0, 0])
+        del container.info_dict['depth_storage']  # containers created before the depth storage option
+    with ImageDataContainer(data_dir) as container:
+        assert container.depth_storage == 'packed'
+        assert container.get_datum(0, 0, 'depth_image').shape == depth_images[0, 0].shape
+    num_fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+    errors = []  # the tracebacks of the errors keep the containers from being garbage collected
+    for container_kwargs in [dict(mode='r+', depth_storage='float16'), dict(mode='r', image_storage='hdf5')]:
+        try:
+            ImageDataContainer(data_dir, **container_kwargs)
+        except ValueError as e:
+            errors.append(e)
+        else:
+            assert False, 'opening a container with a different storage than its own one should fail'
+        if num_fds is not None:
+            # the files opened before the storages were checked are closed
+            assert len(os.listdir('/proc/self/fd')) == num_fds
+
+
+@tools.params('file', 'hdf5')
+def test_threaded_image_decoding(image_storage):
+    data_dir = os.path.join(tempfile.mkdtemp(), 'data')
+    with ImageDataContainer(data_dir, 'x', image_storage=image_storage, depth_storage='packed') as container:
+        container.reserve(['image', 'depth_image'], (num_trajs, num_steps))
+        for traj_iter in range(num_trajs):
+            for step_iter in range(num_steps):
+                container.add_datum(traj_iter, step_iter, image=images[traj_iter, step_iter],
+                                    depth_image=depth_images[traj_iter, step_iter])
+    traj_inds = np.array([2, 0, 2, 1, -1])[:, None]
+    step_inds = np.array([[4, 0], [1, 1], [4, 3], [0, -1], [2, 2]])
+    with ImageDataContainer(data_dir) as container:
+        image_data, depth_image_data = container.get_data(traj_inds, step_inds, ['image', 'depth_image'])
+    with ImageDataContainer(data_dir, num_decode_threads=3) as container:
+        threaded_image_data, threaded_depth_image_data = \
+            container.get_data(traj_inds, step_inds, ['image', 'depth_image'])
+        assert np.all(container.get_datum(2, 4, 'image') == threaded_image_data[0, 0])
+    assert container._decode_pool is None
+    assert threaded_image_data.dtype == image_data.dtype
+    assert np.all(threaded_image_data == image_data)
+    assert threaded_depth_image_data.dtype == depth_image_data.dtype
+    assert np.all(threaded_depth_image_data == depth_image_data)
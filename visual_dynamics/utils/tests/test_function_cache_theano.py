@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    import theano
+    import theano.tensor as T
+    from visual_dynamics.utils import function_cache_theano
+except ImportError:
+    theano = None
+
+
+def build_graph():
+    X_var = T.matrix('x')
+    W_var = theano.shared(np.arange(12, dtype=theano.config.floatX).reshape((3, 4)), name='W')
+    b_var = theano.shared(np.ones(4, dtype=theano.config.floatX))  # unnamed, like the states of the optimizers
+    Y_var = T.dot(X_var, W_var) + b_var
+    updates = [(W_var, W_var * 2), (b_var, b_var + 1)]
+    return X_var, Y_var, W_var, b_var, updates
+
+
+def test_function_cache():
+    if theano is None:
+        raise unittest.SkipTest('theano is not installed')
+    function_cache_dir = tempfile.mkdtemp()
+    old_function_cache_dir = function_cache_theano.get_function_cache_dir()
+    function_cache_theano.set_function_cache_dir(function_cache_dir)
+    try:
+        X = np.random.random((2, 3)).astype(theano.config.floatX)
+        X_var, Y_var, W_var, b_var, updates = build_graph()
+        fn = function_cache_theano.compile_function('test', [X_var], Y_var, updates=updates)
+        assert len(os.listdir(function_cache_dir)) == 1
+        Y = fn(X)
+
+        # the function of an identical graph is loaded, and it uses and updates the shared variables of that graph
+        X_var, Y_var, W_var, b_var, updates = build_graph()
+        W_var.set_value(W_var.get_value() * 3)
+        cached_fn = function_cache_theano.compile_function('test', [X_var], Y_var, updates=updates)
+        assert len(os.listdir(function_cache_dir)) == 1
+        assert np.allclose(cached_fn(X), X.dot(W_var.get_value() / 2) + b_var.get_value() - 1)
+        assert not np.allclose(Y, X.dot(W_var.get_value() / 2) + b_var.get_value() - 1)
+        assert np.allclose(W_var.get_value(), np.arange(12).reshape((3, 4)) * 6)
+        assert np.allclose(b_var.get_value(), 2)
+
+        # a different graph is compiled and stored separately
+        X_var, Y_var, W_var, b_var, updates = build_graph()
+        function_cache_theano.compile_function('test', [X_var], 2 * Y_var, updates=updates)
+        assert len(os.listdir(function_cache_dir)) == 2
+    finally:
+        function_cache_theano.set_function_cache_dir(old_function_cache_dir)
+        shutil.rmtree(function_cache_dir)
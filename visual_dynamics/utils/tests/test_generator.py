@@ -1,9 +1,12 @@
+import os
 import tempfile
 
 import numpy as np
 from nose2 import tools
 
-from visual_dynamics.utils import DataContainer, DataGenerator
+from visual_dynamics.utils.container import DataContainer
+from visual_dynamics.utils.generator import DataGenerator, MultiprocessGenerator
+from visual_dynamics.utils.transformer import Transformer
 
 container_fnames = [tempfile.mktemp() for _ in range(4)]
 num_steps_per_traj = [100] * 4 + [50] * 12 + [100] + [150] * 6
@@ -117,3 +120,155 @@ def test_generator_list_offset(offset_limits):
         assert (traj_iters_traj == traj_iters_traj[0, :]).all()
         # all consecutive step_iters should differ by 1
         assert ((step_iters_traj - np.arange(len(step_iters_traj))[:, None]) == step_iters_traj[0, :]).all()
+
+
+class WorkerFailingTransformer(Transformer):
+    def __init__(self, pid):
+        self.pid = pid
+
+    def preprocess(self, data):
+        if os.getpid() != self.pid:
+            raise ValueError('failing in worker process')
+        return data
+
+
+@tools.params((1, 1), (4, 2), (4, 10))
+def test_multiprocess_generator(nb_worker, max_q_size):
+    data_name_offset_pairs = [('container_ind', 0), ('traj_iter', 0), ('step_iter', slice(0, 2))]
+    generator = DataGenerator(container_fnames,
+                              data_name_offset_pairs=data_name_offset_pairs,
+                              batch_size=32,
+                              shuffle=False,
+                              once=True)
+    all_batch_data = list(generator)
+    generator = DataGenerator(container_fnames,
+                              data_name_offset_pairs=data_name_offset_pairs,
+                              batch_size=32,
+                              shuffle=False,
+                              once=True)
+    with MultiprocessGenerator(generator, max_q_size=max_q_size, nb_worker=nb_worker) as multiprocess_generator:
+        multiprocess_all_batch_data = list(multiprocess_generator)
+    assert len(all_batch_data) == len(multiprocess_all_batch_data)
+    for batch_data, multiprocess_batch_data in zip(all_batch_data, multiprocess_all_batch_data):
+        for datum, multiprocess_datum in zip(batch_data, multiprocess_batch_data):
+            assert datum.dtype == multiprocess_datum.dtype
+            assert np.all(datum == multiprocess_datum)
+
+
+def test_multiprocess_generator_exception():
+    generator = DataGenerator(container_fnames,
+                              data_name_offset_pairs=[('step_iter', 0)],
+                              transformers={'step_iter': WorkerFailingTransformer(os.getpid())},
+                              batch_size=32,
+                              shuffle=True)
+    with MultiprocessGenerator(generator, nb_worker=2) as multiprocess_generator:
+        next(multiprocess_generator)  # the first minibatch is computed in this process
+        try:
+            next(multiprocess_generator)
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'the exception of the worker process was not propagated'
+
+
+class CountingTransformer(Transformer):
+    def __init__(self):
+        self.count = 0
+
+    def preprocess_batch(self, data, out=None):
+        self.count += len(data)
+        return super(CountingTransformer, self).preprocess_batch(data, out=out)
+
+
+def test_generator_unique_reads():
+    transformer = CountingTransformer()
+    generator = DataGenerator(container_fnames,
+                              data_name_offset_pairs=[('container_ind', 0), ('traj_iter', 0),
+                                                      ('step_iter', 0), ('step_iter', 1)],
+                              transformers={'step_iter': transformer},
+                              batch_size=32,
+                              shuffle=False,
+                              once=True)
+    num_unique_data = 0
+    for batch_data in generator:
+        container_inds, traj_iters, step_iters, next_step_iters = batch_data
+        assert np.all(next_step_iters == step_iters + 1)
+        unique_data = set(zip(container_inds, traj_iters, step_iters)) | \
+            set(zip(container_inds, traj_iters, next_step_iters))
+        num_unique_data += len(unique_data)
+    # each step is preprocessed once per minibatch, even if it is requested for both offsets
+    assert transformer.count == num_unique_data
+
+
+def get_step_iter_generator(**kwargs):
+    return DataGenerator(container_fnames,
+                         data_name_offset_pairs=[('container_ind', 0), ('traj_iter', 0), ('step_iter', 0)],
+                         batch_size=32,
+                         shuffle=True,
+                         **kwargs)
+
+
+def get_batch_data_ids(batch_data):
+    return np.stack(batch_data, axis=1).tolist()
+
+
+@tools.params(10, 62, 90)
+def test_generator_resume(num_batches):
+    num_total_batches = 100  # more than one pass over the data
+    generator = get_step_iter_generator(seed=7)
+    all_batch_data = [get_batch_data_ids(next(generator)) for _ in range(num_total_batches)]
+    generator = get_step_iter_generator(seed=7)
+    resumed_all_batch_data = [get_batch_data_ids(next(generator)) for _ in range(num_batches)]
+    state_dict = generator.state_dict()
+    generator = get_step_iter_generator()
+    generator.load_state_dict(state_dict)
+    resumed_all_batch_data.extend(get_batch_data_ids(next(generator))
+                                  for _ in range(num_total_batches - num_batches))
+    assert all_batch_data == resumed_all_batch_data
+
+
+def test_generator_shard():
+    generator = get_step_iter_generator(seed=7, once=True)
+    all_batch_data = [get_batch_data_ids(batch_data) for batch_data in generator]
+    num_shards = 3
+    shards_batch_data = [[get_batch_data_ids(batch_data)
+                          for batch_data in get_step_iter_generator(seed=7, once=True).shard(shard_id, num_shards)]
+                         for shard_id in range(num_shards)]
+    interleaved_batch_data = [batch_data for batches_data in zip(*shards_batch_data) for batch_data in batches_data]
+    num_interleaved = len(interleaved_batch_data)
+    for shard_batch_data in shards_batch_data:  # the first shards may have one more minibatch
+        interleaved_batch_data.extend(shard_batch_data[num_interleaved // num_shards:])
+    assert all_batch_data == interleaved_batch_data
+
+
+def test_multiprocess_generator_state_dict():
+    generator = get_step_iter_generator(seed=7)
+    all_batch_data = [get_batch_data_ids(next(generator)) for _ in range(20)]
+    with MultiprocessGenerator(get_step_iter_generator(seed=7), max_q_size=4, nb_worker=2) as multiprocess_generator:
+        for _ in range(5):
+            next(multiprocess_generator)
+        state_dict = multiprocess_generator.state_dict()
+    generator = get_step_iter_generator()
+    generator.load_state_dict(state_dict)
+    assert [get_batch_data_ids(next(generator)) for _ in range(15)] == all_batch_data[5:]
+
+
+def test_generator_variable_length():
+    traj_lengths = [5, 1, 0, 3, 2]
+    container_fname = tempfile.mktemp()
+    with DataContainer(container_fname, 'x') as container:
+        container.reserve(['traj_iter', 'step_iter'], (None, None))
+        for traj_iter, traj_length in enumerate(traj_lengths):
+            for step_iter in range(traj_length):
+                container.add_datum(traj_iter, step_iter, traj_iter=np.array(traj_iter),
+                                    step_iter=np.array(step_iter))
+    generator = DataGenerator([container_fname],
+                              data_name_offset_pairs=[('traj_iter', 0), ('step_iter', 0), ('step_iter', 1)],
+                              batch_size=4,
+                              shuffle=True,
+                              once=True)
+    all_batch_data = [get_batch_data_ids(batch_data) for batch_data in generator]
+    # only the steps that have a next step within their trajectory are used
+    expected_ids = [[traj_iter, step_iter, step_iter + 1] for traj_iter, traj_length in enumerate(traj_lengths)
+                    for step_iter in range(traj_length - 1)]
+    assert sorted(sum(all_batch_data, [])) == expected_ids
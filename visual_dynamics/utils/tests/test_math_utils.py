@@ -1,7 +1,7 @@
 import numpy as np
 from nose2 import tools
 
-from visual_dynamics import utils
+from visual_dynamics.utils.math_utils import OnlineStatistics
 
 
 @tools.params(((1000, 25), 10, 0),
@@ -10,7 +10,7 @@ from visual_dynamics import utils
               ((1000, 1, 2, 3), 10, (0, 3))
               )
 def test_online_statistics(shape, batch_size, axis):
-    online_stats = utils.OnlineStatistics(axis=axis)
+    online_stats = OnlineStatistics(axis=axis)
     X = np.random.random(shape)
     if isinstance(axis, (list, tuple)):
         data_size = np.prod([X.shape[ax] for ax in axis])
@@ -24,10 +24,30 @@ def test_online_statistics(shape, batch_size, axis):
                 slices.append(slice(curr_ind, min(curr_ind + batch_size, data_size)))
             else:
                 slices.append(slice(None))
-        batch_data = X[slices]
+        batch_data = X[tuple(slices)]
         online_stats.add_data(batch_data)
         curr_ind += batch_size
     mean = X.mean(axis=axis)
     std = X.std(axis=axis)
     assert np.allclose(mean, online_stats.mean)
     assert np.allclose(std, online_stats.std)
+
+
+@tools.params(0, ((0, 2, 3),))
+def test_online_statistics_merge(axis):
+    # large offset relative to the spread, for which the sum of squares is unstable in float32
+    X = (1000.0 + np.random.random((1000, 8, 3, 3))).astype(np.float32)
+    all_online_stats = [OnlineStatistics(axis=axis, covariance=True) for _ in range(3)]
+    for i, batch_data in enumerate(np.array_split(X, 13)):  # batches are streamed round-robin to 3 workers
+        all_online_stats[i % 3].add_data(batch_data)
+    online_stats = OnlineStatistics(axis=axis, covariance=True)
+    online_stats.merge(all_online_stats[0]).merge(all_online_stats[1]).merge(all_online_stats[2])
+    X = X.astype(np.float64)
+    assert online_stats.n == (X.shape[0] if axis == 0 else X.size // X.shape[1])
+    assert np.allclose(online_stats.mean, X.mean(axis=axis), rtol=0, atol=1e-10)
+    assert np.allclose(online_stats.std, X.std(axis=axis), rtol=1e-8)
+    if axis == 0:
+        X_matrix = X.reshape((X.shape[0], -1))
+    else:
+        X_matrix = X.transpose((0, 2, 3, 1)).reshape((-1, X.shape[1]))
+    assert np.allclose(online_stats.cov, np.cov(X_matrix.T, bias=True), rtol=1e-8)
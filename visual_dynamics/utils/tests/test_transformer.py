@@ -1,7 +1,8 @@
 import numpy as np
 from nose2 import tools
 
-from visual_dynamics.utils.transformer import Transformer, OpsTransformer, ImageTransformer, CompositionTransformer
+from visual_dynamics.utils.transformer import Transformer, OpsTransformer, ImageTransformer, CompositionTransformer, \
+    FusedImagePreprocessPlan
 
 
 @tools.params(Transformer(),
@@ -53,3 +54,103 @@ def test_process_shape_roundtripping(transformer):
     shape_prime = transformer.deprocess_shape(pre_data.shape)
     assert shape_prime == data.shape, "Expected {} to equal {}".format(shape_prime, data.shape)
     assert pre_shape_prime == pre_data.shape, "Expected {} to equal {}".format(pre_shape_prime, pre_data.shape)
+
+
+@tools.params(Transformer(),
+              OpsTransformer(scale=2.0, offset=-1.0),
+              OpsTransformer(scale=2.0 / 255.0, offset=-1.0, exponent=-1, transpose=(2, 0, 1)),
+              OpsTransformer(scale=[1.0, 2.0, 3.0, 4.0], offset=[0.1, 0.2, 0.3, 0.4]),
+              ImageTransformer(),
+              ImageTransformer(scale_size=0.125, crop_size=[32, 32], crop_offset=[2, -2]),
+              CompositionTransformer([]),
+              CompositionTransformer(
+                  [ImageTransformer(scale_size=0.125, crop_size=[32, 32]),
+                   OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=(2, 0, 1))]),
+              )
+def test_batch_processing(transformer):
+    if isinstance(transformer, OpsTransformer) and transformer.scale.shape == (4,):
+        data = np.random.random((5, 6))
+    else:
+        data = np.random.randint(0, 256, size=(5, 480, 640, 3)).astype(np.uint8)
+    pre_data = transformer.preprocess_batch(data)
+    assert pre_data.shape == transformer.preprocess_batch_shape(data.shape)
+    for datum, pre_datum in zip(data, pre_data):
+        assert np.allclose(pre_datum, transformer.preprocess(datum))
+    data_prime = transformer.deprocess_batch(pre_data)
+    assert data_prime.shape == transformer.deprocess_batch_shape(pre_data.shape)
+    for pre_datum, datum_prime in zip(pre_data, data_prime):
+        assert np.allclose(datum_prime, transformer.deprocess(pre_datum))
+
+
+@tools.params((CompositionTransformer(
+                   [ImageTransformer(scale_size=0.125, crop_size=[32, 32]),
+                    OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=(2, 0, 1))]), (480, 640, 3), np.uint8),
+              (CompositionTransformer(
+                  [ImageTransformer(scale_size=0.5, crop_size=[64, 48], crop_offset=[3, -5]),
+                   OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=(2, 0, 1))]), (240, 320, 3), np.uint8),
+              (CompositionTransformer(
+                  [ImageTransformer(scale_size=0.25, crop_size=[32, 32]),
+                   OpsTransformer(scale=[1.0, 2.0, 3.0], offset=0.5)]), (240, 320, 3), np.uint8),
+              (CompositionTransformer(
+                  [ImageTransformer(scale_size=1.0 / 3.0),
+                   OpsTransformer(scale=0.1, exponent=-1.0)]), (240, 321), np.float32),
+              (CompositionTransformer(
+                  [ImageTransformer(scale_size=0.3, crop_size=[32, 32]),
+                   OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=(2, 0, 1))]), (240, 320, 3), np.uint8),
+              (CompositionTransformer(
+                  [ImageTransformer(crop_size=[32, 32]),
+                   OpsTransformer(scale=2.0, transpose=(1, 0))]), (240, 320), np.float64),
+              (CompositionTransformer([ImageTransformer(scale_size=0.25)]), (240, 320), np.uint8),
+              (CompositionTransformer(
+                  [ImageTransformer(scale_size=0.5, crop_size=[32, 32]),
+                   OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=(2, 0, 1))]), (120, 160, 1), np.uint8),
+              (CompositionTransformer(
+                  [ImageTransformer(scale_size=0.3),
+                   OpsTransformer(scale=0.1, exponent=-1.0)]), (100, 107, 1), np.float32),
+              )
+def test_fused_image_preprocessing(transformer, image_shape, dtype):
+    if dtype == np.uint8:
+        images = np.random.randint(0, 256, size=(4,) + image_shape).astype(dtype)
+    else:
+        images = np.random.uniform(1.0, 10.0, size=(4,) + image_shape).astype(dtype)
+    assert FusedImagePreprocessPlan.compile(transformer.transformers, image_shape, dtype) is not None
+    pre_images = np.array([transformer.preprocess(image) for image in images])
+    fused_pre_images = transformer.preprocess_batch(images)
+    assert fused_pre_images.shape == pre_images.shape
+    assert fused_pre_images.dtype == pre_images.dtype
+    assert np.allclose(fused_pre_images, pre_images, atol=1e-5)
+    assert pre_images.shape[1:] == transformer.preprocess_shape(image_shape)
+    out = np.empty(pre_images.shape, dtype=np.float32)
+    assert transformer.preprocess_batch(images, out=out) is out
+    assert np.allclose(out, pre_images, atol=1e-5)
+    # the plan is only compiled once for images of the same shape and dtype
+    assert len(transformer._preprocess_plans) == 1
+
+
+@tools.params(2, 3, 4, 8)
+def test_fused_block_downsampling(factor):
+    image_transformer = ImageTransformer(scale_size=1.0 / factor, crop_size=[8, 8])
+    for dtype in [np.uint8, np.float32]:
+        images = np.random.randint(0, 256, size=(4, 16 * factor, 24 * factor, 3)).astype(dtype)
+        plan = FusedImagePreprocessPlan.compile([image_transformer], images.shape[1:], images.dtype)
+        out = np.empty((4, 8, 8, 3), dtype=dtype)
+        plan._downsample_blocks(images[:, 4 * factor:12 * factor, 8 * factor:16 * factor], factor, out)
+        assert np.allclose(out, image_transformer.preprocess_batch(images), atol=1e-4)
+
+
+@tools.params(((320, 320, 3), 1.0 / 3.0),
+              ((100, 107, 3), 0.125),
+              ((45, 52), 0.3),
+              ((31, 31, 3), 0.7),
+              )
+def test_non_integer_scale_shape(image_shape, scale_size):
+    transpose = (2, 0, 1) if len(image_shape) == 3 else (1, 0)
+    transformer = CompositionTransformer([ImageTransformer(scale_size=scale_size),
+                                          OpsTransformer(scale=2.0 / 255.0, offset=-1.0, transpose=transpose)])
+    images = np.random.randint(0, 256, size=(2,) + image_shape).astype(np.uint8)
+    pre_images = np.array([transformer.preprocess(image) for image in images])
+    assert transformer.preprocess_shape(image_shape) == pre_images.shape[1:]
+    # the output is allocated with the predicted shape, like DataGenerator does
+    out = np.empty(transformer.preprocess_batch_shape(images.shape), dtype=np.float32)
+    assert transformer.preprocess_batch(images, out=out) is out
+    assert np.allclose(out, pre_images, atol=1e-5)
@@ -19,6 +19,33 @@ class Transformer(ConfigObject):
     def deprocess_shape(self, shape):
         return shape
 
+    def preprocess_batch(self, data, out=None):
+        """
+        Preprocesses a batch of data, where the first axis is the batch axis.
+        Subclasses should override this with a vectorized implementation.
+
+        If out is given, the preprocessed data is written into it and out is
+        returned.
+        """
+        if type(self).preprocess == Transformer.preprocess:  # identity
+            return _assign_out(data, out)
+        return _assign_out(np.array([self.preprocess(datum) for datum in data]), out)
+
+    def deprocess_batch(self, data):
+        """
+        Deprocesses a batch of data, where the first axis is the batch axis.
+        Subclasses should override this with a vectorized implementation.
+        """
+        if type(self).deprocess == Transformer.deprocess:  # identity
+            return data
+        return np.array([self.deprocess(datum) for datum in data])
+
+    def preprocess_batch_shape(self, shape):
+        return tuple(shape[:1]) + tuple(self.preprocess_shape(shape[1:]))
+
+    def deprocess_batch_shape(self, shape):
+        return tuple(shape[:1]) + tuple(self.deprocess_shape(shape[1:]))
+
 
 class OpsTransformer(Transformer):
     def __init__(self, scale=1.0, offset=0.0, exponent=1.0, transpose=None):
@@ -33,11 +60,8 @@ class OpsTransformer(Transformer):
 
     def preprocess(self, data):
         self._data_dtype = data.dtype
-        # TODO
-        if data.shape == (6,) and (self.scale.shape == (4,) or self.offset.shape == (4,)):
-            data = np.append(self.scale[:3] * data[:3] + self.offset[:3], self.scale[3] * data[3:] + self.offset[3])
-        else:
-            data = self.scale * data + self.offset
+        scale, offset = self._get_scale_offset(data.shape)
+        data = scale * data + offset
         if self.exponent != 1.0:
             data = np.power(data, self.exponent)
         if self.transpose:
@@ -47,18 +71,44 @@ class OpsTransformer(Transformer):
     def deprocess(self, data):
         if self.transpose:
             data = np.transpose(data, self.transpose_inv)
-        # TODO
         if self.exponent != 1.0:
             data = np.power(data, 1.0 / self.exponent)
-        if data.shape == (6,) and (self.scale.shape == (4,) or self.offset.shape == (4,)):
-            data = np.append((data[:3] - self.offset[:3]) * (1.0 / self.scale[:3]),
-                             (data[3:] - self.offset[3]) * (1.0 / self.scale[3]))
-        else:
-            data = (data - self.offset) * (1.0 / self.scale)
+        scale, offset = self._get_scale_offset(data.shape)
+        data = (data - offset) * (1.0 / scale)
+        if self._data_dtype == np.uint8:
+            np.clip(data, 0, 255, out=data)
+        return data.astype(self._data_dtype)
+
+    def preprocess_batch(self, data, out=None):
+        self._data_dtype = data.dtype
+        scale, offset = self._get_scale_offset(data.shape[1:])
+        data = scale * data + offset
+        if self.exponent != 1.0:
+            data = np.power(data, self.exponent)
+        if self.transpose:
+            data = np.transpose(data, (0,) + tuple(axis + 1 for axis in self.transpose))
+        return _assign_out(data, out)
+
+    def deprocess_batch(self, data):
+        if self.transpose:
+            data = np.transpose(data, (0,) + tuple(axis + 1 for axis in self.transpose_inv))
+        if self.exponent != 1.0:
+            data = np.power(data, 1.0 / self.exponent)
+        scale, offset = self._get_scale_offset(data.shape[1:])
+        data = (data - offset) * (1.0 / scale)
         if self._data_dtype == np.uint8:
             np.clip(data, 0, 255, out=data)
         return data.astype(self._data_dtype)
 
+    def _get_scale_offset(self, shape):
+        scale, offset = self.scale, self.offset
+        # TODO
+        if tuple(shape) == (6,) and (np.shape(scale) == (4,) or np.shape(offset) == (4,)):
+            # the last scale and offset applies to the last 3 elements of the data
+            scale = np.broadcast_to(scale, (4,))[[0, 1, 2, 3, 3, 3]]
+            offset = np.broadcast_to(offset, (4,))[[0, 1, 2, 3, 3, 3]]
+        return scale, offset
+
     def preprocess_shape(self, shape):
         if self.transpose:
             shape = tuple(shape[axis] for axis in self.transpose)
@@ -97,20 +147,13 @@ class ImageTransformer(Transformer):
         if need_swap_channels:
             image = image.transpose(1, 2, 0)
         if self.scale_size is not None and self.scale_size != 1.0:
-            image = cv2.resize(image, (0, 0), fx=self.scale_size, fy=self.scale_size, interpolation=cv2.INTER_AREA)
+            scaled_image = cv2.resize(image, (0, 0), fx=self.scale_size, fy=self.scale_size,
+                                      interpolation=cv2.INTER_AREA)
+            # cv2 drops the channel axis of single-channel images
+            image = scaled_image.reshape(scaled_image.shape[:2] + image.shape[2:])
         if self.crop_size is not None and tuple(self.crop_size) != image.shape[:2]:
-            h, w = image_shape = np.asarray(image.shape[:2])
             crop_h, crop_w = self.crop_size
-            if crop_h > h:
-                raise ValueError('crop height %d is larger than image height %d (after scaling)' % (crop_h, h))
-            if crop_w > w:
-                raise ValueError('crop width %d is larger than image width %d (after scaling)' % (crop_w, w))
-            crop_origin = image_shape // 2
-            if self.crop_offset is not None:
-                crop_origin += self.crop_offset
-            crop_corner = crop_origin - self.crop_size // 2
-            if not (np.all(np.zeros(2) <= crop_corner) and np.all(crop_corner + self.crop_size <= image_shape)):
-                raise IndexError('crop indices out of range')
+            crop_corner = self._get_crop_corner(image.shape[:2])
             image = image[crop_corner[0]:crop_corner[0] + crop_h,
                           crop_corner[1]:crop_corner[1] + crop_w,
                           ...]
@@ -118,18 +161,64 @@ class ImageTransformer(Transformer):
             image = image.transpose(2, 0, 1)
         return image
 
+    def preprocess_batch(self, images, out=None):
+        need_swap_channels = (images.ndim == 4 and images.shape[1] == 3)
+        if need_swap_channels:
+            images = images.transpose(0, 2, 3, 1)
+        if self.scale_size is not None and self.scale_size != 1.0:
+            # cv2 only resizes one image at a time, so resize into a preallocated batch
+            scaled_images = None
+            for i, image in enumerate(images):
+                scaled_image = cv2.resize(image, (0, 0), fx=self.scale_size, fy=self.scale_size,
+                                          interpolation=cv2.INTER_AREA)
+                if scaled_images is None:
+                    scaled_images = np.empty((len(images),) + scaled_image.shape[:2] + images.shape[3:],
+                                             dtype=scaled_image.dtype)
+                scaled_images[i] = scaled_image.reshape(scaled_images.shape[1:])
+            if scaled_images is not None:
+                images = scaled_images
+        if self.crop_size is not None and tuple(self.crop_size) != images.shape[1:3]:
+            crop_h, crop_w = self.crop_size
+            crop_corner = self._get_crop_corner(images.shape[1:3])
+            images = images[:, crop_corner[0]:crop_corner[0] + crop_h,
+                            crop_corner[1]:crop_corner[1] + crop_w,
+                            ...]
+        if need_swap_channels:
+            images = images.transpose(0, 3, 1, 2)
+        return _assign_out(images, out)
+
+    def _get_crop_corner(self, image_shape):
+        h, w = image_shape = np.asarray(image_shape)
+        crop_h, crop_w = self.crop_size
+        if crop_h > h:
+            raise ValueError('crop height %d is larger than image height %d (after scaling)' % (crop_h, h))
+        if crop_w > w:
+            raise ValueError('crop width %d is larger than image width %d (after scaling)' % (crop_w, w))
+        crop_origin = image_shape // 2
+        if self.crop_offset is not None:
+            crop_origin += self.crop_offset
+        crop_corner = crop_origin - self.crop_size // 2
+        if not (np.all(np.zeros(2) <= crop_corner) and np.all(crop_corner + self.crop_size <= image_shape)):
+            raise IndexError('crop indices out of range')
+        return crop_corner
+
     def preprocess_shape(self, shape):
         need_swap_channels = (len(shape) == 3 and shape[0] == 3)
+        has_channels = len(shape) == 3
         if self.scale_size is not None and self.scale_size != 1.0:
             if need_swap_channels:
-                shape = (shape[0],) + tuple([int(d * self.scale_size) for d in shape[1:]])
+                shape = (shape[0],) + tuple([get_scaled_size(d, self.scale_size) for d in shape[1:]])
+            elif has_channels:
+                shape = tuple([get_scaled_size(d, self.scale_size) for d in shape[:-1]]) + (shape[-1],)
             else:
-                shape = tuple([int(d * self.scale_size) for d in shape[:-1]]) + (shape[-1],)
+                shape = tuple([get_scaled_size(d, self.scale_size) for d in shape])
         if self.crop_size is not None:
             if need_swap_channels:
                 shape = (shape[0],) + tuple(self.crop_size)
-            else:
+            elif has_channels:
                 shape = tuple(self.crop_size) + (shape[-1],)
+            else:
+                shape = tuple(self.crop_size)
         return shape
 
     def _get_config(self):
@@ -206,6 +295,7 @@ class DepthImageTransformer(OpsTransformer):
 class CompositionTransformer(Transformer):
     def __init__(self, transformers):
         self.transformers = transformers
+        self._preprocess_plans = dict()  # fused plans keyed by the shape and dtype of the images
 
     def preprocess(self, data):
         for transformer in self.transformers:
@@ -227,12 +317,185 @@ class CompositionTransformer(Transformer):
             shape = transformer.deprocess_shape(shape)
         return shape
 
+    def preprocess_batch(self, data, out=None):
+        plan_key = (data.shape[1:], data.dtype)
+        if plan_key not in self._preprocess_plans:
+            self._preprocess_plans[plan_key] = FusedImagePreprocessPlan.compile(self.transformers, *plan_key)
+        plan = self._preprocess_plans[plan_key]
+        if plan is not None:
+            return plan(data, out=out)
+        for transformer in self.transformers:
+            data = transformer.preprocess_batch(data)
+        return _assign_out(data, out)
+
+    def deprocess_batch(self, data):
+        for transformer in reversed(self.transformers):
+            data = transformer.deprocess_batch(data)
+        return data
+
+    def preprocess_batch_shape(self, shape):
+        for transformer in self.transformers:
+            shape = transformer.preprocess_batch_shape(shape)
+        return shape
+
+    def deprocess_batch_shape(self, shape):
+        for transformer in reversed(self.transformers):
+            shape = transformer.deprocess_batch_shape(shape)
+        return shape
+
     def _get_config(self):
         config = super(CompositionTransformer, self)._get_config()
         config.update({'transformers': self.transformers})
         return config
 
 
+class FusedImagePreprocessPlan(object):
+    CV2_RESIZE_DTYPES = tuple(np.dtype(dtype) for dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64))
+
+    def __init__(self, image_transformer, ops_transformer, image_shape, image_dtype):
+        """
+        Preprocesses batches of images with an (optional) ImageTransformer
+        followed by an (optional) OpsTransformer without materializing the
+        intermediate results of each transformer.
+
+        When downsampling by an integer factor, the source images are cropped
+        to the region that contributes to the crop before they are resized.
+        The images are resized with cv2's area interpolation or, for dtypes
+        that cv2 doesn't support, by averaging blocks of pixels (which gives
+        the same result). The output of the resize and crop is written
+        directly into the (transposed) output array, and the scale, offset
+        and exponent are applied in-place on it.
+        """
+        self.image_transformer = image_transformer
+        self.ops_transformer = ops_transformer
+        self.image_shape = tuple(image_shape)
+        self.image_dtype = np.dtype(image_dtype)
+        h, w = self.image_shape[:2]
+        scale_size = image_transformer.scale_size if image_transformer is not None else None
+        if scale_size is None or scale_size == 1.0:
+            self.factor = 1
+        else:
+            factor = int(round(1.0 / scale_size))
+            if factor > 1 and np.isclose(factor * scale_size, 1.0) and h % factor == 0 and w % factor == 0:
+                self.factor = factor
+            else:
+                self.factor = None  # fall back to cv2 to resize the images
+        if self.factor is not None:
+            scaled_shape = (h // self.factor, w // self.factor)
+        else:
+            scaled_shape = tuple(get_scaled_size(d, scale_size) for d in (h, w))
+        if image_transformer is not None and image_transformer.crop_size is not None and \
+                tuple(image_transformer.crop_size) != scaled_shape:
+            crop_h, crop_w = image_transformer.crop_size
+            crop_corner = image_transformer._get_crop_corner(scaled_shape)
+            self.crop_slices = (slice(crop_corner[0], crop_corner[0] + crop_h),
+                                slice(crop_corner[1], crop_corner[1] + crop_w))
+        else:
+            self.crop_slices = (slice(0, scaled_shape[0]), slice(0, scaled_shape[1]))
+        self.cropped_shape = tuple(sl.stop - sl.start for sl in self.crop_slices) + self.image_shape[2:]
+        self.output_shape = self.cropped_shape
+        self.output_dtype = self.image_dtype
+        if ops_transformer is not None:
+            self.output_shape = ops_transformer.preprocess_shape(self.output_shape)
+            dummy = np.zeros((1,) + self.cropped_shape, dtype=self.image_dtype)
+            self.output_dtype = ops_transformer.preprocess_batch(dummy).dtype
+
+    @staticmethod
+    def compile(transformers, image_shape, image_dtype):
+        """
+        Returns a plan for the given chain of transformers, or None if the
+        chain can't be fused.
+        """
+        transformers = list(transformers)
+        image_transformer = ops_transformer = None
+        if transformers and isinstance(transformers[0], ImageTransformer):
+            image_transformer = transformers.pop(0)
+        if transformers and isinstance(transformers[0], OpsTransformer):
+            ops_transformer = transformers.pop(0)
+        if transformers or (image_transformer is None and ops_transformer is None):
+            return None
+        if len(image_shape) not in (2, 3) or (len(image_shape) == 3 and image_shape[0] == 3):
+            return None  # only images with the channels last are supported
+        return FusedImagePreprocessPlan(image_transformer, ops_transformer, image_shape, image_dtype)
+
+    def __call__(self, images, out=None):
+        if images.shape[1:] != self.image_shape:
+            raise ValueError('expecting images of shape %r but got images of shape %r' %
+                             (self.image_shape, images.shape[1:]))
+        if out is None:
+            out = np.empty((len(images),) + self.output_shape, dtype=self.output_dtype)
+        elif out.shape != (len(images),) + self.output_shape:
+            raise ValueError('expecting output of shape %r but got output of shape %r' %
+                             ((len(images),) + self.output_shape, out.shape))
+        # view of the output with the same axes as the cropped images
+        if self.ops_transformer is not None and self.ops_transformer.transpose:
+            cropped_out = out.transpose((0,) + tuple(axis + 1 for axis in self.ops_transformer.transpose_inv))
+        else:
+            cropped_out = out
+
+        if self.factor is None:
+            for image, cropped_image_out in zip(images, cropped_out):
+                cropped_image_out[...] = self.image_transformer.preprocess(image).reshape(self.cropped_shape)
+        elif self.factor == 1:
+            cropped_out[...] = images[(slice(None),) + self.crop_slices]
+        else:
+            # when downsampling by an integer factor, cropping the corresponding source region before resizing it
+            # gives the same result as resizing the whole image and then cropping it
+            factor = self.factor
+            src_crop_slices = tuple(slice(sl.start * factor, sl.stop * factor) for sl in self.crop_slices)
+            src_images = images[(slice(None),) + src_crop_slices]
+            if self.image_dtype in self.CV2_RESIZE_DTYPES:
+                for src_image, cropped_image_out in zip(src_images, cropped_out):
+                    cropped_image = cv2.resize(src_image, (0, 0), fx=1.0 / factor, fy=1.0 / factor,
+                                               interpolation=cv2.INTER_AREA)
+                    cropped_image_out[...] = cropped_image.reshape(self.cropped_shape)
+            else:
+                self._downsample_blocks(src_images, factor, cropped_out)
+
+        if self.ops_transformer is not None:
+            self.ops_transformer._data_dtype = self.image_dtype
+            scale, offset = self.ops_transformer._get_scale_offset(self.cropped_shape)
+            cropped_out *= scale
+            cropped_out += offset
+            if self.ops_transformer.exponent != 1.0:
+                np.power(cropped_out, self.ops_transformer.exponent, out=cropped_out)
+        return out
+
+    def _downsample_blocks(self, images, factor, out):
+        """
+        Downsamples the images by averaging blocks of factor x factor pixels.
+        This is used for the dtypes that cv2 can't resize.
+        """
+        crop_h, crop_w = self.cropped_shape[:2]
+        blocks = images.reshape((len(images), crop_h, factor, crop_w, factor) + self.image_shape[2:])
+        area = factor * factor
+        if np.issubdtype(self.image_dtype, np.integer):
+            # match the rounding of cv2, which rounds half up when downsampling by a factor of 2
+            block_sums = blocks.sum(axis=(2, 4), dtype=np.int64)
+            if factor == 2:
+                out[...] = (block_sums + area // 2) // area
+            else:
+                out[...] = np.rint(block_sums / area)
+        else:
+            out[...] = blocks.mean(axis=(2, 4), dtype=np.float64)
+
+
+def get_scaled_size(size, scale_size):
+    """
+    Returns the size of an image dimension of the given size after it is
+    resized by cv2.resize with the scale factor scale_size, which rounds
+    half to even.
+    """
+    return int(np.rint(size * scale_size))
+
+
+def _assign_out(data, out):
+    if out is None:
+        return data
+    out[...] = data
+    return out
+
+
 def get_all_transformers(transformer):
     """
     Return all transformers contained in this transformer (including this one).